@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The compact schema of the stored log lines.
+
+The fields get short names, empty strings and None are not stored and
+the values of type and state_type are stored as small integers. Filters,
+aggregation expressions and results are translated between the
+attributes of livestatus and the stored fields here. time and lineno
+keep their names, the order of the lines, the time ranges of queries and
+the partitions only look at them.
+"""
+
+import re
+
+# attribute -> stored field
+FIELDS = {
+    'logobject': 'o',
+    'attempt': 'a',
+    'logclass': 'c',
+    'command_name': 'cn',
+    'comment': 'co',
+    'contact_name': 'ct',
+    'host_name': 'h',
+    'message': 'm',
+    'plugin_output': 'p',
+    'service_description': 's',
+    'state': 'st',
+    'state_type': 'sy',
+    'type': 'ty',
+    # the lowercase copies of lowercase_fields
+    'host_name_lc': 'hl',
+    'service_description_lc': 'sl',
+    'contact_name_lc': 'cl',
+}
+ATTRIBUTES = dict((field, attribute) for attribute, field in FIELDS.items())
+
+# The code of a value is its position in the list. The lists may only be
+# extended at their end, the codes are in the database. Values which are
+# not in the list are stored as they are.
+ENUMS = {
+    'type': [
+        'SERVICE ALERT', 'HOST ALERT', 'SERVICE NOTIFICATION', 'HOST NOTIFICATION',
+        'CURRENT SERVICE STATE', 'CURRENT HOST STATE', 'INITIAL SERVICE STATE', 'INITIAL HOST STATE',
+        'SERVICE DOWNTIME ALERT', 'HOST DOWNTIME ALERT', 'SERVICE FLAPPING ALERT', 'HOST FLAPPING ALERT',
+        'EXTERNAL COMMAND', 'SERVICE EVENT HANDLER', 'HOST EVENT HANDLER', 'TIMEPERIOD TRANSITION',
+        'PASSIVE SERVICE CHECK', 'PASSIVE HOST CHECK', 'LOG ROTATION', 'LOG VERSION',
+    ],
+    'state_type': [
+        'HARD', 'SOFT', 'STARTED', 'STOPPED', 'CANCELLED', 'DOWNTIMESTART', 'DOWNTIMEEND',
+        'DOWNTIMECANCELLED', 'FLAPPINGSTART', 'FLAPPINGSTOP', 'FLAPPINGDISABLED',
+        'ACKNOWLEDGEMENT', 'CUSTOM',
+    ],
+}
+CODES = dict((attribute, dict((value, code) for code, value in enumerate(values)))
+             for attribute, values in ENUMS.items())
+
+# String attributes, an empty one is not stored
+STRING_ATTRIBUTES = ('command_name', 'comment', 'contact_name', 'host_name', 'message', 'plugin_output',
+                     'service_description', 'state_type', 'type',
+                     'host_name_lc', 'service_description_lc', 'contact_name_lc')
+
+# BSON type number of strings, for $type
+BSON_STRING = 2
+
+
+def stored_field(attribute):
+    return FIELDS.get(attribute, attribute)
+
+
+def stored_value(attribute, value):
+    """Return the value stored for an attribute, None if nothing is stored."""
+    if value == '' and attribute in STRING_ATTRIBUTES:
+        return None
+    if attribute in CODES:
+        return CODES[attribute].get(value, value)
+    return value
+
+
+def compact_document(values):
+    """Return the document stored for a log line."""
+    doc = {}
+    for attribute, value in values.iteritems():
+        value = stored_value(attribute, value)
+        if value is not None:
+            doc[FIELDS.get(attribute, attribute)] = value
+    return doc
+
+
+def expand_value(attribute, value):
+    """Return the value of an attribute from a value of its stored field."""
+    if value is None:
+        if attribute in STRING_ATTRIBUTES:
+            return ''
+        return None
+    if attribute in ENUMS and isinstance(value, (int, long)) and 0 <= value < len(ENUMS[attribute]):
+        return ENUMS[attribute][value]
+    return value
+
+
+def stored_row_getter(columns):
+    """Return a function which gives the values of columns in a stored document as a tuple."""
+    fields = [(column, FIELDS.get(column, column)) for column in columns]
+    return lambda doc: tuple([expand_value(column, doc.get(field)) for column, field in fields])
+
+
+def stored_array_row_getter(columns):
+    """Like stored_row_getter for the documents of find_array_documents, {'r': [values]}."""
+    return lambda doc: tuple([expand_value(column, value) for column, value in zip(columns, doc['r'])])
+
+
+def regex_matches(regex, value, options=''):
+    if hasattr(regex, 'pattern'):
+        flags = getattr(regex, 'flags', 0)
+        if not isinstance(flags, (int, long)):
+            options, flags = flags, 0
+        regex = regex.pattern
+    else:
+        flags = 0
+    if 'i' in (options or ''):
+        flags |= re.IGNORECASE
+    return re.search(regex, value, flags) is not None
+
+
+def matches(condition, value):
+    """Tell whether a string meets a condition of a filter, like MongoDB does.
+
+    None is returned if the condition has an operator which is not known.
+    """
+    if hasattr(condition, 'pattern'):
+        return regex_matches(condition, value)
+    if not isinstance(condition, dict):
+        return value == condition
+    result = True
+    for operator, reference in condition.items():
+        if operator == '$options':
+            continue
+        elif operator == '$regex':
+            met = regex_matches(reference, value, condition.get('$options'))
+        elif operator == '$eq':
+            met = matches(reference, value)
+        elif operator == '$ne':
+            met = not matches(reference, value)
+        elif operator in ('$in', '$nin'):
+            met = bool([ref for ref in reference if matches(ref, value)])
+            if operator == '$nin':
+                met = not met
+        elif operator == '$not':
+            met = matches(reference, value)
+            if met is not None:
+                met = not met
+        elif operator in ('$lt', '$lte', '$gt', '$gte'):
+            if not isinstance(reference, basestring):
+                met = False
+            elif operator == '$lt':
+                met = value < reference
+            elif operator == '$lte':
+                met = value <= reference
+            elif operator == '$gt':
+                met = value > reference
+            else:
+                met = value >= reference
+        elif operator == '$exists':
+            met = bool(reference)
+        else:
+            return None
+        if met is None:
+            return None
+        result = result and met
+    return result
+
+
+def matches_missing(condition):
+    """Tell whether MongoDB lets a document without the field pass a condition."""
+    if condition is None:
+        return True
+    if not isinstance(condition, dict) or not condition:
+        return False
+    for operator, reference in condition.items():
+        if operator == '$ne' and reference is not None:
+            continue
+        if operator == '$nin' and None not in reference:
+            continue
+        if operator == '$not' or (operator == '$exists' and not reference):
+            continue
+        return False
+    return True
+
+
+def compact_reference(attribute, reference):
+    """Return the stored form of a value a field is compared with."""
+    if isinstance(reference, basestring):
+        return stored_value(attribute, reference)
+    return reference
+
+
+def compact_condition(attribute, condition):
+    """Return the filter on the stored field for a condition on an attribute."""
+    field = FIELDS.get(attribute, attribute)
+    if attribute not in STRING_ATTRIBUTES:
+        return {field: condition}
+    if isinstance(condition, basestring):
+        # the most common case, host_name = test_host_0
+        return {field: compact_reference(attribute, condition)}
+    if isinstance(condition, dict) and condition and set(condition) <= set(['$ne', '$in', '$nin']):
+        mapped = {}
+        for operator, reference in condition.items():
+            if operator == '$ne':
+                mapped[operator] = compact_reference(attribute, reference)
+            else:
+                mapped[operator] = [compact_reference(attribute, ref) for ref in reference]
+        return {field: mapped}
+    # An empty string is stored as a missing field
+    empty = matches(condition, '')
+    if attribute in ENUMS:
+        # The codes of the values which meet the condition, the values
+        # which are not in the list are stored as strings
+        codes = [code for code, value in enumerate(ENUMS[attribute]) if matches(condition, value) is not False]
+        branches = [{'$and': [{field: {'$type': BSON_STRING}}, {field: condition}]}]
+        if codes:
+            branches.insert(0, {field: {'$in': codes}})
+    elif matches_missing(condition):
+        if empty is False:
+            return {'$and': [{field: condition}, {field: {'$ne': None}}]}
+        return {field: condition}
+    else:
+        branches = [{field: condition}]
+    if empty is not False:
+        branches.append({field: None})
+    if len(branches) == 1:
+        return branches[0]
+    return {'$or': branches}
+
+
+def compact_filter(mongo_filter):
+    """Return the filter on the stored fields for a filter made by the filter compiler."""
+    parts = []
+    for key, value in mongo_filter.items():
+        if key in ('$and', '$or', '$nor'):
+            parts.append({key: [compact_filter(sub) for sub in value]})
+        elif key.startswith('$') or key in ATTRIBUTES:
+            # $text, or already a stored field
+            parts.append({key: value})
+        else:
+            parts.append(compact_condition(key, value))
+    result = {}
+    for part in parts:
+        if set(part) & set(result):
+            result = {'$and': parts}
+            break
+        result.update(part)
+    if isinstance(mongo_filter, dict) and mongo_filter.__class__ is not dict:
+        # keep a Superset a Superset
+        return mongo_filter.__class__(result)
+    return result
+
+
+def compact_operand(attribute):
+    """Return the aggregation expression for the value of an attribute.
+
+    A string attribute which is not stored is the empty string, the codes
+    of ENUMS are not translated.
+    """
+    field = '$' + FIELDS.get(attribute, attribute)
+    if attribute in STRING_ATTRIBUTES:
+        return {'$ifNull': [field, '']}
+    return field
+
+
+def compact_expression(expression):
+    """Translate an expression of make_expression, like {'$eq': ['$state', 2]}.
+
+    None is returned if it can't be done, then the stats must be computed
+    by livestatus.
+    """
+    operator, (operand, reference) = list(expression.items())[0]
+    attribute = operand[1:]
+    if attribute in ENUMS:
+        if operator not in ('$eq', '$ne'):
+            return None
+        if reference != '':
+            reference = CODES[attribute].get(reference, reference)
+    return {operator: [compact_operand(attribute), reference]}
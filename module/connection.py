@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The connections to MongoDB.
+
+MongoPool holds one MongoClient, which is shared by the writer and the
+queries. It counts how often its connections are taken and how long
+this had to wait, which helps to choose the size of the pool.
+"""
+
+import time
+import threading
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+try:
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # pymongo < 2.7 raises no BulkWriteError
+    class BulkWriteError(Exception):
+        pass
+
+try:
+    from pymongo import MongoClient, MongoReplicaSetClient
+except ImportError:
+    MongoClient = MongoReplicaSetClient = None
+
+
+def pool_options(pool_size=100, connect_timeout=None, socket_timeout=None, wait_queue_timeout=None,
+                 server_selection_timeout=None, w=None, journal=None, fsync=None, wtimeout=None):
+    """Return the keyword arguments of MongoClient for the options.
+
+    Timeouts are in seconds, None leaves the default of pymongo.
+    """
+    options = {'maxPoolSize': pool_size}
+    for name, value in (('connectTimeoutMS', connect_timeout),
+                        ('socketTimeoutMS', socket_timeout),
+                        ('waitQueueTimeoutMS', wait_queue_timeout),
+                        ('wtimeout', wtimeout)):
+        if value:
+            options[name] = int(value * 1000)
+    # Only known since pymongo 3
+    if server_selection_timeout and pymongo.version_tuple[0] >= 3:
+        options['serverSelectionTimeoutMS'] = int(server_selection_timeout * 1000)
+    if w is not None:
+        # a number of servers or a mode like majority
+        options['w'] = int(w) if w.isdigit() else w
+    # MongoDB refuses j together with fsync or w=0
+    if fsync:
+        options['fsync'] = True
+    elif journal and options.get('w') != 0:
+        options['j'] = True
+    return options
+
+
+def get_database(client, name, read_preference=None):
+    """Return a database of a client which reads with read_preference."""
+    if read_preference is None:
+        return client[name]
+    if hasattr(client, 'get_database'):
+        return client.get_database(name, read_preference=read_preference)
+    db = client[name]
+    db.read_preference = read_preference
+    return db
+
+
+# The error codes of an insert of a document whose _id is already there
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+
+def only_duplicate_keys(exp):
+    """Tell if a bulk insert only failed because some documents were already there."""
+    details = getattr(exp, 'details', None) or {}
+    if details.get('writeConcernErrors'):
+        return False
+    errors = details.get('writeErrors') or []
+    return bool(errors) and all(error.get('code') in DUPLICATE_KEY_CODES for error in errors)
+
+
+def insert_many(collection, documents):
+    """Insert documents with an unordered bulk insert.
+
+    Documents which are already in the collection, because an insert of
+    them was interrupted before and they are written again, are skipped.
+    """
+    try:
+        if hasattr(collection, 'insert_many'):
+            collection.insert_many(documents, ordered=False)
+        else:
+            collection.insert(documents, continue_on_error=True)
+    except DuplicateKeyError:
+        pass
+    except BulkWriteError, exp:
+        if not only_duplicate_keys(exp):
+            raise
+
+
+def delete_many(collection, mongo_filter):
+    if hasattr(collection, 'delete_many'):
+        collection.delete_many(mongo_filter)
+    else:
+        collection.remove(mongo_filter)
+
+
+def create_index(collection, keys, **kwargs):
+    if hasattr(collection, 'create_index'):
+        collection.create_index(keys, **kwargs)
+    else:
+        collection.ensure_index(keys, **kwargs)
+
+
+class MongoPool(object):
+    """A MongoClient and the statistics of the use of its connections.
+
+    Every database operation of the module is done between checkout()
+    and checkin(). At most pool_size of them run at the same time, the
+    others wait for a free connection.
+    """
+
+    def __init__(self, uri, replica_set=None, pool_size=100, **options):
+        self.uri = uri
+        self.replica_set = replica_set
+        self.pool_size = pool_size
+        self.options = pool_options(pool_size, **options)
+        self.client = None
+        self.slots = threading.Semaphore(pool_size)
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def connect(self):
+        """Create the client, this raises if the servers can't be reached."""
+        if self.client is None:
+            options = dict(self.options)
+            if self.replica_set:
+                options['replicaSet'] = self.replica_set
+            if MongoClient is None:
+                # pymongo < 2.4
+                self.client = pymongo.Connection(self.uri, max_pool_size=self.pool_size)
+            elif self.replica_set and pymongo.version_tuple[0] < 3:
+                self.client = MongoReplicaSetClient(self.uri, **options)
+            else:
+                self.client = MongoClient(self.uri, **options)
+        return self.client
+
+    def checkout(self):
+        """Take a connection, wait if all of them are in use."""
+        start = time.time()
+        waited = not self.slots.acquire(False)
+        if waited:
+            self.slots.acquire()
+        wait = time.time() - start
+        self.lock.acquire()
+        try:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        finally:
+            self.lock.release()
+
+    def checkin(self):
+        self.lock.acquire()
+        try:
+            self.in_use -= 1
+        finally:
+            self.lock.release()
+        self.slots.release()
+
+    def stats(self):
+        """Return the statistics of the checkouts as a dict."""
+        self.lock.acquire()
+        try:
+            return {
+                'pool_size': self.pool_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'avg_wait': self.waits and self.wait_time / self.waits or 0.0,
+                'max_wait': self.max_wait,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+            }
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
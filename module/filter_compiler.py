@@ -0,0 +1,546 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Translation of livestatus Filter:/And:/Or: headers into pymongo query
+documents.
+
+Every filter is a dict which can be given to find() as it is. The empty
+dict is the filter which lets everything pass. A Superset dict marks a
+filter which lets pass more than the livestatus filter it was made of, for
+example because it tests an attribute which is not stored in the database.
+That is always correct, because the result of the database query goes
+through the in-memory filters of livestatus too. But it can not be
+negated, Negate: of a Superset lets everything pass.
+"""
+
+import re
+
+from bson.son import SON
+
+try:
+    from bson.regex import Regex
+except ImportError:
+    Regex = None
+
+# These attributes are numbers in the database, the others are strings
+INT_ATTRIBUTES = ('time', 'state', 'attempt', 'logclass')
+STRING_ATTRIBUTES = ('command_name', 'comment', 'contact_name', 'host_name', 'message', 'plugin_output', 'service_description', 'state_type', 'type')
+
+COMPARISONS = {
+    '<': '$lt',
+    '>': '$gt',
+    '<=': '$lte',
+    '>=': '$gte',
+}
+
+EXPRESSION_OPERATORS = {
+    '=': '$eq',
+    '!=': '$ne',
+    '<': '$lt',
+    '>': '$gt',
+    '<=': '$lte',
+    '>=': '$gte',
+}
+
+INVERSE_OPERATORS = {
+    '$lt': '$gte',
+    '$gte': '$lt',
+    '$gt': '$lte',
+    '$lte': '$gt',
+    '$in': '$nin',
+    '$nin': '$in',
+}
+
+# Lowercase copies of these attributes can be stored, so that
+# case-insensitive comparisons can use an index
+LOWERCASE_ATTRIBUTES = ('host_name', 'service_description', 'contact_name')
+
+# A text index on these attributes lets a $text search find words in them
+TEXT_ATTRIBUTES = ('message', 'plugin_output')
+
+# A pattern which only looks for whole words, like "\btimeout\b" or
+# "\bconnection refused\b"
+WORDS = re.compile(r'^\\b([A-Za-z0-9]+( [A-Za-z0-9]+)*)\\b$')
+
+# Characters with a meaning in a regular expression
+REGEX_SPECIAL = '.^$*+?{}[]\\|()'
+
+# The range operators as python functions
+RANGE_OPERATORS = {
+    '$lt': lambda value, reference: value < reference,
+    '$gt': lambda value, reference: value > reference,
+    '$lte': lambda value, reference: value <= reference,
+    '$gte': lambda value, reference: value >= reference,
+}
+
+
+class Superset(dict):
+    """A filter which may let pass more than it should."""
+    pass
+
+
+def is_regex(value):
+    return (Regex is not None and isinstance(value, Regex)) or hasattr(value, 'pattern')
+
+
+def escape_regex(value):
+    """Return a regular expression which matches value literally.
+
+    Unlike re.escape, only the characters with a meaning are escaped,
+    so that the bytes of a UTF-8 string stay valid UTF-8 for BSON.
+    """
+    return ''.join(char in REGEX_SPECIAL and '\\' + char or char for char in value)
+
+
+def make_regex(pattern, nocase=False):
+    """Return a regular expression object which pymongo sends as BSON regex."""
+    if Regex is not None:
+        return Regex(pattern, nocase and 'i' or '')
+    return re.compile(pattern, nocase and re.IGNORECASE or 0)
+
+
+def lowercase_field(attribute):
+    """Return the name of the lowercase copy of an attribute."""
+    return attribute + '_lc'
+
+
+def lowercase(value):
+    """Return the value in lowercase, non-ASCII letters too if it is UTF-8."""
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8').lower().encode('utf-8')
+        except UnicodeError:
+            return value.lower()
+    return value.lower()
+
+
+def literal_prefix(pattern):
+    """Split an anchored regular expression into its literal prefix and the rest.
+
+    Every string the pattern matches starts with the prefix. None is
+    returned if the pattern is not anchored with ^ or has alternatives.
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return None
+    prefix = []
+    pos = 1
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\' and pos + 1 < len(pattern) and not pattern[pos + 1].isalnum():
+            literal, width = pattern[pos + 1], 2
+        elif char in REGEX_SPECIAL:
+            break
+        else:
+            literal, width = char, 1
+        # a quantifier makes the character optional or repeats it
+        if pattern[pos + width:pos + width + 1] in ('*', '+', '?', '{'):
+            break
+        prefix.append(literal)
+        pos += width
+    return ''.join(prefix), pattern[pos:]
+
+
+def prefix_range(prefix):
+    """Return the range condition for the strings which start with prefix.
+
+    MongoDB compares strings by their UTF-8 bytes, the upper bound is the
+    prefix with its last character incremented. Only ASCII prefixes are
+    turned into a range, None is returned for the others.
+    """
+    try:
+        prefix.encode('ascii')
+    except UnicodeError:
+        return None
+    if not prefix or prefix[-1] >= '\x7f':
+        return None
+    return {'$gte': prefix, '$lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+
+def regex_filter(attribute, pattern, nocase=False, lowercase_fields=False):
+    """Return the filter for a match of an attribute with a regular expression.
+
+    A pattern which only tests a literal prefix, like ^web or ^web.*, is
+    turned into a range, which MongoDB reads from an index. Without
+    case, this needs the lowercase copy of the attribute.
+    """
+    split = literal_prefix(pattern)
+    if split is not None and split[0]:
+        prefix, rest = split
+        if not nocase:
+            condition = prefix_range(prefix)
+            if condition is not None and rest in ('', '.*'):
+                return {attribute: condition}
+        elif lowercase_fields and attribute in LOWERCASE_ATTRIBUTES:
+            condition = prefix_range(lowercase(prefix))
+            if condition is not None:
+                if rest in ('', '.*'):
+                    return {lowercase_field(attribute): condition}
+                return {lowercase_field(attribute): condition,
+                        attribute: {'$regex': pattern, '$options': 'i'}}
+    if nocase:
+        return {attribute: {'$regex': pattern, '$options': 'i'}}
+    return {attribute: {'$regex': pattern}}
+
+
+def coerce(attribute, reference):
+    """Convert the reference of a filter to the type of the attribute.
+
+    Raises ValueError if this is not possible.
+    """
+    if attribute in INT_ATTRIBUTES:
+        try:
+            return int(reference)
+        except ValueError:
+            return float(reference)
+    return reference
+
+
+def make_filter(operator, attribute, reference, lowercase_fields=False):
+    """Return the filter for a livestatus Filter: line.
+
+    With lowercase_fields, case-insensitive comparisons of the
+    LOWERCASE_ATTRIBUTES use their lowercase copies.
+    """
+    # We should change the "class" query into the internal "logclass" attribute
+    if attribute == 'class':
+        attribute = 'logclass'
+    if attribute not in INT_ATTRIBUTES and attribute not in STRING_ATTRIBUTES:
+        return Superset()
+    try:
+        reference = coerce(attribute, reference)
+    except ValueError:
+        return Superset()
+    is_string = attribute in STRING_ATTRIBUTES
+
+    if operator == '=':
+        return {attribute: reference}
+    elif operator == '!=':
+        return {attribute: {'$ne': reference}}
+    elif operator in COMPARISONS:
+        return {attribute: {COMPARISONS[operator]: reference}}
+    elif not is_string:
+        # regular expressions on numbers are left to livestatus
+        return Superset()
+    elif operator == '~':
+        return regex_filter(attribute, reference)
+    elif operator == '~~':
+        return regex_filter(attribute, reference, nocase=True, lowercase_fields=lowercase_fields)
+    elif operator == '=~':
+        if reference == '':
+            return {attribute: ''}
+        if lowercase_fields and attribute in LOWERCASE_ATTRIBUTES:
+            return {lowercase_field(attribute): lowercase(reference)}
+        return {attribute: {'$regex': '^' + escape_regex(reference) + '$', '$options': 'i'}}
+    elif operator == '!=~':
+        if reference == '':
+            return {attribute: {'$ne': ''}}
+        if lowercase_fields and attribute in LOWERCASE_ATTRIBUTES:
+            return {lowercase_field(attribute): {'$ne': lowercase(reference)}}
+        return {attribute: {'$not': make_regex('^' + escape_regex(reference) + '$', nocase=True)}}
+    elif operator in ('!~', '!~~'):
+        try:
+            # $not needs a regular expression object, not $regex
+            return {attribute: {'$not': make_regex(reference, nocase=(operator == '!~~'))}}
+        except re.error:
+            return Superset()
+    return Superset()
+
+
+def make_expression(operator, attribute, reference):
+    """Return an aggregation expression for a condition like state = 2.
+
+    Returns None if the condition can't be evaluated by the database.
+    """
+    if attribute == 'class':
+        attribute = 'logclass'
+    if attribute not in INT_ATTRIBUTES and attribute not in STRING_ATTRIBUTES:
+        return None
+    if operator not in EXPRESSION_OPERATORS:
+        return None
+    try:
+        reference = coerce(attribute, reference)
+    except ValueError:
+        return None
+    return {EXPRESSION_OPERATORS[operator]: ['$' + attribute, reference]}
+
+
+def stats_group(stats, group_by, columns, operand=None, translate=None):
+    """Return the $group stage which computes Stats: and its group_by attributes.
+
+    stats is a list of (function, argument) tuples like the ones of
+    get_live_data_log_stats, group_by a list of the attributes the
+    results are grouped by, which must be in columns. The value s<num>
+    of a group is the result of stats[num], g<num> in its _id the value
+    of group_by[num] and n its number of lines. operand(attribute)
+    returns the aggregation expression of an attribute and
+    translate(expression) the one of a condition, which may be None,
+    both for another schema of the stored lines. (None, None) is
+    returned if the stats can't be computed by the database.
+    """
+    if operand is None:
+        operand = lambda attribute: '$' + attribute
+    group = {}
+    group_id = SON()
+    attributes = []
+    for num, attribute in enumerate(group_by):
+        if attribute == 'class':
+            attribute = 'logclass'
+        if attribute not in columns:
+            return None, None
+        attributes.append(attribute)
+        group_id['g%d' % num] = operand(attribute)
+    for num, (function, argument) in enumerate(stats):
+        if function == 'count' and argument is None:
+            group['s%d' % num] = {'$sum': 1}
+        elif function == 'count':
+            attribute, operator, reference = argument
+            expression = make_expression(operator, attribute, reference)
+            if expression is not None and translate is not None:
+                expression = translate(expression)
+            if expression is None:
+                return None, None
+            group['s%d' % num] = {'$sum': {'$cond': [expression, 1, 0]}}
+        elif function in ('min', 'max', 'sum', 'avg') and argument in INT_ATTRIBUTES:
+            group['s%d' % num] = {'$' + function: operand(argument)}
+        else:
+            return None, None
+    group['_id'] = group_id or None
+    # The number of lines is needed to combine the averages of several buckets
+    group['n'] = {'$sum': 1}
+    return group, attributes
+
+
+def time_bounds(mongo_filter, attribute='time'):
+    """Return (low, high) of the time range a filter selects.
+
+    Only conditions which apply to the whole filter are used, i.e. the
+    ones which are not inside an $or or $nor. low or high are None if
+    the range is open on this side.
+    """
+    low = high = None
+    for key, value in mongo_filter.items():
+        if key == '$and':
+            for sub in value:
+                sub_low, sub_high = time_bounds(sub, attribute)
+                if sub_low is not None and (low is None or sub_low > low):
+                    low = sub_low
+                if sub_high is not None and (high is None or sub_high < high):
+                    high = sub_high
+        elif key == attribute:
+            if isinstance(value, dict):
+                conditions = value.items()
+            else:
+                conditions = [('$gte', value), ('$lte', value)]
+            for operator, reference in conditions:
+                if not isinstance(reference, (int, long, float)):
+                    continue
+                if operator in ('$gt', '$gte') and (low is None or reference > low):
+                    low = reference
+                elif operator in ('$lt', '$lte') and (high is None or reference < high):
+                    high = reference
+    return low, high
+
+
+def top_conditions(mongo_filter):
+    """Yield the (attribute, condition) pairs which apply to the whole filter.
+
+    These are the ones which are not inside an $or, $nor or $not.
+    """
+    for key, value in mongo_filter.items():
+        if key == '$and':
+            for sub in value:
+                for pair in top_conditions(sub):
+                    yield pair
+        else:
+            yield key, value
+
+
+def add_text_search(mongo_filter):
+    """Add a $text search to a filter which looks for whole words in a text attribute.
+
+    A regular expression like \\btimeout\\b on message or plugin_output,
+    which only consists of words between word boundaries, is also searched
+    in the text index, which finds these words exactly where the regular
+    expression can match. It stays in the filter, so the result is the
+    same with and without the search. Other regular expressions are left
+    alone, timeout also finds timeouts. A query can have only one $text,
+    which must apply to the whole query, so only the first such condition
+    outside of $or, $nor and $not is used.
+    """
+    search = None
+    for key, value in top_conditions(mongo_filter):
+        if key == '$text':
+            return mongo_filter
+        if search is None and key in TEXT_ATTRIBUTES and isinstance(value, dict) and \
+                set(value) <= set(['$regex', '$options']) and value.get('$options', '') in ('', 'i') and \
+                isinstance(value.get('$regex'), basestring) and WORDS.match(value['$regex']):
+            search = WORDS.match(value['$regex']).group(1)
+    if search is None:
+        return mongo_filter
+    # A phrase, so that all the words must be there in this order. Words
+    # are not stemmed with the language none.
+    text = {'$text': {'$search': '"%s"' % search, '$language': 'none'}}
+    result = dict(mongo_filter)
+    result.update(text)
+    if isinstance(mongo_filter, Superset):
+        return Superset(result)
+    return result
+
+
+def is_range(value):
+    """Tell whether a condition only compares with numbers, like time >= 10."""
+    if isinstance(value, (int, long, float)):
+        return True
+    if not isinstance(value, dict) or not value:
+        return False
+    for name, reference in value.items():
+        if name not in RANGE_OPERATORS or not isinstance(reference, (int, long, float)):
+            return False
+    return True
+
+
+def split_window(mongo_filter, attribute='time'):
+    """Split a filter into the range on attribute and the other conditions.
+
+    Like time_bounds, only the conditions which apply to the whole filter
+    are taken. Returns the filter without them and the list of their
+    (operator, reference) pairs.
+    """
+    rest = {}
+    window = []
+    for key, value in mongo_filter.items():
+        if key == '$and':
+            subs = []
+            for sub in value:
+                sub_rest, sub_window = split_window(sub, attribute)
+                window.extend(sub_window)
+                if sub_rest:
+                    subs.append(sub_rest)
+            if subs:
+                rest['$and'] = subs
+        elif key == attribute and is_range(value):
+            if isinstance(value, dict):
+                window.extend(value.items())
+            else:
+                window.extend([('$gte', value), ('$lte', value)])
+        else:
+            rest[key] = value
+    return rest, window
+
+
+def in_window(window, value):
+    """Tell whether a value matches all the conditions of a window."""
+    for name, reference in window:
+        if not RANGE_OPERATORS[name](value, reference):
+            return False
+    return True
+
+
+def after_filter(watermark):
+    """Return a filter for the lines after a (time, lineno) watermark."""
+    time, lineno = watermark
+    return {'$or': [{'time': {'$gt': time}}, {'time': time, 'lineno': {'$gt': lineno}}]}
+
+
+def and_filters(filters):
+    """Return a filter which lets pass what passes all the filters."""
+    inexact = [f for f in filters if isinstance(f, Superset)]
+    filters = [f for f in filters if f]
+    if not filters:
+        result = {}
+    elif len(filters) == 1:
+        result = filters[0]
+    else:
+        result = {'$and': filters}
+    if inexact:
+        return Superset(result)
+    return result
+
+
+def or_filters(filters):
+    """Return a filter which lets pass what passes one of the filters."""
+    inexact = [f for f in filters if isinstance(f, Superset)]
+    if not filters or [f for f in filters if not f]:
+        # one of them lets everything pass
+        result = {}
+    elif len(filters) == 1:
+        result = filters[0]
+    else:
+        result = {'$or': filters}
+    if inexact:
+        return Superset(result)
+    return result
+
+
+def not_condition(condition):
+    """Return the negation of the condition on one attribute or None."""
+    if is_regex(condition):
+        return {'$not': condition}
+    if not isinstance(condition, dict):
+        return {'$ne': condition}
+    if len(condition) == 1:
+        operator, value = list(condition.items())[0]
+        if operator == '$ne':
+            if isinstance(value, dict) or is_regex(value):
+                return {'$in': [value]}
+            return value
+        if operator in INVERSE_OPERATORS:
+            return {INVERSE_OPERATORS[operator]: value}
+        if operator == '$not':
+            return value
+        if operator == '$exists':
+            return {'$exists': not value}
+        if operator == '$regex':
+            return {'$not': make_regex(value)}
+    elif set(condition) == set(['$regex', '$options']) and condition['$options'] in ('', 'i'):
+        return {'$not': make_regex(condition['$regex'], nocase=(condition['$options'] == 'i'))}
+    return None
+
+
+def not_filter(mongo_filter):
+    """Return a filter which lets pass what the given filter rejects.
+
+    The negation is pushed down to the single attributes with De Morgan's
+    laws, so that the database can still use its indexes. Conditions
+    without an inverse operator are wrapped into a $nor.
+    """
+    if isinstance(mongo_filter, Superset) or not mongo_filter:
+        # We don't know exactly what the filter rejects, so let everything pass
+        return Superset()
+    if len(mongo_filter) > 1:
+        # several attributes in one dict are an implicit $and
+        return not_filter({'$and': [{key: value} for key, value in sorted(mongo_filter.items())]})
+    key, value = list(mongo_filter.items())[0]
+    if key == '$and':
+        return or_filters([not_filter(f) for f in value])
+    if key == '$or':
+        return and_filters([not_filter(f) for f in value])
+    if key == '$nor':
+        return or_filters(value)
+    if not key.startswith('$'):
+        condition = not_condition(value)
+        if condition is not None:
+            return {key: condition}
+    return {'$nor': [mongo_filter]}
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-memory copy of the most recent log lines, stored column by column.
+
+Numbers are kept in arrays of machine integers. The strings of columns
+with few different values are stored once in a dictionary and the
+lines only keep their index, so a filter on such a column is evaluated
+once per different value and not once per line.
+"""
+
+import re
+import time
+import bisect
+import threading
+from array import array
+
+# These columns are stored as arrays of integers
+NUMERIC_COLUMNS = ('time', 'lineno', 'logobject', 'logclass', 'state', 'attempt')
+# These are stored as indexes into the list of their different values
+ENCODED_COLUMNS = ('host_name', 'service_description', 'type', 'state_type', 'contact_name', 'command_name')
+# These are mostly different for every line and are stored as they are
+TEXT_COLUMNS = ('message', 'plugin_output', 'comment')
+
+# A None in a numeric column
+NULL = -2 ** 31
+
+# Lines are only removed when this many seconds have passed since the
+# oldest of them expired, so that the arrays are not moved for every line
+EXPIRE_SLACK = 60
+
+REGEX_FLAGS = {
+    'i': re.IGNORECASE,
+    'm': re.MULTILINE,
+    's': re.DOTALL,
+    'x': re.VERBOSE,
+}
+
+
+class UnsupportedFilter(Exception):
+    """The filter uses something the hot tier can't evaluate."""
+    pass
+
+
+def compile_regex(pattern, options=''):
+    if hasattr(pattern, 'pattern'):
+        flags = getattr(pattern, 'flags', 0)
+        if not isinstance(flags, (int, long)):
+            options, flags = flags, 0
+        pattern = pattern.pattern
+    else:
+        flags = 0
+    for option in options or '':
+        if option not in REGEX_FLAGS:
+            raise UnsupportedFilter('regex option %s' % option)
+        flags |= REGEX_FLAGS[option]
+    return re.compile(pattern, flags)
+
+
+def regex_predicate(regex):
+    return lambda value: isinstance(value, basestring) and regex.search(value) is not None
+
+
+def make_predicate(operator, reference, condition):
+    """Return a function which tells whether a value meets one condition.
+
+    None is a missing value, it is handled like MongoDB handles null.
+    """
+    if operator == '$eq':
+        if hasattr(reference, 'pattern'):
+            return regex_predicate(compile_regex(reference))
+        return lambda value: value == reference
+    if operator == '$ne':
+        return lambda value: value != reference
+    if operator == '$lt':
+        return lambda value: value is not None and value < reference
+    if operator == '$lte':
+        return lambda value: value is not None and value <= reference
+    if operator == '$gt':
+        return lambda value: value is not None and value > reference
+    if operator == '$gte':
+        return lambda value: value is not None and value >= reference
+    if operator in ('$in', '$nin'):
+        if [ref for ref in reference if hasattr(ref, 'pattern')]:
+            raise UnsupportedFilter('regex in %s' % operator)
+        references = frozenset(reference)
+        if operator == '$in':
+            return lambda value: value in references
+        return lambda value: value not in references
+    if operator == '$regex':
+        return regex_predicate(compile_regex(reference, condition.get('$options')))
+    if operator == '$not':
+        if hasattr(reference, 'pattern'):
+            predicate = regex_predicate(compile_regex(reference))
+        else:
+            predicate = condition_predicate(reference)
+        return lambda value: not predicate(value)
+    if operator == '$type':
+        # only the type of strings is asked for
+        if reference != 2:
+            raise UnsupportedFilter('$type %s' % reference)
+        return lambda value: isinstance(value, basestring)
+    if operator == '$exists':
+        # Every line has all the columns
+        return lambda value: bool(reference)
+    raise UnsupportedFilter(operator)
+
+
+def condition_predicate(condition):
+    """Return a function which tells whether a value meets a condition of a filter."""
+    if isinstance(condition, dict) and condition and not [k for k in condition if not k.startswith('$')]:
+        predicates = [make_predicate(operator, reference, condition)
+                      for operator, reference in condition.items() if operator != '$options']
+    else:
+        predicates = [make_predicate('$eq', condition, {})]
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda value: all(predicate(value) for predicate in predicates)
+
+
+class HotTier(object):
+    """The log lines of the last max_age seconds.
+
+    The lines are kept in (time, lineno) order. All the lines since
+    complete_since are in the hot tier, so queries which only want lines
+    from this time on can be answered without the database.
+    """
+
+    def __init__(self, max_age, now=None, derived=None):
+        self.max_age = max_age
+        # field -> (column, function) of the fields of the documents which
+        # are computed from a column, like the lowercase copy of a name
+        self.derived = derived or {}
+        self.complete_since = now or time.time()
+        self.lock = threading.Lock()
+        self.columns = {}
+        for name in NUMERIC_COLUMNS + ENCODED_COLUMNS:
+            self.columns[name] = array('l')
+        for name in TEXT_COLUMNS:
+            self.columns[name] = []
+        # column -> list of the different values and the index of each of them
+        self.dictionaries = {}
+        for name in ENCODED_COLUMNS:
+            self.dictionaries[name] = ([], {})
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def encode(self, name, value):
+        values, codes = self.dictionaries[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def add(self, line):
+        """Add a log line, a dict like the document stored in the database."""
+        self.lock.acquire()
+        try:
+            times = self.columns['time']
+            linenos = self.columns['lineno']
+            line_time = int(line['time'])
+            lineno = int(line['lineno'])
+            position = len(times)
+            # Lines arrive in order, unless the clock of a poller goes wrong
+            if position and (line_time, lineno) < (times[-1], linenos[-1]):
+                position = bisect.bisect_right(times, line_time)
+                while position and times[position - 1] == line_time and linenos[position - 1] > lineno:
+                    position -= 1
+            for name in NUMERIC_COLUMNS:
+                value = line.get(name)
+                self.columns[name].insert(position, NULL if value is None else int(value))
+            for name in ENCODED_COLUMNS:
+                self.columns[name].insert(position, self.encode(name, line.get(name)))
+            for name in TEXT_COLUMNS:
+                self.columns[name].insert(position, line.get(name))
+        finally:
+            self.lock.release()
+
+    def expire(self, now=None):
+        """Remove the lines which are older than max_age."""
+        oldest = (now or time.time()) - self.max_age
+        self.lock.acquire()
+        try:
+            times = self.columns['time']
+            if not times or times[0] >= oldest - EXPIRE_SLACK:
+                return
+            count = bisect.bisect_left(times, oldest)
+            for column in self.columns.values():
+                del column[:count]
+            self.complete_since = max(self.complete_since, oldest)
+        finally:
+            self.lock.release()
+
+    def covers(self, low):
+        """Tell whether all the lines since low are in the hot tier."""
+        return low is not None and low >= self.complete_since
+
+    def find(self, mongo_filter, columns, low, high=None, limit=None):
+        """Return the lines which match a filter in (time, lineno) order.
+
+        A line is the tuple of the values of columns. low and high are the bounds of the time range of the filter. None
+        is returned if the hot tier doesn't have all the lines of this
+        range or if it can't evaluate the filter.
+        """
+        if not self.covers(low):
+            return None
+        self.lock.acquire()
+        try:
+            times = self.columns['time']
+            start = bisect.bisect_left(times, low)
+            end = len(times)
+            if high is not None:
+                end = bisect.bisect_right(times, high, start)
+            try:
+                rows = self.select(mongo_filter, range(start, end))
+            except UnsupportedFilter:
+                return None
+            if limit:
+                rows = rows[:limit]
+            values = [self.column_values(name, rows) for name in columns]
+        finally:
+            self.lock.release()
+        return zip(*values)
+
+    def select(self, mongo_filter, rows):
+        """Return the rows which match a filter, in the order they are in rows."""
+        for key, value in mongo_filter.items():
+            if not rows:
+                break
+            if key == '$and':
+                for sub in value:
+                    rows = self.select(sub, rows)
+            elif key in ('$or', '$nor'):
+                selected = set()
+                for sub in value:
+                    selected.update(self.select(sub, rows))
+                if key == '$or':
+                    rows = [row for row in rows if row in selected]
+                else:
+                    rows = [row for row in rows if row not in selected]
+            elif key in self.columns:
+                rows = self.select_column(key, condition_predicate(value), rows)
+            elif key == '$text':
+                # The regular expression the search was made of is in
+                # the filter too
+                continue
+            elif key in self.derived:
+                name, function = self.derived[key]
+                predicate = condition_predicate(value)
+                rows = self.select_column(name, lambda original: predicate(original if original is None else function(original)), rows)
+            else:
+                raise UnsupportedFilter(key)
+        return rows
+
+    def select_column(self, name, predicate, rows):
+        column = self.columns[name]
+        if name in ENCODED_COLUMNS:
+            values = self.dictionaries[name][0]
+            codes = [code for code, value in enumerate(values) if predicate(value)]
+            if len(codes) == 1:
+                code = codes[0]
+                return [row for row in rows if column[row] == code]
+            codes = frozenset(codes)
+            return [row for row in rows if column[row] in codes]
+        if name in NUMERIC_COLUMNS:
+            return [row for row in rows if predicate(None if column[row] == NULL else column[row])]
+        return [row for row in rows if predicate(column[row])]
+
+    def column_values(self, name, rows):
+        column = self.columns[name]
+        if name in ENCODED_COLUMNS:
+            values = self.dictionaries[name][0]
+            return [values[column[row]] for row in rows]
+        if name in NUMERIC_COLUMNS:
+            return [None if column[row] == NULL else column[row] for row in rows]
+        return [column[row] for row in rows]
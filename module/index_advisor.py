@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The indexes of the log collection and an advisor which watches the shapes
+of the queries and tells which of them have no matching index.
+"""
+
+import threading
+
+import pymongo
+
+# logs_idx and time_1_lineno_1 are the indexes the module always had
+DEFAULT_INDEXES = 'logs_idx:host_name,time,lineno;time,lineno'
+# and these are added for the lowercase copies of lowercase_fields
+LOWERCASE_INDEXES = 'host_name_lc,time,lineno;service_description_lc,time,lineno;contact_name_lc,time,lineno'
+# the keys of the text index of text_search
+TEXT_INDEX = [('message', 'text'), ('plugin_output', 'text')]
+
+EQUALITY = 'eq'
+RANGE = 'range'
+REGEX = 'regex'
+TEXT = 'text'
+OTHER = 'other'
+
+
+def parse_indexes(spec):
+    """Parse an index specification like the one in DEFAULT_INDEXES.
+
+    Indexes are separated by semicolons, their fields by commas. A field
+    with a leading - is descending. An index can be given a name with a
+    name: prefix. Returns a list of (name, keys) tuples, name is None
+    when the index gets the default name of MongoDB.
+    """
+    indexes = []
+    for index in spec.split(';'):
+        index = index.strip()
+        if not index:
+            continue
+        name = None
+        if ':' in index:
+            name, index = index.split(':', 1)
+            name = name.strip()
+        keys = []
+        for field in index.split(','):
+            field = field.strip()
+            if field.startswith('-'):
+                keys.append((field[1:], pymongo.DESCENDING))
+            else:
+                keys.append((field, pymongo.ASCENDING))
+        indexes.append((name, keys))
+    return indexes
+
+
+def condition_kind(condition):
+    if hasattr(condition, 'pattern'):
+        return REGEX
+    if not isinstance(condition, dict):
+        return EQUALITY
+    operators = set(condition)
+    if operators <= set(['$lt', '$lte', '$gt', '$gte']):
+        return RANGE
+    if '$regex' in operators:
+        return REGEX
+    if operators == set(['$in']):
+        return EQUALITY
+    return OTHER
+
+
+def query_shape(mongo_filter, prefix=''):
+    """Return the shape of a filter: its fields and how they are compared.
+
+    The shape is a sorted tuple of (field, kind) pairs. Fields inside
+    $or or $nor get a prefix, because an index on them can't be used
+    for the whole query.
+    """
+    shape = set()
+    for key, value in mongo_filter.items():
+        if key == '$and':
+            for sub in value:
+                shape.update(query_shape(sub, prefix))
+        elif key in ('$or', '$nor'):
+            for sub in value:
+                shape.update(query_shape(sub, key[1:] + ':'))
+        elif key == '$text' and not prefix:
+            shape.add((key, TEXT))
+        elif key.startswith('$'):
+            shape.add((prefix + key, OTHER))
+        else:
+            shape.add((prefix + key, condition_kind(value)))
+    return tuple(sorted(shape))
+
+
+def shape_to_string(shape):
+    return ' '.join('%s:%s' % field for field in shape) or '(all)'
+
+
+def is_covered(shape, indexes):
+    """Tell whether one of the indexes serves the top level equality
+    and range conditions of a shape.
+
+    An index serves a query when it starts with all the fields which the
+    query compares for equality, followed by a field the query compares by
+    range, or when there are no equality comparisons and the index starts
+    with a range field. A $text search is served by a text index.
+    """
+    if [field for field, kind in shape if kind == TEXT] and \
+            [keys for keys in indexes if [field for field, direction in keys if direction == 'text']]:
+        return True
+    equal = set(field for field, kind in shape if kind == EQUALITY and ':' not in field)
+    ranges = set(field for field, kind in shape if kind in (RANGE, REGEX) and ':' not in field)
+    for keys in indexes:
+        fields = [field for field, direction in keys]
+        prefix = fields[:len(equal)]
+        if equal and set(prefix) == equal:
+            return True
+        if not equal and fields and fields[0] in ranges:
+            return True
+    return False
+
+
+def suggest_index(shape):
+    equal = sorted(set(field for field, kind in shape if kind == EQUALITY and ':' not in field))
+    return ','.join(equal + ['time', 'lineno'])
+
+
+class QueryShapeStats(object):
+    """Counts and latencies of the queries per shape.
+
+    record -- note the time a query with a filter took
+    report -- return the statistics of the shapes, the most expensive first
+    """
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.shapes = {}
+        self.lock = threading.Lock()
+
+    def set_indexes(self, indexes):
+        self.indexes = indexes
+
+    def record(self, mongo_filter, seconds):
+        shape = query_shape(mongo_filter)
+        self.lock.acquire()
+        try:
+            count, total, slowest = self.shapes.get(shape, (0, 0.0, 0.0))
+            self.shapes[shape] = (count + 1, total + seconds, max(slowest, seconds))
+        finally:
+            self.lock.release()
+
+    def report(self):
+        self.lock.acquire()
+        try:
+            shapes = self.shapes.items()
+        finally:
+            self.lock.release()
+        report = []
+        for shape, (count, total, slowest) in shapes:
+            covered = is_covered(shape, self.indexes)
+            report.append({
+                'shape': shape_to_string(shape),
+                'count': count,
+                'total': total,
+                'avg': total / count,
+                'max': slowest,
+                'covered': covered,
+                'suggestion': not covered and suggest_index(shape) or None,
+            })
+        report.sort(key=lambda entry: entry['total'], reverse=True)
+        return report
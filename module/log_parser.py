@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A fast parser for the common kinds of Shinken log lines.
+
+parse_line() turns a line into the document which is stored in the
+database, the same as Logline(line=line).as_dict() without the lineno.
+It only knows the lines which make up most of the log, for all the
+others it returns None and the line must be parsed by Logline.
+"""
+
+# The same values as in livestatus.log_line
+LOGCLASS_ALERT = 1
+LOGCLASS_NOTIFICATION = 3
+LOGCLASS_COMMAND = 5
+LOGCLASS_STATE = 6
+LOGOBJECT_INFO = 0
+LOGOBJECT_HOST = 1
+LOGOBJECT_SERVICE = 2
+
+SERVICE_STATES = {'OK': 0, 'WARNING': 1, 'CRITICAL': 2, 'UNKNOWN': 3, 'RECOVERY': 0}
+HOST_STATES = {'UP': 0, 'DOWN': 1, 'UNREACHABLE': 2, 'UNKNOWN': 3, 'RECOVERY': 0}
+
+
+def parse_service_state(doc, options):
+    # test_host_0;test_ok_0;CRITICAL;HARD;1;plugin output
+    fields = options.split(';', 5)
+    if len(fields) != 6 or fields[2] not in SERVICE_STATES or not fields[4].isdigit():
+        return False
+    doc['host_name'], doc['service_description'], state, doc['state_type'], attempt, doc['plugin_output'] = fields
+    doc['state'] = SERVICE_STATES[state]
+    doc['attempt'] = int(attempt)
+    return True
+
+
+def parse_host_state(doc, options):
+    # test_host_0;DOWN;HARD;1;plugin output
+    fields = options.split(';', 4)
+    if len(fields) != 5 or fields[1] not in HOST_STATES or not fields[3].isdigit():
+        return False
+    doc['host_name'], state, doc['state_type'], attempt, doc['plugin_output'] = fields
+    doc['state'] = HOST_STATES[state]
+    doc['attempt'] = int(attempt)
+    return True
+
+
+def parse_service_event(doc, options):
+    # test_host_0;test_ok_0;STARTED;comment
+    fields = options.split(';', 3)
+    if len(fields) != 4:
+        return False
+    doc['host_name'], doc['service_description'], doc['state_type'], doc['comment'] = fields
+    return True
+
+
+def parse_host_event(doc, options):
+    # test_host_0;STARTED;comment
+    fields = options.split(';', 2)
+    if len(fields) != 3:
+        return False
+    doc['host_name'], doc['state_type'], doc['comment'] = fields
+    return True
+
+
+def notification_state(doc, state, states):
+    # CRITICAL, or a special notification like DOWNTIMESTART (OK),
+    # FLAPPINGSTART (OK) or ACKNOWLEDGEMENT (CRITICAL), which Logline
+    # stores as UNKNOWN without a state_type
+    if '(' in state:
+        state = 'UNKNOWN'
+    if state not in states:
+        return False
+    doc['state'] = states[state]
+    return True
+
+
+def parse_service_notification(doc, options):
+    # test_contact;test_host_0;test_ok_0;CRITICAL;notify-service;plugin output
+    fields = options.split(';', 5)
+    if len(fields) != 6:
+        return False
+    doc['contact_name'], doc['host_name'], doc['service_description'], state, doc['command_name'], doc['plugin_output'] = fields
+    return notification_state(doc, state, SERVICE_STATES)
+
+
+def parse_host_notification(doc, options):
+    # test_contact;test_host_0;DOWN;notify-host;plugin output
+    fields = options.split(';', 4)
+    if len(fields) != 5:
+        return False
+    doc['contact_name'], doc['host_name'], state, doc['command_name'], doc['plugin_output'] = fields
+    return notification_state(doc, state, HOST_STATES)
+
+
+def parse_nothing(doc, options):
+    return True
+
+
+# type -> logclass, logobject and the function which reads the options
+PARSERS = {
+    'SERVICE ALERT': (LOGCLASS_ALERT, LOGOBJECT_SERVICE, parse_service_state),
+    'HOST ALERT': (LOGCLASS_ALERT, LOGOBJECT_HOST, parse_host_state),
+    'CURRENT SERVICE STATE': (LOGCLASS_STATE, LOGOBJECT_SERVICE, parse_service_state),
+    'CURRENT HOST STATE': (LOGCLASS_STATE, LOGOBJECT_HOST, parse_host_state),
+    'INITIAL SERVICE STATE': (LOGCLASS_STATE, LOGOBJECT_SERVICE, parse_service_state),
+    'INITIAL HOST STATE': (LOGCLASS_STATE, LOGOBJECT_HOST, parse_host_state),
+    'SERVICE DOWNTIME ALERT': (LOGCLASS_ALERT, LOGOBJECT_SERVICE, parse_service_event),
+    'HOST DOWNTIME ALERT': (LOGCLASS_ALERT, LOGOBJECT_HOST, parse_host_event),
+    'SERVICE FLAPPING ALERT': (LOGCLASS_ALERT, LOGOBJECT_SERVICE, parse_service_event),
+    'HOST FLAPPING ALERT': (LOGCLASS_ALERT, LOGOBJECT_HOST, parse_host_event),
+    'SERVICE NOTIFICATION': (LOGCLASS_NOTIFICATION, LOGOBJECT_SERVICE, parse_service_notification),
+    'HOST NOTIFICATION': (LOGCLASS_NOTIFICATION, LOGOBJECT_HOST, parse_host_notification),
+    'EXTERNAL COMMAND': (LOGCLASS_COMMAND, LOGOBJECT_INFO, parse_nothing),
+}
+
+
+def parse_line(line):
+    """Return the document for a log line or None if the line is not known.
+
+    The line looks like [1400000000] SERVICE ALERT: options
+    """
+    if isinstance(line, unicode):
+        line = line.encode('UTF-8')
+    line = line.rstrip()
+    if line[:1] != '[' or line[11:13] != '] ' or not line[1:11].isdigit():
+        return None
+    colon = line.find(':', 13)
+    if colon < 0:
+        return None
+    logtype = line[13:colon]
+    parser = PARSERS.get(logtype)
+    if parser is None:
+        return None
+    logclass, logobject, parse = parser
+    doc = {
+        'time': int(line[1:11]),
+        'type': logtype,
+        'logclass': logclass,
+        'logobject': logobject,
+        'message': line,
+        'attempt': 0,
+        'state': 0,
+        'command_name': '',
+        'comment': '',
+        'contact_name': '',
+        'host_name': '',
+        'plugin_output': '',
+        'service_description': '',
+        'state_type': '',
+    }
+    if not parse(doc, line[colon + 2:]):
+        return None
+    return doc
@@ -30,11 +30,19 @@ It is one possibility for an exchangeable storage for log broks
 """
 
 import os
+import socket
 import time
 import datetime
 import re
 import sys
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from itertools import chain, imap, islice
+from operator import itemgetter
 import pymongo
+from bson.objectid import ObjectId
+from bson.son import SON
 
 from shinken.objects.service import Service
 from shinken.modulesctx import modulesctx
@@ -52,17 +60,28 @@ Logline = livestatus.Logline
 
 
 
-try:
-    from pymongo import ReplicaSetConnection, ReadPreference
-except ImportError:
-    ReplicaSetConnection = None
-    ReadPreference = None
 from pymongo.errors import AutoReconnect
 
 from shinken.basemodule import BaseModule
 from shinken.log import logger
 from shinken.util import to_bool
 
+from .compact_schema import compact_document, compact_filter, compact_expression, compact_operand, \
+    expand_value, stored_field, stored_value, stored_row_getter, stored_array_row_getter
+from .connection import MongoPool, MongoClient, get_database, insert_many, delete_many, create_index
+from .filter_compiler import make_filter, stats_group, and_filters, or_filters, not_filter, after_filter, time_bounds, split_window, in_window, Superset, \
+    LOWERCASE_ATTRIBUTES, lowercase_field, lowercase, add_text_search
+from .hot_tier import HotTier
+from .index_advisor import DEFAULT_INDEXES, LOWERCASE_INDEXES, TEXT_INDEX, QueryShapeStats, parse_indexes, query_shape
+from .log_parser import parse_line
+from .partitions import PERIODS, bucket_name, buckets_in_range, buckets_before, split_by_bucket, time_slices
+from .query_cache import QueryCache
+from .routing import READ_PREFERENCES, NodeLatency, read_preference, cursor_address
+from .slow_query import SlowQueryLog, explain_summary
+from .spool import LogSpool, MemorySpool
+from .stats import Stats, StatsdSender, write_stats_file
+from .writer import LogWriter, OVERFLOW_POLICIES, OVERFLOW_BLOCK, OVERFLOW_SPILL
+
 properties = {
     'daemons': ['livestatus'],
     'type': 'logstore_mongodb',
@@ -86,6 +105,128 @@ CONNECTED = 1
 DISCONNECTED = 2
 SWITCHING = 3
 
+# Lines which are not stored, like "[1400000000] Warning: ..."
+SKIPPED_LINE = re.compile(r"^\[[0-9]*\] [A-Z][a-z]*.:")
+# The number of documents a cursor reads with one connection of the pool
+# if batch_size is not set, the first batch MongoDB sends has 101 of them
+STREAM_BATCH_SIZE = 101
+# The number of these batches a time slice of a parallel query reads ahead
+SLICE_PREFETCH = 4
+# The columns of a log line in the database
+LOGLINE_COLUMNS = ['logobject', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'host_name', 'lineno', 'message', 'plugin_output', 'service_description', 'state', 'state_type', 'time', 'type']
+# These are always fetched, they are needed for the order of the lines
+# and to link a line to its host or service
+PROJECTION_BASE_COLUMNS = ['logobject', 'host_name', 'lineno', 'service_description', 'time']
+# Time windows which end less than this many seconds ago are treated as
+# the window of a polling client by the query cache
+TAIL_WINDOW_SLACK = 60
+# Livestatus columns of the log table which are computed from other columns
+COLUMN_SOURCES = {
+    'class': ['logclass'],
+    'options': ['message'],
+}
+# Livestatus columns with these prefixes come from the object of the log line
+COLUMN_PREFIX_SOURCES = [
+    ('current_host_', ['host_name']),
+    ('current_service_', ['host_name', 'service_description']),
+    ('current_contact_', ['contact_name']),
+    ('current_command_', ['command_name']),
+]
+
+
+def chain_cursors(cursors, pool, chunk_size, limit=None, done=None):
+    """Yield the documents of the cursors one after the other, at most limit.
+
+    They are read in chunks of chunk_size documents, a connection of the
+    pool is taken for every chunk, not while the documents are used.
+    done is called before the cursors are closed.
+    """
+    count = 0
+    try:
+        for cursor in cursors:
+            documents = iter(cursor)
+            while True:
+                pool.checkout()
+                try:
+                    chunk = list(islice(documents, chunk_size))
+                finally:
+                    pool.checkin()
+                if not chunk:
+                    break
+                for doc in chunk:
+                    yield doc
+                    count += 1
+                    if limit and count >= limit:
+                        return
+    finally:
+        if done:
+            done()
+        for cursor in cursors:
+            cursor.close()
+
+
+def put_unless_stopped(queue, item, stopped):
+    """Put item into a bounded queue, give up if stopped is set. Returns if it was put."""
+    while not stopped.is_set():
+        try:
+            queue.put(item, True, 0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def fetch_slice(find, filter_element, argument, queue, stopped, chunk_size):
+    """Put the documents of one slice of a query into queue.
+
+    They are put in lists of chunk_size documents, followed by None, or
+    by the exception which stopped the query. The queue is bounded, so
+    only a few chunks are read ahead of the ones which are taken out.
+    When stopped is set, the query is given up.
+    """
+    documents = find(filter_element, argument, parallel=False)
+    try:
+        while True:
+            chunk = list(islice(documents, chunk_size))
+            if not chunk:
+                break
+            if not put_unless_stopped(queue, chunk, stopped):
+                return
+        put_unless_stopped(queue, None, stopped)
+    except Exception, exp:
+        put_unless_stopped(queue, exp, stopped)
+    finally:
+        documents.close()
+
+
+def row_getter(columns):
+    """Return a function which gives the values of columns in a document as a tuple."""
+    if len(columns) == 1:
+        column = columns[0]
+        return lambda doc: (doc[column],)
+    return itemgetter(*columns)
+
+
+def projection_columns(columns):
+    """Return the database columns needed for some livestatus columns.
+
+    None means that a column is unknown and every column is needed.
+    """
+    needed = set(PROJECTION_BASE_COLUMNS)
+    for column in columns:
+        if column in LOGLINE_COLUMNS:
+            needed.add(column)
+        elif column in COLUMN_SOURCES:
+            needed.update(COLUMN_SOURCES[column])
+        else:
+            for prefix, sources in COLUMN_PREFIX_SOURCES:
+                if column.startswith(prefix):
+                    needed.update(sources)
+                    break
+            else:
+                return None
+    return [c for c in LOGLINE_COLUMNS if c in needed]
+
 
 class LiveStatusLogStoreError(Exception):
     pass
@@ -99,7 +240,7 @@ class LiveStatusLogStoreMongoDB(BaseModule):
         # mongodb://host1,host2,host3/?safe=true;w=2;wtimeoutMS=2000
         self.mongodb_uri = getattr(modconf, 'mongodb_uri', None)
         self.replica_set = getattr(modconf, 'replica_set', None)
-        if self.replica_set and not ReplicaSetConnection:
+        if self.replica_set and not MongoClient:
             logger.error('[LogStoreMongoDB] Can not initialize LogStoreMongoDB module with '
                          'replica_set because your pymongo lib is too old. '
                          'Please install it with a 2.x+ version from '
@@ -108,7 +249,20 @@ class LiveStatusLogStoreMongoDB(BaseModule):
         self.database = getattr(modconf, 'database', 'logs')
         self.collection = getattr(modconf, 'collection', 'logs')
         self.use_aggressive_sql = True
-        self.mongodb_fsync = to_bool(getattr(modconf, 'mongodb_fsync', "True"))
+        # All the database operations share a pool of pool_size connections.
+        # Timeouts are in seconds. Lines are written with the write concern
+        # write_concern (w) and journal (j), mongodb_fsync is only used when
+        # it is set.
+        self.pool = MongoPool(self.mongodb_uri, self.replica_set,
+                              pool_size=int(getattr(modconf, 'pool_size', '10')),
+                              connect_timeout=float(getattr(modconf, 'connect_timeout', '20')),
+                              socket_timeout=float(getattr(modconf, 'socket_timeout', '0')) or None,
+                              wait_queue_timeout=float(getattr(modconf, 'wait_queue_timeout', '0')) or None,
+                              server_selection_timeout=float(getattr(modconf, 'server_selection_timeout', '30')),
+                              w=getattr(modconf, 'write_concern', '1'),
+                              journal=to_bool(getattr(modconf, 'journal', '1')),
+                              fsync=to_bool(getattr(modconf, 'mongodb_fsync', '0')),
+                              wtimeout=float(getattr(modconf, 'write_timeout', '0')) or None)
         max_logs_age = getattr(modconf, 'max_logs_age', '365')
         maxmatch = re.match(r'^(\d+)([dwmy]*)$', max_logs_age)
         if maxmatch is None:
@@ -131,11 +285,171 @@ class LiveStatusLogStoreMongoDB(BaseModule):
         # This stack is used to create a minimal select-statement which
         # selects only by time >= and time <=
         self.mongo_time_filter_stack = LiveStatusMongoStack()
+        # Log lines can be buffered and written with one bulk insert as soon
+        # as insert_batch_size lines are waiting or the oldest waiting line
+        # is older than insert_batch_timeout seconds. With the default batch
+        # size of 1 every line is written immediately.
+        self.insert_batch_size = max(1, int(getattr(modconf, 'insert_batch_size', '1')))
+        self.insert_batch_timeout = float(getattr(modconf, 'insert_batch_timeout', '1'))
+        self.insert_buffer = []
+        self.insert_buffer_since = 0
+        # With async_writer the broker thread only queues the log lines
+        # and a separate thread writes them to the database.
+        self.async_writer = to_bool(getattr(modconf, 'async_writer', '0'))
+        self.writer_queue_size = int(getattr(modconf, 'writer_queue_size', '100000'))
+        self.writer_overflow = getattr(modconf, 'writer_overflow', OVERFLOW_BLOCK)
+        self.spool_dir = getattr(modconf, 'spool_dir', None)
+        if self.writer_overflow not in OVERFLOW_POLICIES:
+            logger.warning('[LogStoreMongoDB] Wrong value for writer_overflow. Must be one of %s and not %s' % (', '.join(OVERFLOW_POLICIES), self.writer_overflow))
+            self.writer_overflow = OVERFLOW_BLOCK
+        if self.writer_overflow == OVERFLOW_SPILL and not self.spool_dir:
+            logger.warning('[LogStoreMongoDB] writer_overflow %s needs a spool_dir, using %s' % (OVERFLOW_SPILL, OVERFLOW_BLOCK))
+            self.writer_overflow = OVERFLOW_BLOCK
+        # Log lines which could not be written are kept in a spool and sent
+        # when the database is back. With a spool_dir the spool is a set of
+        # files which survive a restart, otherwise it lives in memory.
+        # spool_max_size is in megabytes for a spool_dir, in lines otherwise.
+        if self.spool_dir:
+            self.spool = LogSpool(self.spool_dir,
+                                  segment_size=int(getattr(modconf, 'spool_segment_size', '4')) * 1024 * 1024,
+                                  max_size=int(getattr(modconf, 'spool_max_size', '512')) * 1024 * 1024)
+        else:
+            self.spool = MemorySpool(max_size=int(getattr(modconf, 'spool_max_size', '1000000')))
+        self.writer = None
+        # With stream_results get_live_data_log returns a generator, which
+        # reads the documents from the database in batches of batch_size
+        # while livestatus sends the rows, instead of a complete list.
+        self.stream_results = to_bool(getattr(modconf, 'stream_results', '0'))
+        self.batch_size = int(getattr(modconf, 'batch_size', '0'))
+        # With array_rows MongoDB sends every line as an array of the values
+        # of the requested columns, which is much faster to decode than a
+        # document with its field names. Needs MongoDB >= 3.2.
+        self.array_rows = to_bool(getattr(modconf, 'array_rows', '0'))
+        # On a replica set, queries for lines older than read_lag seconds
+        # read with history_read_preference, so they can go to secondaries,
+        # the others read from the primary. The time the queries took on
+        # each member is logged every latency_report_interval seconds.
+        self.history_read_preference = getattr(modconf, 'history_read_preference', 'primary')
+        if self.history_read_preference not in READ_PREFERENCES:
+            logger.warning('[LogStoreMongoDB] Wrong value for history_read_preference. Must be one of %s and not %s' % (', '.join(READ_PREFERENCES), self.history_read_preference))
+            self.history_read_preference = 'primary'
+        self.read_lag = float(getattr(modconf, 'read_lag', '60'))
+        self.history_db = None
+        self.node_latency = NodeLatency()
+        self.latency_report_interval = int(getattr(modconf, 'latency_report_interval', '0'))
+        self.next_latency_report = time.time() + self.latency_report_interval
+        # Queries over more than parallel_min_span seconds are split into
+        # parallel_slices time slices, which are read at the same time.
+        self.parallel_slices = int(getattr(modconf, 'parallel_slices', '1'))
+        self.parallel_min_span = int(getattr(modconf, 'parallel_min_span', '86400'))
+        self.slice_pool = None
+        # What the module does is counted in stats and is returned by
+        # get_stats(). Every stats_interval seconds a snapshot is written
+        # to stats_file and/or sent to statsd at statsd_host:statsd_port.
+        self.stats = Stats()
+        self.stats_interval = int(getattr(modconf, 'stats_interval', '60'))
+        self.next_stats_output = time.time() + self.stats_interval
+        self.stats_file = getattr(modconf, 'stats_file', None)
+        self.statsd = None
+        statsd_host = getattr(modconf, 'statsd_host', None)
+        if statsd_host:
+            self.statsd = StatsdSender(statsd_host, int(getattr(modconf, 'statsd_port', '8125')),
+                                       getattr(modconf, 'statsd_prefix', 'shinken.logstore_mongodb'))
+        self.stats.gauge('backlog', lambda: len(self.insert_buffer) + (self.writer and self.writer.qsize() or 0))
+        self.stats.gauge('spool.size', lambda: self.spool.size())
+        self.stats.gauge('writer.dropped', lambda: self.writer and self.writer.dropped or 0)
+        self.stats.gauge('writer.spilled', lambda: self.writer and self.writer.spilled or 0)
+        # Queries which take slow_query_threshold seconds or more are
+        # written to slow_query_log with their filters, the plan MongoDB
+        # chose (explain_slow_queries) and where the time was spent.
+        self.slow_queries = None
+        slow_query_threshold = float(getattr(modconf, 'slow_query_threshold', '0'))
+        if slow_query_threshold > 0:
+            slow_query_log = getattr(modconf, 'slow_query_log', '/var/log/shinken/logstore-mongodb-slow-queries.log')
+            try:
+                self.slow_queries = SlowQueryLog(slow_query_log, slow_query_threshold,
+                                                 int(getattr(modconf, 'slow_query_log_size', '10')) * 1024 * 1024,
+                                                 int(getattr(modconf, 'slow_query_log_backups', '5')),
+                                                 int(getattr(modconf, 'explain_interval', '600')))
+            except (IOError, OSError), exp:
+                logger.warning("[LogStoreMongoDB] Could not open the slow query log %s: %s" % (slow_query_log, exp))
+        self.explain_slow_queries = to_bool(getattr(modconf, 'explain_slow_queries', '1'))
+        self.compile_time = 0.0
+        self.query_compile_time = 0.0
+        self.filter_columns = []
+        # The Filter: lines of the query, for the slow query log
+        self.filter_lines = []
+        self.limit = None
+        # The indexes of the collection. With index_advisor the shapes of
+        # the queries are recorded and the ones without a matching index
+        # are logged every index_advisor_interval seconds.
+        # With lowercase_fields a lowercase copy of host_name,
+        # service_description and contact_name is stored with every line,
+        # so that =~, !=~ and ~~ ^prefix can be read from an index.
+        self.lowercase_fields = to_bool(getattr(modconf, 'lowercase_fields', '0'))
+        # With compact_schema the lines are stored with short field names,
+        # without empty strings and with type and state_type as numbers.
+        self.compact_schema = to_bool(getattr(modconf, 'compact_schema', '0'))
+        indexes = DEFAULT_INDEXES
+        if self.lowercase_fields:
+            indexes += ';' + LOWERCASE_INDEXES
+        self.indexes = parse_indexes(getattr(modconf, 'indexes', indexes))
+        # With text_search message and plugin_output get a text index and
+        # filters which look for whole words (\bword\b) in them use it with $text.
+        self.text_search = to_bool(getattr(modconf, 'text_search', '0'))
+        if self.text_search:
+            self.indexes.append(('text_idx', TEXT_INDEX))
+        if self.compact_schema:
+            # The indexes are configured with the names of the attributes
+            self.indexes = [(name, [(stored_field(field), direction) for field, direction in keys])
+                            for name, keys in self.indexes]
+        self.query_shapes = None
+        if to_bool(getattr(modconf, 'index_advisor', '0')):
+            self.query_shapes = QueryShapeStats([keys for name, keys in self.indexes])
+        self.index_advisor_interval = int(getattr(modconf, 'index_advisor_interval', '3600'))
+        self.next_index_report = time.time() + self.index_advisor_interval
+        # Log lines can be stored in one collection per day, week or month.
+        # Then a query only reads the collections of its time range and
+        # old lines are removed by dropping whole collections.
+        self.partitioning = getattr(modconf, 'partitioning', 'none')
+        if self.partitioning == 'none':
+            self.partitioning = None
+        elif self.partitioning not in PERIODS:
+            logger.warning('[LogStoreMongoDB] Wrong value for partitioning. Must be none or one of %s and not %s' % (', '.join(PERIODS), self.partitioning))
+            self.partitioning = None
+        self.buckets = set()
+        # Results of queries are cached in up to query_cache_size megabytes.
+        # Results which lines were added to are extended with them, results
+        # of closed time ranges are served from the cache as they are.
+        self.query_cache = None
+        query_cache_size = float(getattr(modconf, 'query_cache_size', '0'))
+        if query_cache_size > 0:
+            self.query_cache = QueryCache(int(query_cache_size * 1024 * 1024))
+        # The common kinds of log lines are parsed without Logline
+        self.fast_parser = to_bool(getattr(modconf, 'fast_parser', '0'))
+        # The lines of the last hot_tier_hours hours are also kept in memory,
+        # queries for lines of this time are answered without the database.
+        self.hot_tier = None
+        hot_tier_hours = float(getattr(modconf, 'hot_tier_hours', '0'))
+        if hot_tier_hours > 0:
+            derived = {}
+            if self.lowercase_fields:
+                for attribute in LOWERCASE_ATTRIBUTES:
+                    derived[lowercase_field(attribute)] = (attribute, lowercase)
+            if self.compact_schema:
+                # The filters are on the stored fields
+                stored = {}
+                for attribute in LOGLINE_COLUMNS:
+                    stored[stored_field(attribute)] = (attribute, lambda value, attribute=attribute: stored_value(attribute, value))
+                for field, (attribute, function) in derived.items():
+                    stored[stored_field(field)] = (attribute, lambda value, field=field, function=function: stored_value(field, function(value)))
+                derived = stored
+            self.hot_tier = HotTier(int(hot_tier_hours * 3600), derived=derived)
         self.is_connected = DISCONNECTED
-        self.backlog = []
         # Now sleep one second, so that won't get lineno collisions with the last second
         time.sleep(1)
         self.lineno = 0
+        self.lineno_time = 0
 
     def load(self, app):
         self.app = app
@@ -143,25 +457,55 @@ class LiveStatusLogStoreMongoDB(BaseModule):
     def init(self):
         pass
 
+    def connect(self):
+        """Return the client of the connection pool."""
+        return self.pool.connect()
+
+    def ensure_indexes(self, collection):
+        for name, keys in self.indexes:
+            if [direction for field, direction in keys if direction == 'text']:
+                # No stemming and no stop words, words are found as they are
+                create_index(collection, keys, name=name, default_language='none')
+            elif name:
+                create_index(collection, keys, name=name)
+            else:
+                create_index(collection, keys)
+
     def open(self):
         try:
-            if self.replica_set:
-                self.conn = pymongo.ReplicaSetConnection(self.mongodb_uri, replicaSet=self.replica_set, fsync=self.mongodb_fsync)
-            else:
-                # Old versions of pymongo do not known about fsync
-                if ReplicaSetConnection:
-                    self.conn = pymongo.Connection(self.mongodb_uri, fsync=self.mongodb_fsync)
-                else:
-                    self.conn = pymongo.Connection(self.mongodb_uri)
+            self.conn = self.connect()
             self.db = self.conn[self.database]
-            self.db[self.collection].ensure_index([('host_name', pymongo.ASCENDING), ('time', pymongo.ASCENDING), ('lineno', pymongo.ASCENDING)], name='logs_idx')
-            self.db[self.collection].ensure_index([('time', pymongo.ASCENDING), ('lineno', pymongo.ASCENDING)], name='time_1_lineno_1')
-            if self.replica_set:
-                pass
-                # This might be a future option prefer_secondary
-                #self.db.read_preference = ReadPreference.SECONDARY
+            if self.partitioning:
+                # The buckets of a previous run get the indexes too, which
+                # may have changed since, like with text_search or
+                # lowercase_fields. Existing indexes are left as they are.
+                self.buckets = set()
+                for name in buckets_in_range(self.db.collection_names(), self.collection, self.partitioning):
+                    self.ensure_bucket(self.db, name)
+                collection = self.ensure_bucket(self.db, bucket_name(self.collection, time.time(), self.partitioning))
+            else:
+                collection = self.db[self.collection]
+                self.ensure_indexes(collection)
+            if self.query_shapes:
+                # indexes which were created by hand count as well
+                self.query_shapes.set_indexes([index['key'] for index in collection.index_information().values()])
+            self.history_db = self.db
+            if self.history_read_preference != 'primary':
+                self.history_db = get_database(self.conn, self.database, read_preference(self.history_read_preference))
             self.is_connected = CONNECTED
             self.next_log_db_rotate = time.time()
+            if self.parallel_slices > 1 and self.slice_pool is None:
+                self.slice_pool = ThreadPool(self.parallel_slices)
+            if self.async_writer and self.writer is None:
+                # The writer thread uses the same pool
+                self.writer = LogWriter(lambda: self.connect()[self.database], self.write_lines,
+                                        self.writer_queue_size, self.writer_overflow,
+                                        self.insert_batch_size, self.insert_batch_timeout, self.spool,
+                                        self.stats)
+                self.writer.start()
+            elif not self.spool.empty():
+                # Lines from an outage or from the previous run
+                self.drain_spool()
         except AutoReconnect as err:
             # now what, ha?
             logger.error("[LogStoreMongoDB] LiveStatusLogStoreMongoDB.AutoReconnect %s" % err)
@@ -175,20 +519,43 @@ class LiveStatusLogStoreMongoDB(BaseModule):
             raise LiveStatusLogStoreError(err)
 
     def close(self):
-        self.conn.disconnect()
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        self.flush()
+        if self.slice_pool:
+            self.slice_pool.terminate()
+            self.slice_pool = None
+        self.pool.close()
+        if self.slow_queries:
+            self.slow_queries.close()
 
     def commit(self):
-        pass
+        self.flush()
 
     def commit_and_rotate_log_db(self):
         """For a MongoDB there is no rotate, but we will delete old contents."""
         now = time.time()
+        if self.insert_buffer and now - self.insert_buffer_since >= self.insert_batch_timeout:
+            self.flush()
         if self.next_log_db_rotate <= now:
             today = datetime.date.today()
             today0000 = datetime.datetime(today.year, today.month, today.day, 0, 0, 0)
             today0005 = datetime.datetime(today.year, today.month, today.day, 0, 5, 0)
             oldest = today0000 - datetime.timedelta(days=self.max_logs_age)
-            self.db[self.collection].remove({u'time': {'$lt': time.mktime(oldest.timetuple())}})
+            if self.partitioning:
+                names = self.db.collection_names()
+                # Buckets may have been created by another broker
+                self.buckets.update(buckets_in_range(names, self.collection, self.partitioning))
+                # Buckets are dropped when all their lines are too old
+                for name in buckets_before(names, self.collection, self.partitioning, time.mktime(oldest.timetuple())):
+                    logger.info("[LogStoreMongoDB] Dropping the expired collection %s" % name)
+                    self.db.drop_collection(name)
+                    self.buckets.discard(name)
+            else:
+                delete_many(self.db[self.collection], {u'time': {'$lt': time.mktime(oldest.timetuple())}})
+            if self.query_cache:
+                self.query_cache.clear()
 
             if now < time.mktime(today0005.timetuple()):
                 nextrotation = today0005
@@ -199,201 +566,710 @@ class LiveStatusLogStoreMongoDB(BaseModule):
             self.next_log_db_rotate = time.mktime(nextrotation.timetuple())
             logger.info("[LogStoreMongoDB] Next log rotation at %s " % time.asctime(time.localtime(self.next_log_db_rotate)))
 
+        if self.hot_tier:
+            self.hot_tier.expire(now)
+
+        if (self.stats_file or self.statsd) and self.next_stats_output <= now:
+            self.next_stats_output = now + self.stats_interval
+            self.output_stats()
+
+        if self.latency_report_interval and self.next_latency_report <= now:
+            self.next_latency_report = now + self.latency_report_interval
+            for entry in self.node_latency.report(reset=True):
+                logger.info("[LogStoreMongoDB] Queries on %s: %d, avg %.3fs, max %.3fs" % (
+                            entry['node'], entry['count'], entry['avg'], entry['max']))
+
+        if self.query_shapes and self.next_index_report <= now:
+            self.next_index_report = now + self.index_advisor_interval
+            self.log_query_shape_report()
+
+
+    def get_stats(self):
+        """Return the counters, rates, gauges and histograms of the module.
+
+        The rates are per second and the histograms hold the values since
+        the last time they were written to stats_file or statsd.
+        """
+        snapshot = self.stats.snapshot()
+        snapshot['pool'] = self.pool.stats()
+        if self.query_cache:
+            snapshot['query_cache'] = {'hits': self.query_cache.hits, 'misses': self.query_cache.misses, 'size': self.query_cache.size}
+        return snapshot
+
+    def output_stats(self):
+        snapshot = self.stats.snapshot(mark=True)
+        try:
+            if self.stats_file:
+                write_stats_file(self.stats_file, snapshot)
+            if self.statsd:
+                self.statsd.send(snapshot)
+        except (IOError, OSError, socket.error), exp:
+            logger.warning("[LogStoreMongoDB] Could not write the stats: %s" % exp)
+
+    def get_pool_stats(self):
+        """Return how often connections were taken from the pool and how long that had to wait."""
+        return self.pool.stats()
+
+    def get_query_shape_report(self):
+        """Return the statistics of the query shapes, the most expensive first."""
+        if not self.query_shapes:
+            return []
+        return self.query_shapes.report()
+
+
+    def log_query_shape_report(self):
+        for entry in self.get_query_shape_report():
+            if not entry['covered']:
+                logger.info("[LogStoreMongoDB] Query shape %s without index: %d queries, avg %.3fs, max %.3fs, consider an index on %s" % (
+                            entry['shape'], entry['count'], entry['avg'], entry['max'], entry['suggestion']))
+
 
     def manage_log_brok(self, b):
         data = b.data
         line = data['log']
-        if re.match("^\[[0-9]*\] [A-Z][a-z]*.:", line):
-            # Match log which NOT have to be stored
-            # print "Unexpected in manage_log_brok", line
-            return
-        logline = Logline(line=line)
-        values = logline.as_dict()
-        if logline.logclass != LOGCLASS_INVALID:
-            try:
-                self.db[self.collection].insert(values)
-                self.is_connected = CONNECTED
-                # If we have a backlog from an outage, we flush these lines
-                # First we make a copy, so we can delete elements from
-                # the original self.backlog
-                backloglines = [bl for bl in self.backlog]
-                for backlogline in backloglines:
-                    try:
-                        self.db[self.collection].insert(backlogline)
-                        self.backlog.remove(backlogline)
-                    except AutoReconnect, exp:
-                        self.is_connected = SWITCHING
-                    except Exception, exp:
-                        logger.error("[LogStoreMongoDB] Got an exception inserting the backlog" % str(exp))
-            except AutoReconnect, exp:
-                if self.is_connected != SWITCHING:
-                    self.is_connected = SWITCHING
-                    time.sleep(5)
-                    # Under normal circumstances after these 5 seconds
-                    # we should have a new primary node
-                else:
-                    # Not yet? Wait, but try harder.
-                    time.sleep(0.1)
-                # At this point we must save the logline for a later attempt
-                # After 5 seconds we either have a successful write
-                # or another exception which means, we are disconnected
-                self.backlog.append(values)
-            except Exception, exp:
-                self.is_connected = DISCONNECTED
-                logger.error("[LogStoreMongoDB] Databased error occurred: %s" % exp)
-            # FIXME need access to this #self.livestatus.count_event('log_message')
+        values = None
+        if self.fast_parser:
+            # The lines it knows never match SKIPPED_LINE
+            values = parse_line(line)
+        if values is None:
+            if SKIPPED_LINE.match(line):
+                # Match log which NOT have to be stored
+                # print "Unexpected in manage_log_brok", line
+                self.stats.incr('ingest.skipped')
+                return
+            logline = Logline(line=line)
+            if logline.logclass == LOGCLASS_INVALID:
+                logger.debug("[LogStoreMongoDB] This line is invalid: %s" % line)
+                self.stats.incr('ingest.invalid')
+                return
+            values = logline.as_dict()
+        # (time, lineno) is the sort key of every query, so lines
+        # which were logged within the same second are numbered in
+        # the order they arrived. This keeps them in order even if
+        # a bulk insert stores them differently. A line with an older
+        # time continues the numbering of the current second instead of
+        # starting it again.
+        if values['time'] > self.lineno_time:
+            self.lineno_time = values['time']
+            self.lineno = 0
+        self.lineno += 1
+        values['lineno'] = self.lineno
+        if self.lowercase_fields:
+            for attribute in LOWERCASE_ATTRIBUTES:
+                if isinstance(values.get(attribute), basestring):
+                    values[lowercase_field(attribute)] = lowercase(values[attribute])
+        self.stats.incr('ingest.lines')
+        if self.hot_tier:
+            self.hot_tier.add(values)
+        if self.writer:
+            self.writer.put(values)
         else:
-            logger.debug("[LogStoreMongoDB] This line is invalid: %s" % line)
+            if not self.insert_buffer:
+                self.insert_buffer_since = time.time()
+            self.insert_buffer.append(values)
+            if len(self.insert_buffer) >= self.insert_batch_size or \
+                    time.time() - self.insert_buffer_since >= self.insert_batch_timeout:
+                self.flush()
+        # FIXME need access to this #self.livestatus.count_event('log_message')
+
+
+    def flush(self):
+        """Write the buffered log lines to the database."""
+        if not self.insert_buffer:
+            return
+        lines = self.insert_buffer
+        self.insert_buffer = []
+        self.insert_lines(lines)
+
+
+    def insert_lines(self, lines):
+        """Write a list of log lines with one unordered bulk insert."""
+        try:
+            self.write_lines(self.db, lines)
+            self.is_connected = CONNECTED
+            # If we have spooled lines from an outage, we flush these lines,
+            # one segment with every write, so that the broker is not held
+            # up until all of them are written
+            if not self.spool.empty():
+                self.drain_spool(max_segments=1)
+        except AutoReconnect, exp:
+            self.stats.incr('reconnects')
+            if self.is_connected != SWITCHING:
+                self.is_connected = SWITCHING
+                time.sleep(5)
+                # Under normal circumstances after these 5 seconds
+                # we should have a new primary node
+            else:
+                # Not yet? Wait, but try harder.
+                time.sleep(0.1)
+            # At this point we must save the loglines for a later attempt
+            # After 5 seconds we either have a successful write
+            # or another exception which means, we are disconnected
+            self.spool.append(lines)
+        except Exception, exp:
+            self.is_connected = DISCONNECTED
+            logger.error("[LogStoreMongoDB] Databased error occurred: %s" % exp)
+
+
+    def write_lines(self, db, lines):
+        """Insert log lines into their collection with unordered bulk inserts."""
+        start = time.time()
+        # The _id is given before the first insert, so that the lines of an
+        # interrupted insert, which are spooled and written again, are not
+        # stored twice
+        for line in lines:
+            if '_id' not in line:
+                line['_id'] = ObjectId()
+        documents = lines
+        if self.compact_schema:
+            documents = [compact_document(line) for line in lines]
+        self.pool.checkout()
+        try:
+            if not self.partitioning:
+                insert_many(db[self.collection], documents)
+            else:
+                for name, bucket_lines in split_by_bucket(documents, self.collection, self.partitioning):
+                    insert_many(self.ensure_bucket(db, name), bucket_lines)
+        finally:
+            self.pool.checkin()
+        self.stats.timing('insert.time', time.time() - start)
+        self.stats.incr('insert.lines', len(lines))
+        self.stats.incr('insert.batches')
+        if self.query_cache:
+            self.query_cache.written(lines)
+
+
+    def ensure_bucket(self, db, name):
+        """Return the collection of a bucket, it is indexed when it is new."""
+        if name not in self.buckets:
+            self.ensure_indexes(db[name])
+            self.buckets.add(name)
+        return db[name]
+
+
+    def query_collections(self, filter_element):
+        """Return the names of the collections a filter has to read, the oldest first."""
+        if not self.partitioning:
+            return [self.collection]
+        low, high = time_bounds(filter_element)
+        return buckets_in_range(list(self.buckets), self.collection, self.partitioning, low, high)
+
+
+    def drain_spool(self, max_segments=None):
+        """Write the spooled log lines with bulk inserts, oldest first.
+
+        At most max_segments segments of the spool are written, all of
+        them if it is None.
+        """
+        try:
+            self.spool.drain(lambda lines: self.write_lines(self.db, lines), max_segments)
+        except AutoReconnect, exp:
+            self.is_connected = SWITCHING
+        except Exception, exp:
+            logger.error("[LogStoreMongoDB] Got an exception inserting the spooled lines: %s" % exp)
 
 
     def add_filter(self, operator, attribute, reference):
+        start = time.time()
+        self.filter_columns.append(attribute)
+        self.filter_lines.append('Filter: %s %s %s' % (attribute, operator, reference))
         if attribute == 'time':
             self.mongo_time_filter_stack.put_stack(self.make_mongo_filter(operator, attribute, reference))
         self.mongo_filter_stack.put_stack(self.make_mongo_filter(operator, attribute, reference))
+        self.compile_time += time.time() - start
 
 
     def add_filter_and(self, andnum):
+        start = time.time()
         self.mongo_filter_stack.and_elements(andnum)
+        self.filter_lines.append('And: %d' % andnum)
+        self.compile_time += time.time() - start
 
 
     def add_filter_or(self, ornum):
+        start = time.time()
         self.mongo_filter_stack.or_elements(ornum)
+        self.filter_lines.append('Or: %d' % ornum)
+        self.compile_time += time.time() - start
 
 
     def add_filter_not(self):
+        start = time.time()
         self.mongo_filter_stack.not_elements()
+        self.filter_lines.append('Negate:')
+        self.compile_time += time.time() - start
+
 
+    def add_limit(self, limit):
+        """Return at most limit lines from the next query."""
+        self.limit = int(limit)
 
-    def get_live_data_log(self):
-        """Like get_live_data, but for log objects"""
-        # finalize the filter stacks
+
+    def get_filter(self):
+        """Finalize the filter stacks and return the filter for the query"""
+        start = time.time()
         self.mongo_time_filter_stack.and_elements(self.mongo_time_filter_stack.qsize())
         self.mongo_filter_stack.and_elements(self.mongo_filter_stack.qsize())
+        # Both stacks are emptied, so that nothing is left for the next query
+        time_filter = self.mongo_time_filter_stack.get_stack()
+        full_filter = self.mongo_filter_stack.get_stack()
         if self.use_aggressive_sql:
             # Be aggressive, get preselected data from sqlite and do less
             # filtering in python. But: only a subset of Filter:-attributes
             # can be mapped to columns in the logs-table, for the others
             # we must use "always-true"-clauses. This can result in
             # funny and potentially ineffective sql-statements
-            mongo_filter_func = self.mongo_filter_stack.get_stack()
+            filter_element = full_filter
+            if self.text_search:
+                filter_element = add_text_search(filter_element)
+            if self.compact_schema:
+                filter_element = compact_filter(filter_element)
         else:
             # Be conservative, get everything from the database between
             # two dates and apply the Filter:-clauses in python
-            mongo_filter_func = self.mongo_time_filter_stack.get_stack()
-        dbresult = []
-        mongo_filter = mongo_filter_func()
-        logger.debug("[Logstore MongoDB] Mongo filter is %s" % str(mongo_filter))
+            filter_element = Superset(time_filter)
+        self.query_compile_time = self.compile_time + time.time() - start
+        self.stats.timing('query.compile_time', self.query_compile_time)
+        self.compile_time = 0.0
+        return filter_element
+
+
+    def restore_filter(self, filter_element):
+        """Put a filter returned by get_filter back for get_live_data_log"""
+        if self.use_aggressive_sql:
+            self.mongo_filter_stack.put_stack(filter_element)
+        else:
+            self.mongo_time_filter_stack.put_stack(dict(filter_element))
+
+
+    def get_live_data_log(self, columns=None, filtercolumns=None, raw=False):
+        """Like get_live_data, but for log objects
+
+        If livestatus tells which columns were requested, only these, the
+        columns of the filters and the ones needed to sort the lines are
+        read from the database, and the Loglines have only these columns.
+
+        With raw, no Loglines are made. The result is the list of database
+        columns which were read and the rows as tuples (or lists, with
+        array_rows) of their values.
+        """
+        # lines which are still buffered must be visible to the query
+        self.flush()
+        filter_element = self.get_filter()
+        # A limit is only correct if livestatus won't throw away lines
+        limit = None
+        if not isinstance(filter_element, Superset):
+            limit = self.limit
+        self.limit = None
         # We can apply the filterstack here as well. we have columns and filtercolumns.
         # the only additional step is to enrich log lines with host/service-attributes
         # A timerange can be useful for a faster preselection of lines
-
-        filter_element = eval('{ ' + mongo_filter + ' }')
         logger.debug("[LogstoreMongoDB] Mongo filter is %s" % str(filter_element))
-        columns = ['logobject', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'host_name', 'lineno', 'message', 'plugin_output', 'service_description', 'state', 'state_type', 'time', 'type']
+        projection = None
+        if columns:
+            columns = projection_columns(list(columns) + list(filtercolumns or []) + self.filter_columns)
+        self.filter_columns = []
+        filter_lines, self.filter_lines = self.filter_lines, []
+        if columns:
+            if self.compact_schema:
+                projection = dict((stored_field(c), True) for c in columns)
+            else:
+                projection = dict((c, True) for c in columns)
+            projection['_id'] = False
+        else:
+            columns = LOGLINE_COLUMNS
+        # All the Loglines share one description of their columns
+        description = [(c,) for c in columns]
+        if self.hot_tier:
+            low, high = time_bounds(filter_element)
+            rows = self.hot_tier.find(filter_element, columns, low, high, limit)
+            if rows is not None:
+                self.stats.incr('query.hot_tier')
+                self.stats.observe('query.documents', len(rows))
+                if raw:
+                    return columns, rows
+                return [Logline(description, row) for row in rows]
         if not self.is_connected == CONNECTED:
             logger.warning("[LogStoreMongoDB] sorry, not connected")
-        else:
-            dbresult = [Logline([(c,) for c in columns], [x[col] for col in columns]) for x in self.db[self.collection].find(filter_element).sort([(u'time', pymongo.ASCENDING), (u'lineno', pymongo.ASCENDING)])]
-        return dbresult
-
-
-    def make_mongo_filter(self, operator, attribute, reference):
-        # The filters are text fragments which are put together to form a sql where-condition finally.
-        # Add parameter Class (Host, Service), lookup datatype (default string), convert reference
-        # which attributes are suitable for a sql statement
-        good_attributes = ['time', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'message', 'host_name', 'plugin_output', 'service_description', 'state', 'state_type', 'type']
-        good_operators = ['=', '!=']
-        #  put strings in '' for the query
-        string_attributes = ['command_name', 'comment', 'contact_name', 'host_name', 'message', 'plugin_output', 'service_description', 'state_type', 'type']
-        if attribute in string_attributes:
-            reference = "'%s'" % reference
-
-        # We should change the "class" query into the internal "logclass" attribute
-        if attribute == 'class':
-            attribute = 'logclass'
-
-        def eq_filter():
-            if reference == '':
-                return '\'%s\' : \'\'' % (attribute,)
+            if raw:
+                return columns, []
+            return []
+        start = time.time()
+        # The query cache needs whole documents, it is not used for
+        # streamed results
+        array_documents = self.array_rows and (self.stream_results or not self.query_cache)
+        if array_documents:
+            if self.compact_schema:
+                getter = stored_array_row_getter(columns)
             else:
-                return '\'%s\' : %s' % (attribute, reference)
-
-        def match_filter():
-            return '\'%s\' : { \'$regex\' : %s }' % (attribute, reference)
-
-        def eq_nocase_filter():
-            if reference == '':
-                return '\'%s\' : \'\'' % (attribute,)
+                getter = itemgetter('r')
+        elif self.compact_schema:
+            getter = stored_row_getter(columns)
+        else:
+            getter = row_getter(columns)
+        if self.stream_results:
+            if array_documents:
+                documents = self.find_array_documents(filter_element, columns, limit)
             else:
-                return '\'%s\' : { \'$regex\' : %s, \'$options\' : \'i\' }' % (attribute, '^' + reference + '$')
-
-        def match_nocase_filter():
-            return '\'%s\' : { \'$regex\' : %s, \'$options\' : \'i\' }' % (attribute, reference)
+                documents = self.find_documents(filter_element, projection, limit)
+            rows = self.stream_rows(imap(getter, documents), documents, filter_element, start,
+                                    (filter_lines, projection, limit, self.query_compile_time))
+            if raw:
+                return columns, rows
+            return (Logline(description, row) for row in rows)
+        # The connections are taken by the cursors, also by the ones of
+        # the threads which read the time slices of a parallel query
+        if self.query_cache:
+            documents, cached = self.find_cached_documents(filter_element, projection, limit)
+        elif array_documents:
+            documents, cached = self.find_array_documents(filter_element, columns, limit), False
+        else:
+            documents, cached = self.find_documents(filter_element, projection, limit), False
+        # The round trip to the database is the time until the first
+        # batch of documents has arrived
+        documents = iter(documents)
+        for document in documents:
+            documents = chain([document], documents)
+            break
+        database_time = time.time() - start
+        if raw:
+            dbresult = columns, map(getter, documents)
+            rows = dbresult[1]
+        else:
+            dbresult = rows = [Logline(description, row) for row in imap(getter, documents)]
+        total_time = time.time() - start
+        if cached:
+            self.stats.incr('query.cached')
+        else:
+            self.stats.timing('query.database_time', database_time)
+        self.stats.timing('query.rows_time', total_time - database_time)
+        self.stats.timing('query.total_time', total_time)
+        self.stats.observe('query.documents', len(rows))
+        if self.query_shapes and not cached:
+            self.query_shapes.record(filter_element, total_time)
+        if self.slow_queries and self.slow_queries.is_slow(total_time):
+            times = {'total': total_time, 'compile': self.query_compile_time,
+                     'database': None if cached else database_time, 'rows': total_time - database_time}
+            self.log_slow_query(times, len(rows), filter_lines, filter_element, projection, limit, cached)
+        return dbresult
 
-        def lt_filter():
-            return '\'%s\' : { \'$lt\' : %s }' % (attribute, reference)
 
-        def gt_filter():
-            return '\'%s\' : { \'$gt\' : %s }' % (attribute, reference)
+    def find_documents(self, filter_element, projection=None, limit=None, parallel=True):
+        """Return an iterator over the matching documents in (time, lineno) order."""
+        slices = parallel and self.slice_filters(filter_element, limit)
+        if slices:
+            return self.find_in_parallel(self.find_documents, slices, projection)
+        # With partitioning the collections don't overlap in time, so
+        # reading them oldest first keeps the lines in order
+        db = self.read_db(filter_element)
+        start = time.time()
+        cursors = []
+        for name in self.query_collections(filter_element):
+            cursor = db[name].find(filter_element, projection).sort([(u'time', pymongo.ASCENDING), (u'lineno', pymongo.ASCENDING)])
+            if self.batch_size:
+                cursor.batch_size(self.batch_size)
+            if limit:
+                cursor.limit(limit)
+            cursors.append(cursor)
+        return chain_cursors(cursors, self.pool, self.batch_size or STREAM_BATCH_SIZE, limit,
+                             lambda: self.record_latency(cursors, start))
+
+
+    def find_array_documents(self, filter_element, columns, limit=None, parallel=True):
+        """Like find_documents, but the documents are {'r': [values of columns]}."""
+        slices = parallel and self.slice_filters(filter_element, limit)
+        if slices:
+            return self.find_in_parallel(self.find_array_documents, slices, columns)
+        pipeline = [{'$match': filter_element}, {'$sort': SON([(u'time', pymongo.ASCENDING), (u'lineno', pymongo.ASCENDING)])}]
+        if limit:
+            pipeline.append({'$limit': limit})
+        if self.compact_schema:
+            columns = [stored_field(c) for c in columns]
+        pipeline.append({'$project': {'_id': False, 'r': ['$' + c for c in columns]}})
+        cursor_options = {}
+        if self.batch_size:
+            cursor_options['batchSize'] = self.batch_size
+        db = self.read_db(filter_element)
+        start = time.time()
+        cursors = []
+        # aggregate() sends the query and reads the first batch at once
+        self.pool.checkout()
+        try:
+            for name in self.query_collections(filter_element):
+                cursors.append(db[name].aggregate(pipeline, cursor=cursor_options))
+        finally:
+            self.pool.checkin()
+        return chain_cursors(cursors, self.pool, self.batch_size or STREAM_BATCH_SIZE, limit,
+                             lambda: self.record_latency(cursors, start))
 
-        def le_filter():
-            return '\'%s\' : { \'$lte\' : %s }' % (attribute, reference)
 
-        def ge_filter():
-            return '\'%s\' : { \'$gte\' : %s }' % (attribute, reference)
+    def slice_filters(self, filter_element, limit=None):
+        """Return the filters of the time slices of a query, None if it is not split.
 
-        def ne_filter():
-            if reference == '':
-                return '\'%s\' : { \'$ne\' : '' }' % (attribute,)
-            else:
-                return '\'%s\' : { \'$ne\' : %s }' % (attribute, reference)
+        A query with a limit is not split: MongoDB stops reading the
+        sorted lines at the limit, the slices would all be read in full.
+        """
+        if not self.slice_pool or limit:
+            return None
+        low, high = time_bounds(filter_element)
+        if high is None:
+            high = time.time()
+        if low is None or high - low < self.parallel_min_span:
+            return None
+        return [and_filters([filter_element, condition])
+                for condition in time_slices(low, high, self.parallel_slices)]
+
+
+    def find_in_parallel(self, find, slices, argument):
+        """Read the slices with find at the same time, yield their documents in order.
+
+        The slices don't overlap in time, so their results only have to be
+        put one after the other. Each slice is read ahead by at most
+        SLICE_PREFETCH chunks of batch_size documents, so the memory stays
+        bounded while the rows of the first slice are streamed.
+        """
+        chunk_size = self.batch_size or STREAM_BATCH_SIZE
+        stopped = threading.Event()
+        queues = [Queue.Queue(SLICE_PREFETCH) for slice_filter in slices]
+        for slice_filter, queue in zip(slices, queues):
+            self.slice_pool.apply_async(fetch_slice, (find, slice_filter, argument, queue, stopped, chunk_size))
+        try:
+            for queue in queues:
+                while True:
+                    chunk = queue.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    for doc in chunk:
+                        yield doc
+        finally:
+            # the slices which are still read give up
+            stopped.set()
+
+
+    def read_db(self, filter_element):
+        """Return the database a query reads from.
+
+        Lines which are older than read_lag seconds are on the secondaries
+        too, only queries for newer ones must go to the primary.
+        """
+        if self.history_db is None or self.history_db is self.db:
+            return self.db
+        high = time_bounds(filter_element)[1]
+        if high is not None and high < time.time() - self.read_lag:
+            return self.history_db
+        return self.db
+
+
+    def record_latency(self, cursors, start):
+        """Add the time since start to the members the cursors read from."""
+        elapsed = time.time() - start
+        for address in set([cursor_address(cursor) for cursor in cursors]):
+            if address:
+                self.node_latency.record(address, elapsed)
+
+
+    def find_cached_documents(self, filter_element, projection=None, limit=None):
+        """Like find_documents, but use the query cache.
+
+        Returns the list of documents and whether they came from the
+        cache without a database query.
+        """
+        columns = projection and sorted(projection)
+        if not limit:
+            # Polling clients ask for a window which ends now and moves on
+            # with every query. The lines since its start are cached once
+            # and later queries only read the lines which are new.
+            base, window = split_window(filter_element)
+            lows = [reference for name, reference in window if name in ('$gt', '$gte')]
+            highs = [reference for name, reference in window if name in ('$lt', '$lte')]
+            if lows and (not highs or min(highs) >= time.time() - TAIL_WINDOW_SLACK):
+                return self.find_tail_documents(base, window, max(lows), projection, columns)
+        key = self.query_cache.key(filter_element, columns, limit)
+        generation = self.query_cache.generation
+        entry = self.query_cache.get(key)
+        if entry is None:
+            documents = list(self.find_documents(filter_element, projection, limit))
+            low, high = time_bounds(filter_element)
+            # A limited result can't be extended
+            self.query_cache.put(key, documents, low, high, generation, extendable=not limit)
+            return documents, False
+        if not entry.stale:
+            return entry.documents, True
+        # Only fetch the lines which were written after the cached ones
+        new_documents = list(self.find_documents(and_filters([filter_element, after_filter(entry.watermark)]), projection))
+        documents = entry.documents + new_documents
+        self.query_cache.extend(key, entry, new_documents, generation)
+        return documents, False
+
+
+    def find_tail_documents(self, filter_element, window, low, projection, columns):
+        """Return the documents in a time window which starts at low.
+
+        The cache keeps all the lines since low which match filter_element,
+        the time conditions of the window are applied to them here.
+        """
+        key = self.query_cache.tail_key(filter_element, columns)
+        generation = self.query_cache.generation
+        entry = self.query_cache.get(key)
+        if entry is None or entry.low > low:
+            documents = list(self.find_documents(and_filters([filter_element, {'time': {'$gte': low}}]), projection))
+            self.query_cache.put(key, documents, low, None, generation)
+            cached = False
+        elif entry.stale:
+            since = {'time': {'$gte': entry.low}}
+            new_documents = list(self.find_documents(and_filters([filter_element, since, after_filter(entry.watermark)]), projection))
+            documents = entry.documents + new_documents
+            self.query_cache.extend(key, entry, new_documents, generation)
+            self.query_cache.trim(key, entry, low)
+            cached = False
+        else:
+            documents = entry.documents
+            self.query_cache.trim(key, entry, low)
+            cached = True
+        return [doc for doc in documents if in_window(window, doc['time'])], cached
+
+
+    def get_live_data_log_stats(self, stats, group_by=None):
+        """Compute Stats: of the log table with an aggregation in the database
+
+        stats is a list of (function, argument) tuples:
+        ('count', None) -- the number of lines
+        ('count', (attribute, operator, reference)) -- the number of
+        lines for which the condition is true, like Stats: state = 2
+        ('min'|'max'|'sum'|'avg', attribute) -- of a numeric attribute
+
+        group_by is a list of attributes, one result row is returned for each
+        of their combinations. A row contains the values of the group_by
+        attributes followed by the values of the stats. None is returned
+        if the query can't be done by the database, then the filter is left
+        for get_live_data_log.
+        """
+        self.flush()
+        filter_element = self.get_filter()
+        group_by = list(group_by or [])
+        if self.compact_schema:
+            group, group_attributes = stats_group(stats, group_by, LOGLINE_COLUMNS, compact_operand, compact_expression)
+        else:
+            group, group_attributes = stats_group(stats, group_by, LOGLINE_COLUMNS)
+        if group is None or isinstance(filter_element, Superset) or not self.is_connected == CONNECTED:
+            self.restore_filter(filter_element)
+            return None
+        self.filter_columns = []
+        self.filter_lines = []
+        self.limit = None
+        pipeline = [{'$match': filter_element}, {'$group': group}]
+        logger.debug("[LogstoreMongoDB] Aggregation is %s" % str(pipeline))
+        merged = {}
+        start = time.time()
+        for result in self.aggregate_collections(filter_element, pipeline):
+            for doc in result:
+                key = tuple([doc['_id']['g%d' % num] for num in range(len(group_by))])
+                if self.compact_schema:
+                    key = tuple([expand_value(attribute, value) for attribute, value in zip(group_attributes, key)])
+                values = [doc['s%d' % num] for num in range(len(stats))]
+                if key not in merged:
+                    merged[key] = (doc['n'], values)
+                    continue
+                count, merged_values = merged[key]
+                for num, (function, argument) in enumerate(stats):
+                    if function == 'min':
+                        merged_values[num] = min(merged_values[num], values[num])
+                    elif function == 'max':
+                        merged_values[num] = max(merged_values[num], values[num])
+                    elif function == 'avg':
+                        merged_values[num] = (merged_values[num] * count + values[num] * doc['n']) / float(count + doc['n'])
+                    else:
+                        merged_values[num] += values[num]
+                merged[key] = (count + doc['n'], merged_values)
+        self.stats.timing('query.aggregate_time', time.time() - start)
+        rows = [list(key) + values for key, (count, values) in sorted(merged.items())]
+        if not rows and not group_by:
+            rows.append([0 for _ in stats])
+        return rows
+
+
+    def aggregate_collections(self, filter_element, pipeline):
+        """Run an aggregation on each collection of a filter, return the lists of their results."""
+        db = self.read_db(filter_element)
+        start = time.time()
+        results = []
+        cursors = []
+        self.pool.checkout()
+        try:
+            for name in self.query_collections(filter_element):
+                result = db[name].aggregate(pipeline)
+                # Before pymongo 3 the result is the reply document of the command
+                if isinstance(result, dict):
+                    result = result.get('result', [])
+                else:
+                    cursors.append(result)
+                results.append(list(result))
+        finally:
+            self.pool.checkin()
+        self.record_latency(cursors, start)
+        return results
+
+
+    def stream_rows(self, rows, documents, filter_element, start, query=None):
+        """Yield the rows, which are read from documents.
+
+        query is (filter_lines, projection, limit, compile_time) for the
+        slow query log. The cursors behind documents only take a
+        connection of the pool while they read a batch, not while
+        livestatus sends the rows, so a generator which is not read to
+        its end doesn't keep one.
+        """
+        count = 0
+        try:
+            for row in rows:
+                count += 1
+                yield row
+        finally:
+            documents.close()
+            # This includes the time livestatus needed to send the rows
+            self.stats.timing('query.total_time', time.time() - start)
+            self.stats.observe('query.documents', count)
+            if self.query_shapes:
+                self.query_shapes.record(filter_element, time.time() - start)
+            total_time = time.time() - start
+            if self.slow_queries and query and self.slow_queries.is_slow(total_time):
+                filter_lines, projection, limit, compile_time = query
+                times = {'total': total_time, 'compile': compile_time}
+                self.log_slow_query(times, count, filter_lines, filter_element, projection, limit)
+
+
+    def log_slow_query(self, times, rows, filter_lines, filter_element, projection, limit, cached=False):
+        """Write a query to the slow query log, with the plans of its collections."""
+        if cached:
+            plans = 'from the query cache'
+        elif not self.explain_slow_queries:
+            plans = 'not explained'
+        elif not self.slow_queries.should_explain(query_shape(filter_element)):
+            plans = 'explained less than %ds ago' % self.slow_queries.explain_interval
+        else:
+            plans = []
+            db = self.read_db(filter_element)
+            for name in self.query_collections(filter_element):
+                cursor = db[name].find(filter_element, projection).sort([(u'time', pymongo.ASCENDING), (u'lineno', pymongo.ASCENDING)])
+                if limit:
+                    cursor.limit(limit)
+                try:
+                    plans.append((name, explain_summary(cursor.explain())))
+                except Exception, exp:
+                    logger.warning("[LogStoreMongoDB] Could not explain a slow query: %s" % exp)
+                    plans.append((name, None))
+        self.slow_queries.write(times, rows, filter_lines, filter_element, plans)
 
-        def not_match_filter():
-            # http://myadventuresincoding.wordpress.com/2011/05/19/mongodb-negative-regex-query-in-mongo-shell/
-            return '\'%s\' : { \'$regex\' : %s }' % (attribute, '^((?!' + reference + ').)')
 
-        def ne_nocase_filter():
-            if reference == '':
-                return '\'%s\' : \'\'' % (attribute,)
-            else:
-                return '\'%s\' : { \'$regex\' : %s, \'$options\' : \'i\' }' % (attribute, '^((?!' + reference + ').)')
-
-        def not_match_nocase_filter():
-            return '\'%s\' : { \'$regex\' : %s, \'$options\' : \'i\' }' % (attribute, '^((?!' + reference + ').)')
-
-        def no_filter():
-            return '\'time\' : { \'$exists\' : True }'
-
-        if attribute not in good_attributes:
-            return no_filter
-        if operator == '=':
-            return eq_filter
-        elif operator == '~':
-            return match_filter
-        elif operator == '=~':
-            return eq_nocase_filter
-        elif operator == '~~':
-            return match_nocase_filter
-        elif operator == '<':
-            return lt_filter
-        elif operator == '>':
-            return gt_filter
-        elif operator == '<=':
-            return le_filter
-        elif operator == '>=':
-            return ge_filter
-        elif operator == '!=':
-            return ne_filter
-        elif operator == '!~':
-            return not_match_filter
-        elif operator == '!=~':
-            return ne_nocase_filter
-        elif operator == '!~~':
-            return not_match_nocase_filter
+    def make_mongo_filter(self, operator, attribute, reference):
+        """Return the pymongo filter document for a Filter: line."""
+        return make_filter(operator, attribute, reference, self.lowercase_fields)
 
 
 class LiveStatusMongoStack(LiveStatusStack):
-    """A Lifo queue for filter functions.
+    """A Lifo queue for pymongo filter documents.
 
     This class inherits either from MyLifoQueue or Queue.LifoQueue
     whatever is available with the current python version.
@@ -401,13 +1277,11 @@ class LiveStatusMongoStack(LiveStatusStack):
     Public functions:
     and_elements -- takes a certain number (given as argument)
     of filters from the stack, creates a new filter and puts
-    this filter on the stack. If these filters are lambda functions,
-    the new filter is a boolean and of the underlying filters.
-    If the filters are sql where-conditions, they are also concatenated
-    with and to form a new string containing a more complex where-condition.
+    this filter on the stack. The new filter is an $and of the
+    underlying filters.
 
     or_elements --- the same, only that the single filters are
-    combined with a logical or.
+    combined with $or.
 
     """
 
@@ -416,17 +1290,14 @@ class LiveStatusMongoStack(LiveStatusStack):
         self.__class__.__bases__[0].__init__(self, *args, **kw)
 
     def not_elements(self):
-        top_filter = self.get_stack()
-        #negate_filter = lambda: '\'$not\': { %s }' % top_filter()
+        """Take the top filter from the stack, negate it and put the result back"""
         # mongodb doesn't have the not-operator like sql, which can negate
         # a complete expression. Mongodb $not can only reverse one operator
-        # at a time. This would require rewriting of the whole expression.
-        # So instead of deciding whether a record can pass the filter or not,
-        # we let it pass in any case. That's no problem, because the result
-        # of the database query will have to go through the in-memory-objects
-        # filter too.
-        negate_filter = lambda: '\'time\' : { \'$exists\' : True }'
-        self.put_stack(negate_filter)
+        # at a time, so the negation is pushed down to the single operators.
+        # Where we can't do this exactly, we let the records pass. That's no
+        # problem, because the result of the database query will have to go
+        # through the in-memory-objects filter too.
+        self.put_stack(not_filter(self.get_stack()))
 
     def and_elements(self, num):
         """Take num filters from the stack, and them and put the result back"""
@@ -434,11 +1305,7 @@ class LiveStatusMongoStack(LiveStatusStack):
             filters = []
             for _ in range(num):
                 filters.append(self.get_stack())
-            # Take from the stack:
-            # Make a combined anded function
-            # Put it on the stack
-            logger.debug("[Logstore MongoDB] Filter is %s" % str(filters))
-            and_clause = lambda: '\'$and\' : [%s]' % ', '.join('{ ' + x() + ' }' for x in filters)
+            and_clause = and_filters(filters)
             logger.debug("[Logstore MongoDB] and_elements %s" % str(and_clause))
             self.put_stack(and_clause)
 
@@ -448,12 +1315,11 @@ class LiveStatusMongoStack(LiveStatusStack):
             filters = []
             for _ in range(num):
                 filters.append(self.get_stack())
-            or_clause = lambda: '\'$or\' : [%s]' % ', '.join('{ ' + x() + ' }' for x in filters)
-            self.put_stack(or_clause)
+            self.put_stack(or_filters(filters))
 
     def get_stack(self):
         """Return the top element from the stack or a filter which is always true"""
         if self.qsize() == 0:
-            return lambda: ''
+            return {}
         else:
             return self.get()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Log lines can be stored in one collection per day, week or month. The
+collections are called like the configured collection with a suffix for
+the period (in local time, like the log rotation):
+day -- logs_20140521
+week -- logs_w20140519, the date of the monday of the week
+month -- logs_201405
+"""
+
+import re
+import time
+import datetime
+
+PERIODS = ('day', 'week', 'month')
+
+SUFFIX_FORMATS = {
+    'day': ('%Y%m%d', r'\d{8}'),
+    'week': ('w%Y%m%d', r'w\d{8}'),
+    'month': ('%Y%m', r'\d{6}'),
+}
+
+
+def bucket_start(timestamp, period):
+    """Return the first day of the bucket a timestamp belongs to."""
+    day = datetime.date.fromtimestamp(timestamp)
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket_start(day, period):
+    if period == 'week':
+        return day + datetime.timedelta(days=7)
+    if period == 'month':
+        if day.month == 12:
+            return day.replace(year=day.year + 1, month=1)
+        return day.replace(month=day.month + 1)
+    return day + datetime.timedelta(days=1)
+
+
+def bucket_name(collection, timestamp, period):
+    """Return the name of the collection for a log line of this time."""
+    return '%s_%s' % (collection, bucket_start(timestamp, period).strftime(SUFFIX_FORMATS[period][0]))
+
+
+def bucket_range(collection, name, period):
+    """Return (start, end) timestamps of a bucket or None if the name
+    is not one of our buckets. end is the start of the next bucket."""
+    suffix_format, suffix_re = SUFFIX_FORMATS[period]
+    if not re.match('^%s_%s$' % (re.escape(collection), suffix_re), name):
+        return None
+    try:
+        day = datetime.datetime.strptime(name[len(collection) + 1:], suffix_format).date()
+    except ValueError:
+        return None
+    end = next_bucket_start(day, period)
+    return time.mktime(day.timetuple()), time.mktime(end.timetuple())
+
+
+def split_by_bucket(lines, collection, period):
+    """Return a list of (bucket name, lines), the oldest bucket first."""
+    buckets = {}
+    for line in lines:
+        buckets.setdefault(bucket_name(collection, line['time'], period), []).append(line)
+    return sorted(buckets.items())
+
+
+def buckets_in_range(names, collection, period, low=None, high=None):
+    """Return the buckets which can hold lines between low and high,
+    the oldest first. low and high can be None for an open range."""
+    buckets = []
+    for name in names:
+        limits = bucket_range(collection, name, period)
+        if limits is None:
+            continue
+        start, end = limits
+        if (low is None or end > low) and (high is None or start <= high):
+            buckets.append((start, name))
+    buckets.sort()
+    return [name for start, name in buckets]
+
+
+def buckets_before(names, collection, period, oldest):
+    """Return the buckets which only hold lines older than oldest."""
+    expired = []
+    for name in names:
+        limits = bucket_range(collection, name, period)
+        if limits is not None and limits[1] <= oldest:
+            expired.append(name)
+    return sorted(expired)
+
+
+def time_slices(low, high, count):
+    """Split the time range from low to high into count slices.
+
+    Returns the conditions on time of the slices, the oldest first. They
+    don't overlap and the first and the last one are open, so together
+    they let every line pass.
+    """
+    step = (high - low) / float(count)
+    bounds = [int(low + step * num) for num in range(1, count)]
+    conditions = []
+    previous = None
+    for bound in bounds + [None]:
+        condition = {}
+        if previous is not None:
+            condition['$gte'] = previous
+        if bound is not None:
+            condition['$lt'] = bound
+        conditions.append({'time': condition})
+        previous = bound
+    return conditions
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A cache for the documents returned by log queries.
+"""
+
+import threading
+
+# A very rough estimate of the memory used by a document and by one of its
+# fields, the values of strings are added
+DOCUMENT_OVERHEAD = 280
+FIELD_OVERHEAD = 80
+
+
+def normalize(value):
+    """Return a hashable form of a filter, equal for equivalent filters.
+
+    The members of $and and $or are sorted, because their order doesn't
+    change the result.
+    """
+    if isinstance(value, dict):
+        items = []
+        for key, sub in value.items():
+            if key in ('$and', '$or', '$nor'):
+                items.append((key, tuple(sorted(normalize(f) for f in sub))))
+            else:
+                items.append((key, normalize(sub)))
+        return ('dict', tuple(sorted(items)))
+    if isinstance(value, (list, tuple)):
+        return ('list', tuple(normalize(v) for v in value))
+    if hasattr(value, 'pattern'):
+        return ('regex', value.pattern, getattr(value, 'flags', 0))
+    return value
+
+
+def document_size(doc):
+    size = DOCUMENT_OVERHEAD
+    for value in doc.values():
+        size += FIELD_OVERHEAD
+        if isinstance(value, basestring):
+            size += len(value)
+    return size
+
+
+def line_key(line):
+    return (line['time'], line['lineno'])
+
+
+class CacheEntry(object):
+    __slots__ = ('documents', 'size', 'low', 'high', 'watermark', 'extendable', 'stale', 'used')
+
+    def __init__(self, documents, low, high, extendable):
+        self.documents = documents
+        self.size = sum(document_size(doc) for doc in documents)
+        self.low = low
+        self.high = high
+        # Every matching line in the database is in documents, so a line
+        # after the last one of them must be new
+        self.watermark = (-1, -1)
+        if documents:
+            self.watermark = line_key(documents[-1])
+        self.extendable = extendable
+        self.stale = False
+        self.used = 0
+
+
+class QueryCache(object):
+    """An LRU cache of query results which holds at most max_size bytes.
+
+    The results are lists of documents, the key of a result is the
+    normalized filter together with the columns and the limit of the query.
+    When log lines are written, written() marks the results of the
+    queries whose time range contains them as stale. If all these lines
+    come after the last line of the result in (time, lineno) order, the
+    result can be extended with the lines after this watermark, otherwise
+    it is thrown away. Results of time ranges which ended before the
+    written lines stay valid.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.tick = 0
+        # counts the calls of written()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, mongo_filter, columns, limit):
+        return (normalize(mongo_filter), tuple(columns or ()), limit)
+
+    def tail_key(self, mongo_filter, columns):
+        """Return the key of the lines since some time which match a filter."""
+        return ('tail', normalize(mongo_filter), tuple(columns or ()))
+
+    def get(self, key):
+        """Return the entry for a key or None.
+
+        The entry may be stale, then it must be extended before it is used.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.tick += 1
+            entry.used = self.tick
+            self.hits += 1
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, key, documents, low, high, generation, extendable=True):
+        """Store the documents a query returned, sorted by time and lineno.
+
+        generation is the one of the cache from before the query. If lines
+        were written while the query ran, it is not known whether the result
+        contains them, so it is not stored.
+        """
+        entry = CacheEntry(documents, low, high, extendable)
+        if entry.size > self.max_size / 4:
+            return
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return
+            self._remove(key)
+            self.tick += 1
+            entry.used = self.tick
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                oldest = min(self.entries, key=lambda k: self.entries[k].used)
+                self._remove(oldest)
+        finally:
+            self.lock.release()
+
+    def extend(self, key, entry, documents, generation):
+        """Append the lines after the watermark of a stale entry."""
+        self.lock.acquire()
+        try:
+            if generation != self.generation or self.entries.get(key) is not entry:
+                self._remove(key)
+                return
+            entry.documents.extend(documents)
+            added = sum(document_size(doc) for doc in documents)
+            entry.size += added
+            self.size += added
+            if documents:
+                entry.watermark = line_key(documents[-1])
+            entry.stale = False
+        finally:
+            self.lock.release()
+
+    def trim(self, key, entry, low):
+        """Drop the documents of an entry which are older than low."""
+        self.lock.acquire()
+        try:
+            if self.entries.get(key) is not entry or entry.low is None or low <= entry.low:
+                return
+            keep = 0
+            while keep < len(entry.documents) and entry.documents[keep]['time'] < low:
+                keep += 1
+            removed = sum(document_size(doc) for doc in entry.documents[:keep])
+            # Readers may still iterate over the old list
+            entry.documents = entry.documents[keep:]
+            entry.size -= removed
+            self.size -= removed
+            entry.low = low
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self.lock.release()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def written(self, lines):
+        """Tell the cache that these log lines were written."""
+        if not lines:
+            return
+        first = min(line_key(line) for line in lines)
+        last = max(line_key(line) for line in lines)
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            for key, entry in self.entries.items():
+                if entry.high is not None and first[0] > entry.high:
+                    continue
+                if entry.low is not None and last[0] < entry.low:
+                    continue
+                if entry.extendable and first > entry.watermark:
+                    entry.stale = True
+                else:
+                    self._remove(key)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.size = 0
+        finally:
+            self.lock.release()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Routing of log queries to the members of a replica set.
+
+Queries for lines older than some seconds can read from secondaries,
+which are a little behind the primary, so they don't compete with the
+inserts. NodeLatency keeps the time the queries took on each member.
+"""
+
+import threading
+
+try:
+    from pymongo import ReadPreference
+except ImportError:
+    ReadPreference = None
+
+READ_PREFERENCES = ('primary', 'primary_preferred', 'secondary', 'secondary_preferred', 'nearest')
+
+
+def read_preference(name):
+    """Return the pymongo read preference for a name of READ_PREFERENCES."""
+    if ReadPreference is None or name not in READ_PREFERENCES:
+        return None
+    return getattr(ReadPreference, name.upper())
+
+
+def cursor_address(cursor):
+    """Return the (host, port) of the member a cursor read from, None if not known."""
+    # conn_id before pymongo 3
+    return getattr(cursor, 'address', None) or getattr(cursor, 'conn_id', None)
+
+
+def node_name(address):
+    if isinstance(address, tuple):
+        return '%s:%s' % address
+    return str(address)
+
+
+class NodeLatency(object):
+    """The number and the duration of the queries per member."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}
+
+    def record(self, address, elapsed):
+        node = node_name(address)
+        self.lock.acquire()
+        try:
+            count, total, maximum = self.nodes.get(node, (0, 0.0, 0.0))
+            self.nodes[node] = (count + 1, total + elapsed, max(maximum, elapsed))
+        finally:
+            self.lock.release()
+
+    def report(self, reset=False):
+        """Return a list of dicts with the node, the count, the avg and the max of the times."""
+        self.lock.acquire()
+        try:
+            nodes = self.nodes
+            if reset:
+                self.nodes = {}
+        finally:
+            self.lock.release()
+        return [{'node': node, 'count': count, 'avg': total / count, 'max': maximum}
+                for node, (count, total, maximum) in sorted(nodes.items())]
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A log of the queries which took longer than a threshold.
+
+An entry has the Filter: lines livestatus gave, the MongoDB filter they
+became, the plan MongoDB chose for it and where the time was spent. The
+entries are written to their own file, which is rotated by size.
+"""
+
+import time
+import logging
+import logging.handlers
+import threading
+
+# The stages of a plan which read a collection
+SCAN_STAGES = ('IXSCAN', 'COLLSCAN', 'TEXT', 'IDHACK')
+
+
+def plan_stages(plan):
+    """Yield the stages of a winning plan, the outermost first."""
+    stack = [plan]
+    while stack:
+        stage = stack.pop()
+        if not isinstance(stage, dict):
+            continue
+        yield stage
+        if 'inputStage' in stage:
+            stack.append(stage['inputStage'])
+        stack.extend(stage.get('inputStages', []))
+        # the plans of the shards of a sharded collection
+        for shard in stage.get('shards', []):
+            stack.append(shard.get('winningPlan'))
+
+
+def explain_summary(explain):
+    """Return what matters of the result of explain() as a dict.
+
+    plan is how the collection was read (IXSCAN, COLLSCAN), index the
+    names of the indexes which were used. The result of explain() of
+    MongoDB 3.0 and later and the one of older servers are understood.
+    """
+    summary = {'plan': None, 'index': None, 'keys_examined': None, 'docs_examined': None, 'returned': None}
+    if 'queryPlanner' in explain:
+        plans = []
+        indexes = []
+        for stage in plan_stages(explain['queryPlanner'].get('winningPlan')):
+            if stage.get('stage') in SCAN_STAGES:
+                if stage['stage'] not in plans:
+                    plans.append(stage['stage'])
+                index = stage.get('indexName') or stage.get('keyPattern') and str(stage['keyPattern'])
+                if index and index not in indexes:
+                    indexes.append(index)
+        summary['plan'] = '+'.join(plans) or None
+        summary['index'] = ','.join(indexes) or None
+        execution = explain.get('executionStats', {})
+        summary['keys_examined'] = execution.get('totalKeysExamined')
+        summary['docs_examined'] = execution.get('totalDocsExamined')
+        summary['returned'] = execution.get('nReturned')
+    else:
+        # BtreeCursor <index> [reverse] or BasicCursor
+        cursor = explain.get('cursor', '')
+        if cursor.startswith('BtreeCursor'):
+            summary['plan'] = 'IXSCAN'
+            summary['index'] = cursor.split()[1]
+        elif cursor == 'BasicCursor':
+            summary['plan'] = 'COLLSCAN'
+        else:
+            summary['plan'] = cursor or None
+        summary['keys_examined'] = explain.get('nscanned')
+        summary['docs_examined'] = explain.get('nscannedObjects')
+        summary['returned'] = explain.get('n')
+    return summary
+
+
+def format_plan(collection, summary):
+    if summary is None:
+        return '%s: no plan' % collection
+    return '%s: %s on %s, %s keys and %s documents examined, %s returned' % (
+        collection, summary['plan'], summary['index'] or 'no index',
+        summary['keys_examined'], summary['docs_examined'], summary['returned'])
+
+
+def format_slow_query(times, rows, filter_lines, mongo_filter, plans):
+    """Return the text of an entry of the slow query log.
+
+    times has the total seconds and those spent in the filter compiler,
+    the database and in Python turning documents into rows, if known.
+    plans is a list of (collection, explain_summary), or a string which
+    tells why there is none.
+    """
+    parts = []
+    for key, name in (('compile', 'compile'), ('database', 'database'), ('rows', 'rows')):
+        if times.get(key) is not None:
+            parts.append('%s %.3fs' % (name, times[key]))
+    if parts:
+        lines = ['slow query %.3fs (%s), %d rows' % (times['total'], ', '.join(parts), rows)]
+    else:
+        lines = ['slow query %.3fs, %d rows' % (times['total'], rows)]
+    lines.append('  livestatus: %s' % (' | '.join(filter_lines) or 'no filter'))
+    lines.append('  mongodb: %s' % (mongo_filter,))
+    if isinstance(plans, basestring):
+        lines.append('  plan: %s' % plans)
+    else:
+        for collection, summary in plans:
+            lines.append('  plan of %s' % format_plan(collection, summary))
+    return '\n'.join(lines)
+
+
+class SlowQueryLog(object):
+    """Writes the queries which took threshold seconds or more to a rotated file."""
+
+    def __init__(self, path, threshold, max_bytes=10 * 1024 * 1024, backup_count=5, explain_interval=600):
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        # query shape -> when a query of this shape was explained last
+        self.explained = {}
+        self.lock = threading.Lock()
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        # Not known to the logging module, so nothing goes to the broker log
+        self.logger = logging.Logger('logstore_mongodb.slow_queries')
+        self.logger.addHandler(self.handler)
+
+    def is_slow(self, seconds):
+        return seconds >= self.threshold
+
+    def should_explain(self, shape, now=None):
+        """Tell if a slow query of a shape is to be explained.
+
+        explain() runs the query once more, so this is only done once in
+        explain_interval seconds for the queries of the same shape.
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            last = self.explained.get(shape)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self.explained[shape] = now
+            return True
+        finally:
+            self.lock.release()
+
+    def write(self, times, rows, filter_lines, mongo_filter, plans):
+        self.logger.warning(format_slow_query(times, rows, filter_lines, mongo_filter, plans))
+
+    def close(self):
+        self.handler.close()
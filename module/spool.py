@@ -0,0 +1,334 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Places where log lines are parked while they can not be written to the
+database. LogSpool keeps them in append-only segment files on disk, so they
+survive a restart of the broker, MemorySpool keeps them in memory.
+Both are bounded: when they are full, the oldest segment is dropped.
+"""
+
+import os
+import re
+import struct
+import time
+import threading
+from collections import deque
+
+import bson
+from pymongo.errors import ConnectionFailure
+
+from shinken.log import logger
+
+
+def line_order(line):
+    return (line.get('time'), line.get('lineno'))
+
+
+class Spool(object):
+    """Base class of the spools.
+
+    append -- add log lines at the end of the spool
+    oldest -- return the oldest segment and its log lines
+    remove -- delete a segment once its lines are in the database
+    quarantine -- put a segment which can't be written aside
+    drain -- write the spooled log lines to the database
+    size -- how much is waiting in the spool
+    """
+
+    unit = 'bytes'
+
+    # How often a segment may fail for another reason than a lost
+    # connection before it is put into quarantine
+    max_failures = 3
+
+    def drain(self, insert, max_segments=None):
+        """Write segments, oldest first, each with one call of insert(lines).
+
+        The lines of a segment are sorted by time and lineno before.
+        An exception of insert() stops the drain and is raised again, the
+        segment which failed stays in the spool. A segment which failed
+        max_failures times for another reason than a lost connection is
+        put into quarantine instead, so that it does not block the ones
+        behind it. Returns the number of written lines.
+        """
+        start = time.time()
+        written = 0
+        segments = 0
+        try:
+            while not self.empty() and (max_segments is None or segments < max_segments):
+                seq, lines = self.oldest()
+                if lines:
+                    lines.sort(key=line_order)
+                    try:
+                        insert(lines)
+                    except ConnectionFailure:
+                        raise
+                    except Exception, exp:
+                        self.failures[seq] = self.failures.get(seq, 0) + 1
+                        if self.failures[seq] < self.max_failures:
+                            raise
+                        del self.failures[seq]
+                        logger.error("[LogStoreMongoDB] Spool segment %d with %d log lines failed %d times, put into quarantine: %s" % (
+                                     seq, len(lines), self.max_failures, exp))
+                        self.quarantine(seq)
+                        segments += 1
+                        continue
+                    self.failures.pop(seq, None)
+                self.remove(seq)
+                written += len(lines)
+                segments += 1
+        finally:
+            if segments:
+                elapsed = max(time.time() - start, 0.001)
+                logger.info("[LogStoreMongoDB] Spool drained %d log lines in %.1fs (%d lines/s), %d %s left" % (
+                            written, elapsed, written / elapsed, self.size(), self.unit))
+        return written
+
+
+class LogSpool(Spool):
+    """Log lines appended to segment files as BSON documents."""
+
+    def __init__(self, directory, name='spool', segment_size=4 * 1024 * 1024, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.name = name
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.segment_re = re.compile(r'^%s-(\d+)\.bson$' % re.escape(name))
+        self.failures = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Segments left over by a previous run are drained first
+        self.segments = deque()
+        self.sizes = {}
+        for filename in sorted(os.listdir(directory)):
+            match = self.segment_re.match(filename)
+            if match:
+                seq = int(match.group(1))
+                self.segments.append(seq)
+                self.sizes[seq] = os.path.getsize(self.path(seq))
+        self.active = None
+        self.fh = None
+        self.next_seq = 0
+        if self.segments:
+            self.next_seq = self.segments[-1] + 1
+        if self.segments:
+            logger.info("[LogStoreMongoDB] Spool %s holds %d bytes from a previous run" % (directory, self.size()))
+
+    def path(self, seq):
+        return os.path.join(self.directory, '%s-%012d.bson' % (self.name, seq))
+
+    def quarantine_path(self, seq):
+        return os.path.join(self.directory, '%s-quarantine-%012d.bson' % (self.name, seq))
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def empty(self):
+        return not self.segments
+
+    def append(self, lines):
+        data = ''.join(bson.BSON.encode(line) for line in lines)
+        self.lock.acquire()
+        try:
+            if self.active is None or self.sizes[self.active] >= self.segment_size:
+                self._close_active()
+                self.active = self.next_seq
+                self.next_seq += 1
+                self.segments.append(self.active)
+                self.sizes[self.active] = 0
+                self.fh = open(self.path(self.active), 'ab')
+                logger.info("[LogStoreMongoDB] Spool holds %d bytes in %d segments" % (self.size(), len(self.segments)))
+            # Flushed at once, so that the lines survive a crash of the broker
+            self.fh.write(data)
+            self.fh.flush()
+            self.sizes[self.active] += len(data)
+            while self.size() > self.max_size and len(self.segments) > 1:
+                seq = self.segments[0]
+                logger.error("[LogStoreMongoDB] Spool is full, dropping %d bytes of log lines" % self.sizes[seq])
+                self._remove(seq)
+        finally:
+            self.lock.release()
+
+    def oldest(self):
+        """Return (segment, loglines) for the oldest segment.
+
+        The segment stays in the spool until it is removed. (None, [])
+        means the spool is empty.
+        """
+        self.lock.acquire()
+        try:
+            if not self.segments:
+                return None, []
+            seq = self.segments[0]
+            if seq == self.active:
+                # Lines are no longer appended to a segment which is drained
+                self._close_active()
+            fh = open(self.path(seq), 'rb')
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+        finally:
+            self.lock.release()
+        try:
+            return seq, bson.decode_all(data)
+        except Exception, exp:
+            # A crash while appending can leave a truncated document behind
+            logger.error("[LogStoreMongoDB] Spool segment %s is damaged: %s" % (self.path(seq), exp))
+            return seq, self._decode_valid_prefix(data)
+
+    def _decode_valid_prefix(self, data):
+        lines = []
+        pos = 0
+        while pos + 4 <= len(data):
+            length = struct.unpack('<i', data[pos:pos + 4])[0]
+            if length < 5 or pos + length > len(data):
+                break
+            try:
+                lines.append(bson.BSON(data[pos:pos + length]).decode())
+            except Exception:
+                break
+            pos += length
+        return lines
+
+    def remove(self, seq):
+        self.lock.acquire()
+        try:
+            self._remove(seq)
+        finally:
+            self.lock.release()
+
+    def quarantine(self, seq):
+        """Move a segment out of the spool into a file which is kept for inspection."""
+        self.lock.acquire()
+        try:
+            if seq == self.active:
+                self._close_active()
+            if seq not in self.sizes:
+                return
+            try:
+                os.rename(self.path(seq), self.quarantine_path(seq))
+            except OSError, exp:
+                logger.error("[LogStoreMongoDB] Could not move spool segment into quarantine: %s" % exp)
+                self._remove(seq)
+                return
+            self.segments.remove(seq)
+            del self.sizes[seq]
+            logger.error("[LogStoreMongoDB] Spool segment moved to %s" % self.quarantine_path(seq))
+        finally:
+            self.lock.release()
+
+    def _close_active(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        self.active = None
+
+    def _remove(self, seq):
+        if seq in self.sizes:
+            self.segments.remove(seq)
+            del self.sizes[seq]
+            if seq == self.active:
+                self._close_active()
+            try:
+                os.remove(self.path(seq))
+            except OSError, exp:
+                logger.error("[LogStoreMongoDB] Could not remove spool segment: %s" % exp)
+
+
+class MemorySpool(Spool):
+    """The same as LogSpool, but the segments are kept in memory.
+
+    The lines are lost when the broker stops. max_size is a number
+    of log lines.
+    """
+
+    unit = 'lines'
+
+    def __init__(self, segment_size=10000, max_size=1000000):
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.segments = deque()
+        self.next_seq = 0
+        self.lines = 0
+        self.active = None
+        self.failures = {}
+
+    def size(self):
+        return self.lines
+
+    def empty(self):
+        return not self.segments
+
+    def append(self, lines):
+        self.lock.acquire()
+        try:
+            if self.active is None or len(self.active[1]) >= self.segment_size:
+                self.active = (self.next_seq, [])
+                self.next_seq += 1
+                self.segments.append(self.active)
+                logger.info("[LogStoreMongoDB] Spool holds %d log lines in %d segments" % (self.lines, len(self.segments)))
+            self.active[1].extend(lines)
+            self.lines += len(lines)
+            while self.lines > self.max_size and len(self.segments) > 1:
+                seq, dropped = self.segments[0]
+                logger.error("[LogStoreMongoDB] Spool is full, dropping %d log lines" % len(dropped))
+                self._remove(seq)
+        finally:
+            self.lock.release()
+
+    def oldest(self):
+        self.lock.acquire()
+        try:
+            if not self.segments:
+                return None, []
+            segment = self.segments[0]
+            if segment is self.active:
+                self.active = None
+            return segment[0], list(segment[1])
+        finally:
+            self.lock.release()
+
+    def remove(self, seq):
+        self.lock.acquire()
+        try:
+            self._remove(seq)
+        finally:
+            self.lock.release()
+
+    def quarantine(self, seq):
+        """Drop a segment, there is no place to keep it."""
+        self.remove(seq)
+
+    def _remove(self, seq):
+        for segment in self.segments:
+            if segment[0] == seq:
+                self.segments.remove(segment)
+                self.lines -= len(segment[1])
+                if segment is self.active:
+                    self.active = None
+                break
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counters, gauges and histograms of what the module does.
+
+A snapshot of them is returned by get_stats() of the module and can be
+written periodically to a JSON file or sent to statsd.
+"""
+
+import os
+import time
+import json
+import socket
+import threading
+from bisect import bisect_left
+
+# Upper bounds of the buckets of histograms of seconds and of counts
+TIME_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BOUNDS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class Histogram(object):
+    """Counts the values which fall into each bucket of bounds."""
+
+    def __init__(self, bounds, unit=None):
+        self.bounds = bounds
+        self.unit = unit
+        # the last bucket takes the values above the last bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket which holds the percentile."""
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for num, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                if num < len(self.bounds):
+                    return min(self.bounds[num], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'unit': self.unit,
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.count and self.sum / self.count or 0.0,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'buckets': zip(list(self.bounds) + ['inf'], self.buckets),
+        }
+
+
+class Stats(object):
+    """The counters, gauges and histograms of the module."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # rates are computed since the last mark()
+        self.marked = self.started
+        self.marked_counters = {}
+
+    def incr(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def gauge(self, name, value):
+        """Set a gauge, value may be a function which is called for every snapshot."""
+        self.gauges[name] = value
+
+    def observe(self, name, value, bounds=COUNT_BOUNDS, unit=None):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds, unit)
+            histogram.add(value)
+        finally:
+            self.lock.release()
+
+    def timing(self, name, seconds):
+        self.observe(name, seconds, TIME_BOUNDS, 's')
+
+    def snapshot(self, mark=False):
+        """Return the current values as a dict.
+
+        The rates are per second and the histograms hold the values since
+        the last snapshot with mark, which starts new histograms.
+        """
+        now = time.time()
+        gauges = {}
+        for name, value in self.gauges.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    value = None
+            gauges[name] = value
+        self.lock.acquire()
+        try:
+            counters = dict(self.counters)
+            elapsed = max(now - self.marked, 0.001)
+            rates = {}
+            for name, value in counters.items():
+                rates[name] = (value - self.marked_counters.get(name, 0)) / elapsed
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = histogram.summary()
+            if mark:
+                self.marked = now
+                self.marked_counters = counters
+                self.histograms = dict((name, Histogram(histogram.bounds, histogram.unit))
+                                       for name, histogram in self.histograms.items())
+        finally:
+            self.lock.release()
+        return {
+            'time': now,
+            'uptime': now - self.started,
+            'counters': counters,
+            'rates': rates,
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+
+def write_stats_file(path, snapshot):
+    """Replace the file at path with the snapshot as JSON."""
+    temporary = path + '.tmp'
+    stats_file = open(temporary, 'w')
+    try:
+        json.dump(snapshot, stats_file, indent=1, sort_keys=True)
+    finally:
+        stats_file.close()
+    os.rename(temporary, path)
+
+
+class StatsdSender(object):
+    """Sends snapshots to statsd over UDP.
+
+    Counters are sent as the increase since the last snapshot, gauges as
+    they are and histograms, which hold the values of one interval, as
+    gauges of their avg, p95 and max, in ms if they hold seconds. statsd
+    would compute its own percentiles of timers, not of these values.
+    """
+
+    def __init__(self, host, port=8125, prefix='shinken.logstore_mongodb'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.last_counters = {}
+
+    def lines(self, snapshot):
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('%s.%s:%d|c' % (self.prefix, name, value - self.last_counters.get(name, 0)))
+        self.last_counters = snapshot['counters']
+        for name, value in sorted(snapshot['gauges'].items()):
+            if isinstance(value, (int, long, float)):
+                lines.append('%s.%s:%s|g' % (self.prefix, name, value))
+        for name, summary in sorted(snapshot['histograms'].items()):
+            if not summary['count']:
+                continue
+            for key in ('avg', 'p95', 'max'):
+                if summary['unit'] == 's':
+                    lines.append('%s.%s.%s:%f|g' % (self.prefix, name, key, summary[key] * 1000))
+                else:
+                    lines.append('%s.%s.%s:%s|g' % (self.prefix, name, key, summary[key]))
+        return lines
+
+    def send(self, snapshot):
+        # several lines per packet, but a packet must not get too big
+        packet = ''
+        for line in self.lines(snapshot):
+            if packet and len(packet) + len(line) > 1400:
+                self.socket.sendto(packet, self.address)
+                packet = ''
+            packet += packet and '\n' + line or line
+        if packet:
+            self.socket.sendto(packet, self.address)
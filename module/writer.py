@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A thread which writes log lines to the database, so that the livestatus
+broker never has to wait for MongoDB.
+"""
+
+import time
+import threading
+import Queue
+
+from pymongo.errors import AutoReconnect, ConnectionFailure
+
+from shinken.log import logger
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+
+
+class LogWriter(threading.Thread):
+    """Takes log lines from a bounded queue and writes them in batches.
+
+    The thread has its own database connection, connect() returns
+    it and write(db, lines) inserts the lines. When MongoDB is not
+    reachable, the current batch is kept and retried with an increasing
+    delay while new lines pile up in the queue. What happens when the
+    queue is full is decided by the overflow policy:
+    block -- the broker waits until there is room again
+    drop-oldest -- the oldest queued line is thrown away
+    spill -- the line is written to the spool on disk and
+    sent to the database as soon as the queue is empty again
+    Whatever can not be written when the writer is stopped goes to
+    the spool as well.
+    """
+
+    min_retry_delay = 0.1
+    max_retry_delay = 5.0
+
+    def __init__(self, connect, write, queue_size, overflow, batch_size, batch_timeout, spool=None, stats=None):
+        threading.Thread.__init__(self, name='logstore-mongodb-writer')
+        self.daemon = True
+        self.connect = connect
+        self.write = write
+        self.queue = Queue.Queue(queue_size)
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.spool = spool
+        self.stats = stats
+        self.stopping = threading.Event()
+        self.db = None
+        self.dropped = 0
+        self.spilled = 0
+
+    def put(self, line):
+        """Queue a log line, called from the broker thread."""
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(line)
+            return
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            if self.overflow == OVERFLOW_SPILL:
+                self.spool.append([line])
+                self.spilled += 1
+                return
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning("[LogStoreMongoDB] Writer queue is full, %d log lines dropped so far" % self.dropped)
+            except Queue.Empty:
+                pass
+            self.queue.put_nowait(line)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def stop(self, timeout=10):
+        """Write what is still queued and stop the thread."""
+        self.stopping.set()
+        self.join(timeout)
+        if self.is_alive():
+            logger.warning("[LogStoreMongoDB] Writer did not finish, %d log lines still queued" % self.qsize())
+
+    def next_batch(self):
+        """Wait for log lines and return up to batch_size of them.
+
+        None means the writer was stopped and the queue is empty.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                wait = self.batch_timeout
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+            try:
+                batch.append(self.queue.get(True, wait))
+            except Queue.Empty:
+                if batch or not self.stopping.is_set():
+                    break
+                return None
+            if deadline is None:
+                deadline = time.time() + self.batch_timeout
+        return batch
+
+    def insert(self, lines):
+        if self.db is None:
+            self.db = self.connect()
+        self.write(self.db, lines)
+
+    def run(self):
+        batch = []
+        delay = self.min_retry_delay
+        while True:
+            if not batch:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                if not batch and self.spool and not self.spool.empty():
+                    # The queue is idle, send one segment of spooled lines
+                    try:
+                        self.spool.drain(self.insert, max_segments=1)
+                        delay = self.min_retry_delay
+                    except (AutoReconnect, ConnectionFailure), exp:
+                        if self.stats:
+                            self.stats.incr('reconnects')
+                        logger.warning("[LogStoreMongoDB] Writer could not reach the database, retry in %.1fs: %s" % (delay, exp))
+                        self.stopping.wait(delay)
+                        delay = min(delay * 2, self.max_retry_delay)
+                    except Exception, exp:
+                        logger.error("[LogStoreMongoDB] Writer could not drain the spool: %s" % exp)
+                        self.stopping.wait(self.max_retry_delay)
+                if not batch:
+                    continue
+            try:
+                self.insert(batch)
+                batch = []
+                delay = self.min_retry_delay
+            except (AutoReconnect, ConnectionFailure), exp:
+                if self.stats:
+                    self.stats.incr('reconnects')
+                if self.stopping.is_set():
+                    break
+                logger.warning("[LogStoreMongoDB] Writer could not reach the database, retry in %.1fs: %s" % (delay, exp))
+                self.stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            except Exception, exp:
+                logger.error("[LogStoreMongoDB] Writer lost %d log lines: %s" % (len(batch), exp))
+                batch = []
+        # Lines which could not be written before the stop are kept in the
+        # spool if there is one
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            if self.spool:
+                self.spool.append(batch)
+            else:
+                logger.error("[LogStoreMongoDB] Writer stopped with %d unwritten log lines" % len(batch))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+#
+# Compares the time needed to turn the reply of MongoDB into result rows
+# for documents with field names and for the arrays of array_rows. The
+# lines look like the ones of TestConfigBig (100 hosts with 20 services).
+# Without a uri only the decoding of the BSON replies is measured, with
+# one the lines are also written to a scratch collection and read back
+# with find() and with the aggregation of array_rows.
+#
+# On a test machine arrays were decoded 1.7-2.5x faster with 8 or more
+# columns. With 5 or fewer short columns the runs varied between 0.8x and
+# 1.5x, so below about 8 columns arrays don't reliably pay off.
+#
+# python test/bench_array_rows.py [lines] [mongodb uri]
+#
+
+
+from __future__ import print_function
+
+import sys
+import time
+import random
+from operator import itemgetter
+
+import bson
+import pymongo
+from bson.son import SON
+
+COLUMNS = ['logobject', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'host_name', 'lineno', 'message', 'plugin_output', 'service_description', 'state', 'state_type', 'time', 'type']
+QUERY_COLUMNS = [
+    ('all columns', COLUMNS),
+    ('10 columns', ['logobject', 'attempt', 'logclass', 'host_name', 'lineno', 'message', 'plugin_output',
+                    'service_description', 'state', 'time']),
+    ('8 columns', ['logobject', 'logclass', 'host_name', 'lineno', 'message', 'service_description', 'state', 'time']),
+    ('5 columns', ['host_name', 'lineno', 'service_description', 'state', 'time']),
+    ('3 columns', ['lineno', 'state', 'time']),
+]
+BATCH = 1000
+# Every decoding is measured this often, the fastest run counts
+REPEAT = 5
+
+
+def lines(count):
+    random.seed(1)
+    result = []
+    for num in range(count):
+        host = 'test_host_%03d' % random.randint(0, 99)
+        service = 'test_ok_%02d' % random.randint(0, 19)
+        state = random.choice(['OK', 'WARNING', 'CRITICAL'])
+        output = '%s | value=%d' % (state, random.randint(0, 100))
+        result.append({
+            'logobject': 2, 'attempt': 1, 'logclass': 1, 'command_name': u'', 'comment': u'', 'contact_name': u'',
+            'host_name': host, 'lineno': num % 10 + 1,
+            'message': u'[%d] SERVICE ALERT: %s;%s;%s;HARD;1;%s' % (1400000000 + num / 10, host, service, state, output),
+            'plugin_output': output, 'service_description': service, 'state': ['OK', 'WARNING', 'CRITICAL'].index(state),
+            'state_type': u'HARD', 'time': 1400000000 + num / 10, 'type': u'SERVICE ALERT',
+        })
+    return result
+
+
+def replies(docs, encode):
+    """Return the BSON replies for the documents, BATCH documents each."""
+    return [''.join(bson.BSON.encode(encode(doc)) for doc in docs[start:start + BATCH])
+            for start in range(0, len(docs), BATCH)]
+
+
+def decode(batches, getter):
+    start = time.time()
+    rows = []
+    for batch in batches:
+        rows.extend(map(getter, bson.decode_all(batch)))
+    return time.time() - start
+
+
+def bench_decoding(docs):
+    print("decoding %d lines (us/line)" % len(docs))
+    print("  %-12s %10s %10s %8s" % ('', 'documents', 'arrays', 'speedup'))
+    for name, columns in QUERY_COLUMNS:
+        documents = replies(docs, lambda doc: dict((c, doc[c]) for c in columns))
+        arrays = replies(docs, lambda doc: {'r': [doc[c] for c in columns]})
+        plain = min(decode(documents, itemgetter(*columns)) for _ in range(REPEAT)) / len(docs) * 1e6
+        array = min(decode(arrays, itemgetter('r')) for _ in range(REPEAT)) / len(docs) * 1e6
+        print("  %-12s %10.2f %10.2f %7.1fx" % (name, plain, array, plain / array))
+
+
+def bench_queries(docs, uri):
+    collection = pymongo.MongoClient(uri)['bench_array_rows']['logs']
+    collection.drop()
+    for start in range(0, len(docs), BATCH):
+        collection.insert([dict(doc) for doc in docs[start:start + BATCH]])
+    collection.ensure_index([('time', pymongo.ASCENDING), ('lineno', pymongo.ASCENDING)])
+    sort = [('time', pymongo.ASCENDING), ('lineno', pymongo.ASCENDING)]
+    print("reading %d lines (us/line)" % len(docs))
+    print("  %-12s %10s %10s %8s" % ('', 'find', 'arrays', 'speedup'))
+    for name, columns in QUERY_COLUMNS:
+        projection = dict((c, True) for c in columns)
+        projection['_id'] = False
+        start = time.time()
+        map(itemgetter(*columns), collection.find({}, projection).sort(sort).batch_size(BATCH))
+        plain = (time.time() - start) / len(docs) * 1e6
+        pipeline = [{'$sort': SON(sort)}, {'$project': {'_id': False, 'r': ['$' + c for c in columns]}}]
+        start = time.time()
+        map(itemgetter('r'), collection.aggregate(pipeline, cursor={'batchSize': BATCH}))
+        array = (time.time() - start) / len(docs) * 1e6
+        print("  %-12s %10.2f %10.2f %7.1fx" % (name, plain, array, plain / array))
+    collection.drop()
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 200000
+    docs = lines(count)
+    bench_decoding(docs)
+    if len(sys.argv) > 2:
+        bench_queries(docs, sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
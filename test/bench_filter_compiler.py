@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Compares the time needed to turn livestatus filter headers into a
+# pymongo query with the filter compiler and with the former way of
+# building python source strings and eval()-ing them.
+#
+# python test/bench_filter_compiler.py [repetitions]
+#
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+import filter_compiler
+
+
+QUERIES = {
+    'time range': """Filter: time >= 1400000000
+Filter: time <= 1400086400""",
+    'host alerts': """Filter: time >= 1400000000
+Filter: time <= 1400086400
+Filter: host_name = test_host_005
+Filter: type = HOST ALERT""",
+    'availability': """Filter: time >= 1400000000
+Filter: time <= 1400086400
+Filter: type = SERVICE ALERT
+And: 1
+Filter: type = HOST ALERT
+And: 1
+Filter: type = SERVICE FLAPPING ALERT
+Filter: type = HOST FLAPPING ALERT
+Filter: type = SERVICE DOWNTIME ALERT
+Filter: type = HOST DOWNTIME ALERT
+Filter: type ~ starting...
+Filter: type ~ shutting down...
+Or: 8""",
+    'service history': """Filter: time >= 1400000000
+Filter: time <= 1400086400
+Filter: host_name = test_host_005
+Filter: service_description = test_ok_01
+Filter: class = 1
+Filter: state != 0
+Filter: plugin_output ~~ timeout""",
+}
+
+
+def parse(query):
+    """Return the filter headers of a query as (keyword, args) tuples."""
+    headers = []
+    for line in query.splitlines():
+        keyword, args = line.split(': ', 1)
+        if keyword == 'Filter':
+            attribute, operator, reference = (args.split(' ', 2) + [''])[:3]
+            headers.append((keyword, (operator, attribute, reference)))
+        else:
+            headers.append((keyword, int(args)))
+    return headers
+
+
+def compile_native(headers):
+    stack = []
+    for keyword, args in headers:
+        if keyword == 'Filter':
+            stack.append(filter_compiler.make_filter(*args))
+        elif args > 1:
+            filters = [stack.pop() for _ in range(args)]
+            if keyword == 'And':
+                stack.append(filter_compiler.and_filters(filters))
+            else:
+                stack.append(filter_compiler.or_filters(filters))
+    return filter_compiler.and_filters([stack.pop() for _ in range(len(stack))])
+
+
+def legacy_make_mongo_filter(operator, attribute, reference):
+    # The former make_mongo_filter, returning closures which build source text
+    good_attributes = ['time', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'message', 'host_name', 'plugin_output', 'service_description', 'state', 'state_type', 'type']
+    string_attributes = ['command_name', 'comment', 'contact_name', 'host_name', 'message', 'plugin_output', 'service_description', 'state_type', 'type']
+    if attribute in string_attributes:
+        reference = "'%s'" % reference
+    if attribute == 'class':
+        attribute = 'logclass'
+
+    def eq_filter():
+        if reference == '':
+            return '\'%s\' : \'\'' % (attribute,)
+        else:
+            return '\'%s\' : %s' % (attribute, reference)
+
+    def match_filter():
+        return '\'%s\' : { \'$regex\' : %s }' % (attribute, reference)
+
+    def match_nocase_filter():
+        return '\'%s\' : { \'$regex\' : %s, \'$options\' : \'i\' }' % (attribute, reference)
+
+    def ne_filter():
+        return '\'%s\' : { \'$ne\' : %s }' % (attribute, reference)
+
+    def ge_filter():
+        return '\'%s\' : { \'$gte\' : %s }' % (attribute, reference)
+
+    def le_filter():
+        return '\'%s\' : { \'$lte\' : %s }' % (attribute, reference)
+
+    def no_filter():
+        return '\'time\' : { \'$exists\' : True }'
+
+    if attribute not in good_attributes:
+        return no_filter
+    return {
+        '=': eq_filter,
+        '~': match_filter,
+        '~~': match_nocase_filter,
+        '!=': ne_filter,
+        '>=': ge_filter,
+        '<=': le_filter,
+    }[operator]
+
+
+def compile_legacy(headers):
+    stack = []
+
+    def combine(op, filters):
+        return lambda: '\'%s\' : [%s]' % (op, ', '.join('{ ' + x() + ' }' for x in filters))
+
+    for keyword, args in headers:
+        if keyword == 'Filter':
+            stack.append(legacy_make_mongo_filter(*args))
+        elif args > 1:
+            filters = [stack.pop() for _ in range(args)]
+            stack.append(combine(keyword == 'And' and '$and' or '$or', filters))
+    if len(stack) > 1:
+        filters = [stack.pop() for _ in range(len(stack))]
+        stack.append(combine('$and', filters))
+    return eval('{ ' + stack[0]() + ' }')
+
+
+def bench(func, headers, repetitions):
+    start = time.time()
+    for _ in range(repetitions):
+        func(headers)
+    return (time.time() - start) / repetitions * 1e6
+
+
+def main():
+    repetitions = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+    print("%-16s %12s %12s %8s" % ('query', 'legacy us', 'native us', 'speedup'))
+    for name in sorted(QUERIES):
+        headers = parse(QUERIES[name])
+        legacy = bench(compile_legacy, headers, repetitions)
+        native = bench(compile_native, headers, repetitions)
+        print("%-16s %12.2f %12.2f %7.1fx" % (name, legacy, native, legacy / native))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+#
+# Compares the time needed to turn log lines into documents with the fast
+# parser and with Logline, if livestatus can be imported.
+#
+# python test/bench_log_parser.py [lines]
+#
+
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from log_parser import parse_line
+
+try:
+    from livestatus.log_line import Logline
+except ImportError:
+    Logline = None
+
+SKIPPED_LINE = re.compile(r"^\[[0-9]*\] [A-Z][a-z]*.:")
+
+# The kinds of lines with their share of a busy log
+TEMPLATES = [
+    (60, 'SERVICE ALERT: host_%(host)03d;service_%(service)02d;%(service_state)s;%(state_type)s;%(attempt)d;%(output)s'),
+    (10, 'HOST ALERT: host_%(host)03d;%(host_state)s;%(state_type)s;%(attempt)d;%(output)s'),
+    (10, 'SERVICE NOTIFICATION: admin;host_%(host)03d;service_%(service)02d;%(service_state)s;notify-service-by-email;%(output)s'),
+    (3, 'HOST NOTIFICATION: admin;host_%(host)03d;%(host_state)s;notify-host-by-email;%(output)s'),
+    (5, 'CURRENT SERVICE STATE: host_%(host)03d;service_%(service)02d;%(service_state)s;HARD;1;%(output)s'),
+    (2, 'CURRENT HOST STATE: host_%(host)03d;%(host_state)s;HARD;1;%(output)s'),
+    (2, 'SERVICE DOWNTIME ALERT: host_%(host)03d;service_%(service)02d;STARTED;Service has entered a period of scheduled downtime'),
+    (2, 'SERVICE FLAPPING ALERT: host_%(host)03d;service_%(service)02d;STARTED;Service appears to have started flapping'),
+    (3, 'EXTERNAL COMMAND: [%(time)d] PROCESS_SERVICE_CHECK_RESULT;host_%(host)03d;service_%(service)02d;0;OK'),
+    (2, 'SERVICE EVENT HANDLER: host_%(host)03d;service_%(service)02d;%(service_state)s;SOFT;1;restart-service'),
+    (1, 'Warning: Check result queue contained results for host_%(host)03d, but the host could not be found!'),
+]
+
+
+def corpus(count):
+    random.seed(1)
+    choices = []
+    for weight, template in TEMPLATES:
+        choices.extend([template] * weight)
+    now = 1400000000
+    lines = []
+    for num in range(count):
+        values = {
+            'time': now + num / 50,
+            'host': random.randint(0, 500),
+            'service': random.randint(0, 20),
+            'service_state': random.choice(['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']),
+            'host_state': random.choice(['UP', 'DOWN', 'UNREACHABLE']),
+            'state_type': random.choice(['SOFT', 'HARD']),
+            'attempt': random.randint(1, 3),
+            'output': 'CHECK_NRPE: Socket timeout after 10 seconds, load average: 0.%d' % random.randint(0, 99),
+        }
+        lines.append('[%d] %s\n' % (values['time'], random.choice(choices) % values))
+    return lines
+
+
+def ingest_fast(lines):
+    for line in lines:
+        if parse_line(line) is None and not SKIPPED_LINE.match(line) and Logline is not None:
+            Logline(line=line).as_dict()
+
+
+def ingest_logline(lines):
+    for line in lines:
+        if not re.match("^\[[0-9]*\] [A-Z][a-z]*.:", line):
+            Logline(line=line).as_dict()
+
+
+def bench(func, lines):
+    start = time.time()
+    func(lines)
+    return (time.time() - start) / len(lines) * 1e6
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    lines = corpus(count)
+    fast = bench(ingest_fast, lines)
+    known = len([line for line in lines if parse_line(line) is not None])
+    print("%d lines, %.1f%% parsed by the fast parser" % (count, 100.0 * known / count))
+    print("%-16s %12.2f us/line" % ('fast parser', fast))
+    if Logline is None:
+        print("livestatus can't be imported, Logline is not measured")
+        return
+    logline = bench(ingest_logline, lines)
+    print("%-16s %12.2f us/line" % ('Logline', logline))
+    print("%-16s %11.1fx" % ('speedup', logline / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Benchmarks ingest and queries of the module against a throwaway local
+# mongod, started like the one of test_livestatus_mongodb.py. A synthetic
+# log of the given size and number of hosts and services is written with
+# manage_log_brok, then a catalogue of typical livestatus log queries is
+# run, then the retention deletes the older half of the log. The results
+# are written as JSON, so the ones of two versions or two configurations
+# can be compared.
+#
+# Run it in the shinken test directory, like the tests:
+# python bench_logstore.py --lines 200000 --hosts 500 --services 20 \
+#     --option query_cache_size=64 --output result.json
+#
+
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import resource
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+from shinken.brok import Brok
+from shinken.modulesctx import modulesctx
+from shinken.objects.module import Module
+
+
+# The kinds of lines with their share of a busy log
+TEMPLATES = [
+    (60, 'SERVICE ALERT: %(host)s;%(service)s;%(service_state)s;%(state_type)s;%(attempt)d;%(output)s'),
+    (10, 'HOST ALERT: %(host)s;%(host_state)s;%(state_type)s;%(attempt)d;%(output)s'),
+    (10, 'SERVICE NOTIFICATION: admin;%(host)s;%(service)s;%(service_state)s;notify-service-by-email;%(output)s'),
+    (3, 'HOST NOTIFICATION: admin;%(host)s;%(host_state)s;notify-host-by-email;%(output)s'),
+    (5, 'CURRENT SERVICE STATE: %(host)s;%(service)s;%(service_state)s;HARD;1;%(output)s'),
+    (2, 'CURRENT HOST STATE: %(host)s;%(host_state)s;HARD;1;%(output)s'),
+    (2, 'SERVICE DOWNTIME ALERT: %(host)s;%(service)s;STARTED;Service has entered a period of scheduled downtime'),
+    (2, 'SERVICE FLAPPING ALERT: %(host)s;%(service)s;STARTED;Service appears to have started flapping'),
+    (3, 'EXTERNAL COMMAND: [%(time)d] PROCESS_SERVICE_CHECK_RESULT;%(host)s;%(service)s;0;OK'),
+    (2, 'SERVICE EVENT HANDLER: %(host)s;%(service)s;%(service_state)s;SOFT;1;restart-service'),
+    (1, 'Warning: Check result queue contained results for %(host)s, but the host could not be found!'),
+]
+
+# Typical queries of the log table by the web interfaces, like livestatus
+# receives them. %(...)s are replaced by times relative to the end of the
+# log, a host and a service.
+QUERIES = [
+    ('host_history_day', """Columns: time type message host_name service_description state
+Filter: time >= %(day_ago)s
+Filter: time <= %(end)s
+Filter: host_name = %(host)s
+And: 3"""),
+    ('service_history_week', """Columns: time type message state state_type plugin_output
+Filter: time >= %(week_ago)s
+Filter: time <= %(end)s
+Filter: host_name = %(host)s
+Filter: service_description = %(service)s
+And: 4"""),
+    ('alerts_last_hour', """Columns: time type host_name service_description state plugin_output
+Filter: time >= %(hour_ago)s
+Filter: class = 1
+And: 2"""),
+    ('notifications_day', """Columns: time contact_name host_name service_description command_name
+Filter: time >= %(day_ago)s
+Filter: class = 3
+And: 2"""),
+    ('problems_or_day', """Columns: time host_name service_description state
+Filter: time >= %(day_ago)s
+Filter: state = 2
+Filter: state = 3
+Or: 2
+And: 2"""),
+    ('message_regex_day', """Columns: time message
+Filter: time >= %(day_ago)s
+Filter: message ~~ socket timeout
+And: 2"""),
+    ('latest_lines', """Columns: time type message
+Filter: time >= %(hour_ago)s
+Limit: 1000"""),
+    ('full_range_all_columns', """Filter: time >= %(start)s
+Filter: time <= %(end)s
+Filter: host_name = %(host)s
+And: 3"""),
+]
+
+# Stats: queries, as (name, filter lines, stats, group_by)
+STATS_QUERIES = [
+    ('count_by_state_day', """Filter: time >= %(day_ago)s
+Filter: class = 1
+And: 2""", [('count', None)], ['state']),
+    ('alerts_per_host_week', """Filter: time >= %(week_ago)s
+Filter: class = 1
+And: 2""", [('count', None), ('max', 'state')], ['host_name']),
+]
+
+
+def host_name(num):
+    return 'host_%04d' % num
+
+
+def service_description(num):
+    return 'service_%03d' % num
+
+
+def log_lines(count, hosts, services, start, end):
+    """Return count log lines with evenly spread times from start to end."""
+    random.seed(1)
+    choices = []
+    for weight, template in TEMPLATES:
+        choices.extend([template] * weight)
+    step = float(end - start) / count
+    lines = []
+    for num in xrange(count):
+        values = {
+            'time': int(start + num * step),
+            'host': host_name(random.randint(0, hosts - 1)),
+            'service': service_description(random.randint(0, services - 1)),
+            'service_state': random.choice(['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']),
+            'host_state': random.choice(['UP', 'DOWN', 'UNREACHABLE']),
+            'state_type': random.choice(['SOFT', 'HARD']),
+            'attempt': random.randint(1, 3),
+            'output': 'CHECK_NRPE: Socket timeout after 10 seconds, load average: 0.%d' % random.randint(0, 99),
+        }
+        lines.append('[%d] %s' % (values['time'], random.choice(choices) % values))
+    return lines
+
+
+def peak_rss():
+    """Return the peak resident set size of the process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_mongod(mongod, directory, timeout=60):
+    """Start a mongod with its files in directory, return the process and its uri."""
+    os.makedirs(os.path.join(directory, 'db'))
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    args = [mongod, '--dbpath', os.path.join(directory, 'db'), '--port', str(port),
+            '--logpath', os.path.join(directory, 'log.txt'), '--smallfiles']
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(1)
+        if proc.poll() is not None:
+            raise RuntimeError("mongod died at its start, see %s" % os.path.join(directory, 'log.txt'))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not sock.connect_ex(('127.0.0.1', port)):
+            sock.close()
+            return proc, 'mongodb://127.0.0.1:%d' % port
+        sock.close()
+    proc.kill()
+    raise RuntimeError("mongod did not listen on port %d after %d seconds" % (port, timeout))
+
+
+def stop_mongod(proc):
+    proc.terminate()
+    for _ in range(10):
+        time.sleep(1)
+        if proc.poll() is not None:
+            return
+    proc.kill()
+    proc.wait()
+
+
+def count_lines(store):
+    return sum([store.db[name].count() for name in store.db.collection_names()
+                if name == store.collection or name.startswith(store.collection + '_')])
+
+
+def bench_ingest(store, lines):
+    """Write the lines with manage_log_brok, return the results."""
+    broks = []
+    for line in lines:
+        brok = Brok('log', {'log': line})
+        if hasattr(brok, 'prepare'):
+            brok.prepare()
+        broks.append(brok)
+    rss_before = peak_rss()
+    start = time.time()
+    for brok in broks:
+        store.manage_log_brok(brok)
+    handled = time.time() - start
+    # The lines are only stored when the buffer or the writer queue is
+    # written, which is part of the ingest
+    store.flush()
+    stored = store.stats.counters.get('ingest.lines', 0)
+    while store.writer and store.stats.counters.get('insert.lines', 0) + store.writer.dropped < stored:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    return {
+        'lines': len(lines),
+        'stored_lines': stored,
+        'manage_log_brok_seconds': handled,
+        'manage_log_brok_lines_per_second': len(lines) / handled,
+        'seconds': elapsed,
+        'lines_per_second': len(lines) / elapsed,
+        'peak_rss': peak_rss(),
+        'peak_rss_growth': peak_rss() - rss_before,
+    }
+
+
+def run_query_filters(store, query):
+    """Give the module the filters of a query like livestatus, return its columns."""
+    columns = None
+    for line in query.splitlines():
+        header, _, argument = line.partition(':')
+        argument = argument.strip()
+        if header == 'Columns':
+            columns = argument.split()
+        elif header == 'Filter':
+            attribute, operator, reference = (argument.split(' ', 2) + [''])[:3]
+            store.add_filter(operator, attribute, reference)
+        elif header == 'And':
+            store.add_filter_and(int(argument))
+        elif header == 'Or':
+            store.add_filter_or(int(argument))
+        elif header == 'Negate':
+            store.add_filter_not()
+        elif header == 'Limit':
+            store.add_limit(argument)
+    return columns
+
+
+def run_query(store, query):
+    return store.get_live_data_log(run_query_filters(store, query), [])
+
+
+def timings(func, repeat):
+    """Run func repeat times, return the result and the times of the runs."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        if not isinstance(result, list):
+            result = list(result)
+        times.append(time.time() - start)
+    return result, times
+
+
+def summary(times, rows):
+    ordered = sorted(times)
+    return {
+        'rows': rows,
+        'first': times[0],
+        'min': ordered[0],
+        'median': ordered[len(ordered) / 2],
+        'max': ordered[-1],
+    }
+
+
+def bench_queries(store, values, repeat):
+    results = {}
+    for name, query in QUERIES:
+        rows, times = timings(lambda: run_query(store, query % values), repeat)
+        results[name] = summary(times, len(rows))
+        print("  %-24s %8d rows %10.4fs" % (name, len(rows), results[name]['median']), file=sys.stderr)
+    for name, query, stats, group_by in STATS_QUERIES:
+        def stats_query():
+            run_query_filters(store, query % values)
+            rows = store.get_live_data_log_stats(stats, group_by)
+            if rows is None:
+                # livestatus computes the stats from the lines
+                rows = store.get_live_data_log(None, [])
+            return rows
+        rows, times = timings(stats_query, repeat)
+        results[name] = summary(times, len(rows))
+        print("  %-24s %8d rows %10.4fs" % (name, len(rows), results[name]['median']), file=sys.stderr)
+    return results
+
+
+def bench_retention(store):
+    """Delete the lines older than max_logs_age, return the results."""
+    before = count_lines(store)
+    store.next_log_db_rotate = 0
+    start = time.time()
+    store.commit_and_rotate_log_db()
+    elapsed = time.time() - start
+    after = count_lines(store)
+    return {
+        'lines_before': before,
+        'lines_deleted': before - after,
+        'seconds': elapsed,
+        'lines_per_second': (before - after) / max(elapsed, 0.000001),
+    }
+
+
+def git_revision():
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return proc.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--lines', type='int', default=100000, help="number of log lines")
+    parser.add_option('--hosts', type='int', default=500, help="number of hosts")
+    parser.add_option('--services', type='int', default=20, help="number of services per host")
+    parser.add_option('--days', type='int', default=14, help="the log ends now and starts days ago")
+    parser.add_option('--repeat', type='int', default=5, help="runs of each query")
+    parser.add_option('--option', action='append', default=[], metavar='NAME=VALUE',
+                      help="option of the module, may be repeated")
+    parser.add_option('--mongod', default='/usr/bin/mongod', help="the mongod to start")
+    parser.add_option('--uri', help="use this MongoDB instead of starting a mongod")
+    parser.add_option('--modules-dir', default='modules', help="where shinken finds the modules")
+    parser.add_option('--output', help="write the results to this file instead of stdout")
+    options, _ = parser.parse_args()
+
+    modulesctx.set_modulesdir(options.modules_dir)
+    logstore_mongodb = modulesctx.get_module('logstore-mongodb')
+
+    end = int(time.time())
+    start = end - options.days * 86400
+    module_options = {
+        # the older half of the log is deleted by the retention
+        'max_logs_age': '%dd' % max(options.days / 2, 1),
+    }
+    for option in options.option:
+        name, _, value = option.partition('=')
+        module_options[name] = value
+
+    mongod = directory = None
+    if options.uri:
+        uri = options.uri
+    else:
+        directory = tempfile.mkdtemp(prefix='bench_mongo')
+        mongod, uri = start_mongod(options.mongod, os.path.join(directory, 'mongo'))
+    database = 'bench%d' % os.getpid()
+    try:
+        conf = {
+            'module_name': 'LogStore',
+            'module_type': 'logstore_mongodb',
+            'mongodb_uri': uri,
+            'database': database,
+        }
+        conf.update(module_options)
+        store = logstore_mongodb.LiveStatusLogStoreMongoDB(Module(conf))
+        store.open()
+        try:
+            print("Generating %d log lines" % options.lines, file=sys.stderr)
+            lines = log_lines(options.lines, options.hosts, options.services, start, end)
+            print("Ingest", file=sys.stderr)
+            ingest = bench_ingest(store, lines)
+            del lines
+            values = {
+                'start': start,
+                'end': end,
+                'week_ago': end - 7 * 86400,
+                'day_ago': end - 86400,
+                'hour_ago': end - 3600,
+                'host': host_name(options.hosts / 2),
+                'service': service_description(options.services / 2),
+            }
+            print("Queries", file=sys.stderr)
+            queries = bench_queries(store, values, options.repeat)
+            print("Retention", file=sys.stderr)
+            retention = bench_retention(store)
+            stats = store.get_stats()
+        finally:
+            store.conn.drop_database(database)
+            store.close()
+    finally:
+        if mongod is not None:
+            stop_mongod(mongod)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    result = {
+        'time': end,
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'lines': options.lines,
+        'hosts': options.hosts,
+        'services': options.services,
+        'days': options.days,
+        'repeat': options.repeat,
+        'module_options': module_options,
+        'ingest': ingest,
+        'queries': queries,
+        'retention': retention,
+        'peak_rss': peak_rss(),
+        'stats': stats,
+    }
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    json.dump(result, output, indent=1, sort_keys=True)
+    output.write('\n')
+    if options.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+
+#
+# Compares the time and memory needed to turn the documents of a query
+# into result rows: the former way, which built the column description
+# and a value list for every row, one description shared by all rows, and
+# raw tuples. Each way runs in its own process, the memory is the growth
+# of its resident set size.
+#
+# python test/bench_rows.py [rows]
+#
+
+
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import time
+from itertools import imap
+from operator import itemgetter
+
+try:
+    from livestatus.log_line import Logline
+except ImportError:
+    Logline = None
+
+
+class Row(object):
+    """Built like a Logline from a description and values, if livestatus can't be imported."""
+
+    def __init__(self, description, row):
+        for idx, col in enumerate(description):
+            setattr(self, col[0], row[idx])
+
+
+COLUMNS = ['logobject', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'host_name', 'lineno', 'message', 'plugin_output', 'service_description', 'state', 'state_type', 'time', 'type']
+
+
+def documents(count):
+    docs = []
+    for num in range(count):
+        docs.append({
+            'logobject': 2, 'attempt': 1, 'logclass': 1, 'command_name': '',
+            'comment': '', 'contact_name': '', 'host_name': 'host_%03d' % (num % 500),
+            'lineno': num % 50, 'message': '[%d] SERVICE ALERT: host;service;OK;HARD;1;OK' % (1400000000 + num),
+            'plugin_output': 'OK', 'service_description': 'service_%02d' % (num % 20),
+            'state': 0, 'state_type': 'HARD', 'time': 1400000000 + num / 50,
+            'type': 'SERVICE ALERT',
+        })
+    return docs
+
+
+def per_row_description(row_class, docs, columns):
+    return [row_class([(c,) for c in columns], [x[col] for col in columns]) for x in docs]
+
+
+def shared_description(row_class, docs, columns):
+    description = [(c,) for c in columns]
+    return [row_class(description, row) for row in imap(itemgetter(*columns), docs)]
+
+
+def raw_tuples(row_class, docs, columns):
+    return map(itemgetter(*columns), docs)
+
+
+def rss():
+    statm = open('/proc/self/statm').read().split()
+    return int(statm[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(func, row_class, docs, columns):
+    """Run func in a child process and return its time and memory growth."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        gc.collect()
+        before = rss()
+        start = time.time()
+        result = func(row_class, docs, columns)
+        elapsed = time.time() - start
+        gc.collect()
+        os.write(write_end, '%f %d' % (elapsed, rss() - before))
+        os._exit(len(result) and 0)
+    os.close(write_end)
+    output = os.read(read_end, 100)
+    os.waitpid(pid, 0)
+    elapsed, memory = output.split()
+    return float(elapsed), int(memory)
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    row_class = Logline or Row
+    print("%d rows of %s" % (count, Logline and 'Logline' or 'a class built like Logline'))
+    docs = documents(count)
+    for columns in (COLUMNS, ['time', 'host_name', 'state']):
+        print("%d columns" % len(columns))
+        print("  %-20s %10s %10s" % ('', 'seconds', 'MB'))
+        for name, func in (('per row description', per_row_description),
+                           ('shared description', shared_description),
+                           ('raw tuples', raw_tuples)):
+            elapsed, memory = measure(func, row_class, docs, columns)
+            print("  %-20s %10.2f %10.1f" % (name, elapsed, memory / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the compact schema of the stored log lines.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from compact_schema import compact_document, compact_filter, compact_expression, compact_operand, expand_value, matches, \
+    stored_field, stored_value, stored_row_getter, stored_array_row_getter
+from filter_compiler import make_filter, make_expression, stats_group, and_filters, or_filters, not_filter, Superset
+from hot_tier import HotTier
+
+COLUMNS = ['logobject', 'attempt', 'logclass', 'command_name', 'comment', 'contact_name', 'host_name', 'lineno',
+           'message', 'plugin_output', 'service_description', 'state', 'state_type', 'time', 'type']
+
+
+def line(lineno, host_name, service_description, type, state_type, state=0):
+    return {
+        'time': 1000, 'lineno': lineno, 'logobject': 2, 'logclass': 1, 'state': state, 'attempt': 1,
+        'host_name': host_name, 'service_description': service_description, 'type': type,
+        'state_type': state_type, 'contact_name': '', 'command_name': '', 'comment': '',
+        'message': '[1000] %s: %s;%s' % (type, host_name, service_description), 'plugin_output': '',
+    }
+
+
+LINES = [
+    line(1, 'test_host_0', 'test_ok_0', 'SERVICE ALERT', 'HARD', 2),
+    line(2, 'test_host_0', '', 'HOST ALERT', 'SOFT', 1),
+    line(3, 'test_host_1', 'test_ok_1', 'SERVICE NOTIFICATION', ''),
+    line(4, 'test_host_1', 'test_ok_0', 'NEW KIND OF ALERT', 'UNKNOWN STATE TYPE'),
+]
+
+
+class TestCompactSchema(unittest.TestCase):
+
+    def test_document(self):
+        doc = compact_document(LINES[2])
+        self.assertEqual({'time': 1000, 'lineno': 3, 'o': 2, 'c': 1, 'st': 0, 'a': 1, 'h': 'test_host_1',
+                          's': 'test_ok_1', 'ty': 2, 'm': LINES[2]['message']}, doc)
+        self.assertEqual(LINES[2], dict(zip(COLUMNS, stored_row_getter(COLUMNS)(doc))))
+        # values which are not in the lists stay strings
+        doc = compact_document(LINES[3])
+        self.assertEqual(('NEW KIND OF ALERT', 'UNKNOWN STATE TYPE'), (doc['ty'], doc['sy']))
+        self.assertEqual(LINES[3], dict(zip(COLUMNS, stored_row_getter(COLUMNS)(doc))))
+        row = stored_array_row_getter(['type', 'service_description'])({'r': [1, None]})
+        self.assertEqual(('HOST ALERT', ''), row)
+
+    def test_matches(self):
+        self.assertTrue(matches({'$regex': '^TEST', '$options': 'i'}, 'test_host_0'))
+        self.assertFalse(matches({'$regex': '^TEST'}, 'test_host_0'))
+        self.assertTrue(matches({'$ne': 'x'}, ''))
+        self.assertTrue(matches({'$gte': 'a', '$lt': 'b'}, 'abc'))
+        self.assertEqual(None, matches({'$where': 'true'}, ''))
+
+    def test_filters(self):
+        # The stored lines must be found by the compact filters like the
+        # lines by the filters made by the filter compiler
+        tier = HotTier(3600, now=1000)
+        compact_tier = HotTier(3600, now=1000, derived=dict(
+            (stored_field(attribute), (attribute, lambda value, attribute=attribute: stored_value(attribute, value)))
+            for attribute in COLUMNS))
+        for values in LINES:
+            tier.add(values)
+            compact_tier.add(values)
+        host = make_filter('=', 'host_name', 'test_host_0')
+        filters = [
+            host,
+            make_filter('=', 'service_description', ''),
+            make_filter('!=', 'service_description', ''),
+            make_filter('=', 'type', 'SERVICE ALERT'),
+            make_filter('=', 'type', 'NEW KIND OF ALERT'),
+            make_filter('!=', 'type', 'HOST ALERT'),
+            make_filter('~', 'type', 'ALERT'),
+            make_filter('!~', 'type', 'ALERT'),
+            make_filter('~', 'state_type', '^$'),
+            make_filter('!~', 'service_description', '^$'),
+            make_filter('<', 'service_description', 'test_ok_1'),
+            make_filter('=~', 'host_name', 'TEST_HOST_1'),
+            not_filter(make_filter('=~', 'state_type', 'hard')),
+            or_filters([host, make_filter('=', 'state_type', '')]),
+            not_filter(and_filters([make_filter('~', 'service_description', 'ok'), make_filter('>=', 'state', '1')])),
+        ]
+        for mongo_filter in filters:
+            expected = [row[7] for row in tier.find(mongo_filter, COLUMNS, 1000)]
+            found = [row[7] for row in compact_tier.find(compact_filter(mongo_filter), COLUMNS, 1000)]
+            self.assertEqual(expected, found, '%s -> %s' % (mongo_filter, compact_filter(mongo_filter)))
+
+    def test_compact_filter(self):
+        self.assertEqual({'$and': [{'h': 'test_host_0'}, {'time': {'$gte': 100}}]},
+                         compact_filter(and_filters([make_filter('=', 'host_name', 'test_host_0'),
+                                                     make_filter('>=', 'time', '100')])))
+        self.assertEqual({'ty': {'$in': [0, 1]}}, compact_filter({'type': {'$in': ['SERVICE ALERT', 'HOST ALERT']}}))
+        self.assertEqual({'s': None}, compact_filter(make_filter('=', 'service_description', '')))
+        # it can be applied twice, like to a filter which was given back
+        mongo_filter = compact_filter(make_filter('~', 'type', 'ALERT'))
+        self.assertEqual(mongo_filter, compact_filter(mongo_filter))
+        self.assertTrue(isinstance(compact_filter(Superset({'host_name': 'x'})), Superset))
+
+    def test_expression(self):
+        self.assertEqual({'$eq': ['$st', 2]}, compact_expression(make_expression('=', 'state', '2')))
+        self.assertEqual({'$eq': [{'$ifNull': ['$ty', '']}, 0]}, compact_expression(make_expression('=', 'type', 'SERVICE ALERT')))
+        self.assertEqual(None, compact_expression(make_expression('<', 'type', 'SERVICE ALERT')))
+        group, attributes = stats_group([('count', ('type', '=', 'HOST ALERT')), ('max', 'state')], ['host_name'], ['host_name'],
+                                        compact_operand, compact_expression)
+        self.assertEqual({'g0': {'$ifNull': ['$h', '']}}, group['_id'])
+        self.assertEqual({'$sum': {'$cond': [{'$eq': [{'$ifNull': ['$ty', '']}, 1]}, 1, 0]}}, group['s0'])
+        self.assertEqual({'$max': '$st'}, group['s1'])
+        self.assertEqual('HOST ALERT', expand_value('type', 1))
+        self.assertEqual('', expand_value('state_type', None))
+        self.assertEqual(None, expand_value('state', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
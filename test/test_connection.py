@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the pool of connections to MongoDB.
+#
+
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from connection import MongoPool, pool_options, only_duplicate_keys
+
+
+class TestConnection(unittest.TestCase):
+
+    def test_options(self):
+        options = pool_options(5, connect_timeout=2, socket_timeout=0.5, w='majority', journal=True)
+        self.assertEqual(5, options['maxPoolSize'])
+        self.assertEqual(2000, options['connectTimeoutMS'])
+        self.assertEqual(500, options['socketTimeoutMS'])
+        self.assertEqual('majority', options['w'])
+        self.assertEqual(True, options['j'])
+        self.assertFalse('waitQueueTimeoutMS' in options)
+        # j can't go together with fsync or w=0
+        options = pool_options(w='0', journal=True)
+        self.assertEqual((0, False), (options['w'], 'j' in options))
+        options = pool_options(journal=True, fsync=True)
+        self.assertEqual((True, False), (options['fsync'], 'j' in options))
+
+    def test_duplicate_keys(self):
+        class BulkError(Exception):
+            def __init__(self, details):
+                self.details = details
+        # lines which were already written by an interrupted insert
+        self.assertTrue(only_duplicate_keys(BulkError({'writeErrors': [{'code': 11000}, {'code': 11000}]})))
+        self.assertFalse(only_duplicate_keys(BulkError({'writeErrors': [{'code': 11000}, {'code': 2}]})))
+        self.assertFalse(only_duplicate_keys(BulkError({'writeErrors': [{'code': 11000}], 'writeConcernErrors': [{'code': 64}]})))
+        self.assertFalse(only_duplicate_keys(BulkError({})))
+        self.assertFalse(only_duplicate_keys(Exception('no details')))
+
+    def test_checkout_stats(self):
+        pool = MongoPool('mongodb://localhost', pool_size=1)
+        pool.checkout()
+
+        def use():
+            pool.checkout()
+            pool.checkin()
+        thread = threading.Thread(target=use)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(1, pool.stats()['in_use'])
+        pool.checkin()
+        thread.join()
+        stats = pool.stats()
+        self.assertEqual(2, stats['checkouts'])
+        self.assertEqual(1, stats['waits'])
+        self.assertTrue(stats['max_wait'] >= 0.05)
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(1, stats['max_in_use'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the translation of livestatus filters
+# into pymongo queries.
+#
+
+
+import os
+import sys
+import unittest
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from filter_compiler import make_filter, and_filters, or_filters, not_filter, split_window, in_window, literal_prefix, add_text_search, \
+    stats_group, Superset
+
+
+class TestFilterCompiler(unittest.TestCase):
+
+    def test_coercion(self):
+        self.assertEqual({'time': {'$gte': 1400000000}}, make_filter('>=', 'time', '1400000000'))
+        self.assertEqual({'state': 2}, make_filter('=', 'state', '2'))
+        self.assertEqual({'logclass': 1}, make_filter('=', 'class', '1'))
+        self.assertEqual({'host_name': '42'}, make_filter('=', 'host_name', '42'))
+        # a reference which is not a number lets everything pass
+        self.assertEqual({}, make_filter('=', 'state', 'CRITICAL'))
+
+    def test_quotes_and_metacharacters(self):
+        self.assertEqual({'host_name': "it's \"quoted\""}, make_filter('=', 'host_name', "it's \"quoted\""))
+        self.assertEqual({'host_name': {'$regex': '^srv\\.1\\(a\\)$', '$options': 'i'}},
+                         make_filter('=~', 'host_name', 'srv.1(a)'))
+        # the UTF-8 bytes of non-ASCII characters are not escaped one by one
+        mongo_filter = make_filter('=~', 'host_name', 'caf\xc3\xa9.1')
+        self.assertEqual({'host_name': {'$regex': '^caf\xc3\xa9\\.1$', '$options': 'i'}}, mongo_filter)
+        bson.BSON.encode(mongo_filter)
+        bson.BSON.encode(make_filter('!=~', 'service_description', 'caf\xc3\xa9'))
+
+    def test_prefix(self):
+        self.assertEqual(('web', '.*'), literal_prefix('^web.*'))
+        self.assertEqual(('srv.1', '$'), literal_prefix('^srv\\.1$'))
+        self.assertEqual(('we', 'b*'), literal_prefix('^web*'))
+        self.assertEqual(None, literal_prefix('web'))
+        self.assertEqual(None, literal_prefix('^web|db'))
+        # a literal prefix becomes a range, which can be read from an index
+        self.assertEqual({'host_name': {'$gte': 'web', '$lt': 'wec'}}, make_filter('~', 'host_name', '^web'))
+        self.assertEqual({'host_name': {'$gte': 'web', '$lt': 'wec'}}, make_filter('~', 'host_name', '^web.*'))
+        self.assertEqual({'host_name': {'$regex': '^web[0-9]'}}, make_filter('~', 'host_name', '^web[0-9]'))
+        self.assertEqual({'host_name': {'$regex': '^web', '$options': 'i'}}, make_filter('~~', 'host_name', '^web'))
+
+    def test_lowercase_fields(self):
+        self.assertEqual({'host_name_lc': 'srv.1(a)'}, make_filter('=~', 'host_name', 'SRV.1(a)', True))
+        self.assertEqual({'contact_name_lc': {'$ne': 'admin'}}, make_filter('!=~', 'contact_name', 'Admin', True))
+        self.assertEqual({'host_name_lc': {'$gte': 'web', '$lt': 'wec'}}, make_filter('~~', 'host_name', '^WEB', True))
+        self.assertEqual({'host_name_lc': {'$gte': 'web', '$lt': 'wec'}, 'host_name': {'$regex': '^WEB[0-9]', '$options': 'i'}},
+                         make_filter('~~', 'host_name', '^WEB[0-9]', True))
+        self.assertEqual({'host_name': {'$regex': 'web', '$options': 'i'}}, make_filter('~~', 'host_name', 'web', True))
+        # attributes without a lowercase copy
+        self.assertEqual({'message': {'$regex': '^web', '$options': 'i'}}, make_filter('~~', 'message', '^web', True))
+
+    def test_text_search(self):
+        since = make_filter('>=', 'time', '100')
+        text = {'$search': '"connection refused"', '$language': 'none'}
+        mongo_filter = and_filters([since, make_filter('~~', 'plugin_output', r'\bconnection refused\b')])
+        self.assertEqual({'$and': mongo_filter['$and'], '$text': text}, add_text_search(mongo_filter))
+        # it is added only once
+        self.assertEqual(add_text_search(mongo_filter), add_text_search(add_text_search(mongo_filter)))
+        self.assertEqual({'message': {'$regex': r'\btimeout\b'}, '$text': {'$search': '"timeout"', '$language': 'none'}},
+                         add_text_search(make_filter('~', 'message', r'\btimeout\b')))
+        # a word without boundaries is a substring, timeout finds timeouts,
+        # which the text index doesn't
+        self.assertEqual({'message': {'$regex': 'timeout'}}, add_text_search(make_filter('~', 'message', 'timeout')))
+        self.assertEqual(make_filter('~', 'message', r'\btimeout'), add_text_search(make_filter('~', 'message', r'\btimeout')))
+        # real regular expressions, other attributes, $or and $not are left alone
+        for mongo_filter in (make_filter('~', 'message', r'\btime.*out\b'),
+                             make_filter('~', 'host_name', r'\btimeout\b'),
+                             or_filters([since, make_filter('~', 'message', r'\btimeout\b')]),
+                             not_filter(make_filter('~', 'message', r'\btimeout\b'))):
+            self.assertEqual(mongo_filter, add_text_search(mongo_filter))
+        self.assertTrue(isinstance(add_text_search(Superset(make_filter('~', 'message', r'\btimeout\b'))), Superset))
+
+    def test_stats_group(self):
+        columns = ['host_name', 'state', 'time']
+        group, attributes = stats_group([('count', None), ('count', ('state', '=', '1')), ('max', 'time')], ['host_name'], columns)
+        self.assertEqual(['host_name'], attributes)
+        self.assertEqual({'_id': {'g0': '$host_name'},
+                          's0': {'$sum': 1},
+                          's1': {'$sum': {'$cond': [{'$eq': ['$state', 1]}, 1, 0]}},
+                          's2': {'$max': '$time'},
+                          'n': {'$sum': 1}}, group)
+        self.assertEqual(None, stats_group([('count', None)], [], columns)[0]['_id'])
+        self.assertEqual({'$sum': {'$cond': [{'$gte': ['$logclass', 2]}, 1, 0]}},
+                         stats_group([('count', ('class', '>=', '2'))], [], columns)[0]['s0'])
+        # the ones the database can't do
+        self.assertEqual((None, None), stats_group([('count', ('plugin_output', '~', 'down'))], [], columns))
+        self.assertEqual((None, None), stats_group([('avg', 'host_name')], [], columns))
+        self.assertEqual((None, None), stats_group([('count', None)], ['current_host_state'], columns))
+        # another schema of the stored lines
+        group, attributes = stats_group([('count', ('state', '=', '1')), ('min', 'time')], ['state'], columns,
+                                        operand=lambda attribute: '$x_' + attribute,
+                                        translate=lambda expression: {'$expr': expression})
+        self.assertEqual({'g0': '$x_state'}, group['_id'])
+        self.assertEqual({'$sum': {'$cond': [{'$expr': {'$eq': ['$state', 1]}}, 1, 0]}}, group['s0'])
+        self.assertEqual({'$min': '$x_time'}, group['s1'])
+        self.assertEqual((None, None), stats_group([('count', ('state', '=', '1'))], [], columns, translate=lambda expression: None))
+
+    def test_unknown_attribute(self):
+        self.assertEqual({}, make_filter('=', 'current_host_state', '0'))
+        self.assertEqual({}, make_filter('~', 'state', '0'))
+
+    def test_and_or(self):
+        host = make_filter('=', 'host_name', 'test_host_0')
+        alert = make_filter('=', 'type', 'HOST ALERT')
+        self.assertEqual({'$and': [host, alert]}, and_filters([host, {}, alert]))
+        self.assertEqual(host, and_filters([{}, host]))
+        self.assertEqual({'$or': [host, alert]}, or_filters([host, alert]))
+        self.assertEqual({}, or_filters([host, {}]))
+
+    def test_negate(self):
+        host = make_filter('=', 'host_name', 'test_host_0')
+        since = make_filter('>=', 'time', '1400000000')
+        self.assertEqual({'host_name': {'$ne': 'test_host_0'}}, not_filter(host))
+        self.assertEqual(host, not_filter(not_filter(host)))
+        self.assertEqual({'$or': [{'host_name': {'$ne': 'test_host_0'}}, {'time': {'$lt': 1400000000}}]},
+                         not_filter(and_filters([host, since])))
+        self.assertEqual({'$and': [{'host_name': {'$ne': 'test_host_0'}}, {'time': {'$lt': 1400000000}}]},
+                         not_filter(or_filters([host, since])))
+        self.assertEqual({'state': {'$nin': [1, 2]}}, not_filter({'state': {'$in': [1, 2]}}))
+        self.assertEqual({'$nor': [{'time': {'$gte': 1, '$lt': 2}}]}, not_filter({'time': {'$gte': 1, '$lt': 2}}))
+        regex = not_filter(make_filter('~~', 'host_name', 'test'))['host_name']['$not']
+        self.assertEqual('test', regex.pattern)
+
+    def test_negate_superset(self):
+        host = make_filter('=', 'host_name', 'test_host_0')
+        unknown = make_filter('=', 'current_host_state', '0')
+        self.assertTrue(isinstance(unknown, Superset))
+        # not (host and unknown) can't be narrowed down by the database
+        self.assertEqual({}, not_filter(and_filters([host, unknown])))
+        self.assertTrue(isinstance(not_filter(and_filters([host, unknown])), Superset))
+        self.assertEqual({}, not_filter(unknown))
+
+    def test_split_window(self):
+        host = make_filter('=', 'host_name', 'test_host_0')
+        mongo_filter = and_filters([make_filter('>=', 'time', '100'), host, make_filter('<', 'time', '200')])
+        rest, window = split_window(mongo_filter)
+        self.assertEqual({'$and': [host]}, rest)
+        self.assertEqual([('$gte', 100), ('$lt', 200)], window)
+        self.assertTrue(in_window(window, 100))
+        self.assertFalse(in_window(window, 200))
+        # a time inside an $or stays in the filter
+        mongo_filter = or_filters([make_filter('>=', 'time', '100'), host])
+        self.assertEqual((mongo_filter, []), split_window(mongo_filter))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the in-memory copy of the recent log lines.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from filter_compiler import make_filter, and_filters, or_filters, not_filter, lowercase_field, lowercase, add_text_search
+from hot_tier import HotTier
+
+COLUMNS = ['time', 'lineno', 'host_name', 'service_description', 'state', 'message']
+
+
+def line(time, lineno, host_name, service_description='', state=0, message='message'):
+    return {
+        'time': time, 'lineno': lineno, 'logobject': 1, 'logclass': 1,
+        'state': state, 'attempt': 1, 'host_name': host_name,
+        'service_description': service_description, 'type': 'SERVICE ALERT',
+        'state_type': 'HARD', 'contact_name': '', 'command_name': '',
+        'message': message, 'plugin_output': 'output', 'comment': '',
+    }
+
+
+class TestHotTier(unittest.TestCase):
+
+    def setUp(self):
+        self.tier = HotTier(3600, now=1000)
+        self.tier.add(line(1000, 1, 'test_host_0', 'test_ok_0', 0))
+        self.tier.add(line(1001, 1, 'test_host_0', 'test_ok_1', 2))
+        self.tier.add(line(1001, 2, 'test_host_1', 'test_ok_0', 1))
+        # a line which arrives late
+        self.tier.add(line(1000, 2, 'test_host_1', 'test_ok_1', None))
+
+    def find(self, mongo_filter, low=1000, high=None, limit=None):
+        rows = self.tier.find(mongo_filter, COLUMNS, low, high, limit)
+        if rows is None:
+            return None
+        return [row[:2] for row in rows]
+
+    def test_order(self):
+        self.assertEqual([(1000, 1), (1000, 2), (1001, 1), (1001, 2)], self.find({}))
+        self.assertEqual([(1000, 1), (1000, 2)], self.find({}, limit=2))
+        self.assertEqual([(1001, 1), (1001, 2)], self.find({}, low=1001))
+
+    def test_not_covered(self):
+        self.assertEqual(None, self.find({}, low=999))
+        self.assertEqual(None, self.find({}, low=None))
+
+    def test_filters(self):
+        host = make_filter('=', 'host_name', 'test_host_0')
+        self.assertEqual([(1000, 1), (1001, 1)], self.find(host))
+        self.assertEqual([(1000, 2), (1001, 2)], self.find(not_filter(host)))
+        regex = make_filter('~~', 'host_name', 'HOST_1')
+        critical = make_filter('>=', 'state', '2')
+        self.assertEqual([(1000, 2), (1001, 1), (1001, 2)], self.find(or_filters([regex, critical])))
+        self.assertEqual([(1001, 1)], self.find(and_filters([host, make_filter('>=', 'time', '1001')])))
+        self.assertEqual([], self.find(make_filter('=', 'host_name', 'unknown')))
+        # None is null, like in the database
+        self.assertEqual([(1000, 2)], self.find({'state': None}))
+        self.assertEqual([(1000, 1), (1001, 2)], self.find(make_filter('<', 'state', '2')))
+
+    def test_lowercase_fields(self):
+        tier = HotTier(3600, now=1000, derived={lowercase_field('host_name'): ('host_name', lowercase)})
+        tier.add(line(1000, 1, 'Web_1'))
+        tier.add(line(1000, 2, 'db_1'))
+        tier.add(line(1000, 3, 'WEB_2'))
+        rows = tier.find(make_filter('~~', 'host_name', '^web', True), COLUMNS, 1000)
+        self.assertEqual(['Web_1', 'WEB_2'], [row[2] for row in rows])
+        rows = tier.find(make_filter('=~', 'host_name', 'web_2', True), COLUMNS, 1000)
+        self.assertEqual(['WEB_2'], [row[2] for row in rows])
+        rows = tier.find(make_filter('~', 'host_name', '^WEB'), COLUMNS, 1000)
+        self.assertEqual(['WEB_2'], [row[2] for row in rows])
+
+    def test_text_search(self):
+        tier = HotTier(3600, now=1000)
+        tier.add(line(1000, 1, 'test_host_0', message='connect timeout'))
+        tier.add(line(1000, 2, 'test_host_0', message='3 timeouts'))
+        tier.add(line(1000, 3, 'test_host_0', message='ok'))
+        # the regular expression is evaluated, the search is left out
+        substring = make_filter('~', 'message', 'timeout')
+        self.assertEqual(['connect timeout', '3 timeouts'], [row[5] for row in tier.find(substring, COLUMNS, 1000)])
+        self.assertEqual(['connect timeout', '3 timeouts'], [row[5] for row in tier.find(add_text_search(substring), COLUMNS, 1000)])
+        word = add_text_search(make_filter('~', 'message', r'\btimeout\b'))
+        self.assertTrue('$text' in word)
+        self.assertEqual(['connect timeout'], [row[5] for row in tier.find(word, COLUMNS, 1000)])
+
+    def test_values(self):
+        rows = self.tier.find(make_filter('=', 'host_name', 'test_host_1'), COLUMNS, 1000)
+        self.assertEqual((1000, 2, 'test_host_1', 'test_ok_1', None, 'message'), rows[0])
+        self.assertEqual((1001, 2, 'test_host_1', 'test_ok_0', 1, 'message'), rows[1])
+
+    def test_unsupported(self):
+        self.assertEqual(None, self.find({'$where': 'true'}))
+        self.assertEqual(None, self.find({'unknown': 1}))
+
+    def test_expire(self):
+        self.tier.expire(now=1000 + 3600 + 30)
+        self.assertEqual(4, len(self.tier))
+        self.tier.expire(now=1001 + 3600 + 100)
+        self.assertEqual(0, len(self.tier))
+        self.assertEqual(None, self.find({}, low=1000))
+        self.assertEqual([], self.find({}, low=1001 + 3600 + 100))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the index configuration and the query shape
+# statistics.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from filter_compiler import make_filter, and_filters, or_filters, add_text_search
+from index_advisor import DEFAULT_INDEXES, TEXT_INDEX, QueryShapeStats, parse_indexes, query_shape, is_covered
+
+
+class TestIndexAdvisor(unittest.TestCase):
+
+    def test_parse_indexes(self):
+        self.assertEqual([('logs_idx', [('host_name', 1), ('time', 1), ('lineno', 1)]),
+                          (None, [('time', 1), ('lineno', 1)])],
+                         parse_indexes(DEFAULT_INDEXES))
+        self.assertEqual([(None, [('type', 1), ('time', -1)])], parse_indexes(' type, -time ;'))
+
+    def test_query_shape(self):
+        mongo_filter = and_filters([
+            make_filter('>=', 'time', '1400000000'),
+            make_filter('<=', 'time', '1400086400'),
+            make_filter('=', 'host_name', 'test_host_0'),
+            or_filters([make_filter('=', 'state', '1'), make_filter('=', 'state', '2')]),
+        ])
+        self.assertEqual((('host_name', 'eq'), ('or:state', 'eq'), ('time', 'range')), query_shape(mongo_filter))
+
+    def test_text_search(self):
+        mongo_filter = add_text_search(and_filters([make_filter('>=', 'time', '1400000000'),
+                                                    make_filter('~', 'message', r'\btimeout\b')]))
+        shape = query_shape(mongo_filter)
+        self.assertEqual((('$text', 'text'), ('message', 'regex'), ('time', 'range')), shape)
+        self.assertFalse(is_covered(shape, [[('type', 1)]]))
+        self.assertTrue(is_covered(shape, [[('type', 1)], TEXT_INDEX]))
+
+    def test_report(self):
+        stats = QueryShapeStats([keys for name, keys in parse_indexes(DEFAULT_INDEXES)])
+        since = make_filter('>=', 'time', '1400000000')
+        by_host = and_filters([make_filter('=', 'host_name', 'test_host_0'), since])
+        by_type = and_filters([make_filter('=', 'type', 'HOST ALERT'), since])
+        stats.record(by_host, 0.1)
+        stats.record(by_type, 0.5)
+        stats.record(by_type, 1.5)
+        report = stats.report()
+        self.assertEqual('time:range type:eq', report[0]['shape'])
+        self.assertEqual(2, report[0]['count'])
+        self.assertEqual(1.0, report[0]['avg'])
+        self.assertEqual(1.5, report[0]['max'])
+        self.assertFalse(report[0]['covered'])
+        self.assertEqual('type,time,lineno', report[0]['suggestion'])
+        self.assertTrue(report[1]['covered'])
+
+
+if __name__ == '__main__':
+    unittest.main()
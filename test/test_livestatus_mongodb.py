@@ -56,7 +56,8 @@ from mock_livestatus import mock_livestatus_handle_request
 from livestatus.log_line import Logline
 
 
-LiveStatusLogStoreMongoDB = modulesctx.get_module('logstore-mongodb').LiveStatusLogStoreMongoDB
+logstore_mongodb = modulesctx.get_module('logstore-mongodb')
+LiveStatusLogStoreMongoDB = logstore_mongodb.LiveStatusLogStoreMongoDB
 
 
 sys.setcheckinterval(10000)
@@ -235,9 +236,153 @@ Columns: time type options state host_name"""
         self.assert_(curs[0]['state_type'] == 'SOFT')
         self.assert_(curs[1]['state_type'] == 'HARD')
 
+        # only the requested columns are read from the database
+        db = self.livestatus_broker.db
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        loglines = db.get_live_data_log(columns=['time', 'type', 'state'])
+        self.assertEqual(2, len(loglines))
+        self.assertEqual(1, loglines[0].state)
+        self.assertEqual(0, loglines[1].state)
+
+        # stats are computed by the database
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        rows = db.get_live_data_log_stats([('count', None), ('count', ('state', '=', '1')), ('max', 'time')], ['host_name'])
+        self.assertEqual([['test_host_0', 2, 1, loglines[1].time]], rows)
+        # the Limit: of a Stats query is not left for the next query
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        db.add_limit(1)
+        self.assertEqual([[2]], db.get_live_data_log_stats([('count', None)]))
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        self.assertEqual(2, len(db.get_live_data_log()))
+        # but not the ones it can't do, the filter is then left for the query
+        db.add_filter('=', 'host_name', 'test_host_0')
+        self.assertEqual(None, db.get_live_data_log_stats([('count', ('plugin_output', '~', 'down'))]))
+        self.assertEqual(2, len(db.get_live_data_log()))
+
+        # a limit is done by the database
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        db.add_limit(1)
+        loglines = db.get_live_data_log()
+        self.assertEqual(1, len(loglines))
+        self.assertEqual('SOFT', loglines[0].state_type)
+
+        # a streamed result which is not read to its end keeps no connection
+        db.stream_results = True
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        loglines = db.get_live_data_log()
+        self.assertEqual('SOFT', loglines.next().state_type)
+        self.assertEqual(0, db.pool.stats()['in_use'])
+        self.assertEqual(['HARD'], [logline.state_type for logline in loglines])
+        # streamed array rows, also with a query cache, which is only used
+        # when the result is not streamed
+        db.array_rows = True
+        db.query_cache = logstore_mongodb.QueryCache(1024 * 1024)
+        db.add_filter('>=', 'time', str(int(now - 3600)))
+        loglines = list(db.get_live_data_log(columns=['time', 'state_type']))
+        self.assertEqual(['SOFT', 'HARD'], [logline.state_type for logline in loglines])
+        db.array_rows = False
+        db.query_cache = None
+        db.stream_results = False
+
+    def test_projection_columns(self):
+        projection_columns = logstore_mongodb.projection_columns
+        self.assertEqual(['logobject', 'host_name', 'lineno', 'service_description', 'state', 'time'],
+                         projection_columns(['time', 'host_name', 'state']))
+        self.assertEqual(['logobject', 'logclass', 'host_name', 'lineno', 'message', 'service_description', 'time'],
+                         projection_columns(['class', 'options', 'current_service_state']))
+        self.assertEqual(None, projection_columns(['time', 'no_such_column']))
+
+    def test_fast_parser(self):
+        parse_line = logstore_mongodb.parse_line
+        lines = [
+            '[1400000000] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;SOFT;2;BAD;really',
+            '[1400000000] HOST ALERT: test_host_0;DOWN;HARD;3;unreachable',
+            '[1400000000] CURRENT SERVICE STATE: test_host_0;test_ok_0;OK;HARD;1;OK',
+            '[1400000000] CURRENT HOST STATE: test_host_0;UP;HARD;1;OK',
+            '[1400000000] SERVICE DOWNTIME ALERT: test_host_0;test_ok_0;STARTED;Service has entered a period of scheduled downtime',
+            '[1400000000] HOST FLAPPING ALERT: test_host_0;STOPPED;Host appears to have stopped flapping',
+            '[1400000000] SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;CRITICAL;notify-service;BAD',
+            '[1400000000] HOST NOTIFICATION: test_contact;test_host_0;DOWN;notify-host;unreachable',
+            '[1400000000] SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;DOWNTIMESTART (OK);notify-service;OK',
+            '[1400000000] SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;FLAPPINGSTART (CRITICAL);notify-service;BAD',
+            '[1400000000] SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;ACKNOWLEDGEMENT (CRITICAL);notify-service;BAD',
+            '[1400000000] HOST NOTIFICATION: test_contact;test_host_0;(UP);notify-host;OK',
+            '[1400000000] HOST NOTIFICATION: test_contact;test_host_0;DOWNTIMEEND (UP);notify-host;OK',
+            '[1400000000] HOST NOTIFICATION: test_contact;test_host_0;FLAPPINGSTOP (DOWN);notify-host;unreachable',
+            '[1400000000] HOST NOTIFICATION: test_contact;test_host_0;ACKNOWLEDGEMENT (DOWN);notify-host;unreachable',
+            '[1400000000] EXTERNAL COMMAND: [1400000000] DISABLE_NOTIFICATIONS',
+        ]
+        for line in lines:
+            expected = Logline(line=line).as_dict()
+            del expected['lineno']
+            self.assertEqual(expected, parse_line(line))
+
+
+@mock_livestatus_handle_request
+class TestConfigBatched(TestConfig):
+    def setUp(self):
+        self.setup_with_file('etc/shinken_1r_1h_1s.cfg')
+        Comment.id = 1
+        self.testid = str(os.getpid() + random.randint(1, 1000))
+
+        dbmodconf = Module({'module_name': 'LogStore',
+            'module_type': 'logstore_mongodb',
+            'mongodb_uri': self.mongo_db_uri,
+            'database': 'testtest' + self.testid,
+            'insert_batch_size': '100',
+            'insert_batch_timeout': '86400',
+        })
+
+        self.init_livestatus(dbmodconf=dbmodconf)
+        self.sched.conf.skip_initial_broks = False
+        self.sched.brokers['Default-Broker'] = {'broks' : {}, 'has_full_broks' : False}
+        self.sched.fill_initial_broks('Default-Broker')
+
+        self.update_broker()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        host.__class__.use_aggressive_host_checking = 1
+
+
+    def test_batched_logs(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        name = 'testtest' + self.testid
+        now = time.time()
+        host.state = 'DOWN'
+        host.state_type = 'SOFT'
+        host.attempt = 1
+        host.output = "i am down"
+        host.raise_alert_log_entry()
+        host.state = 'UP'
+        host.state_type = 'HARD'
+        host.attempt = 1
+        host.output = "i am up"
+        host.raise_alert_log_entry()
+        self.update_broker()
+        # both lines are still waiting in the insert buffer
+        self.assertEqual(0, self.livestatus_broker.db.conn[name].logs.find().count())
+        self.assertEqual(2, len(self.livestatus_broker.db.insert_buffer))
+
+        # a query sees the buffered lines
+        request = """GET log
+Filter: time >= """ + str(int(now - 3600)) + """
+Filter: time <= """ + str(int(now + 3600)) + """
+Columns: time type options state host_name
+OutputFormat: json"""
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(2, len(eval(response)))
+        self.assertEqual(0, len(self.livestatus_broker.db.insert_buffer))
+        curs = self.livestatus_broker.db.conn[name].logs.find().sort([('time', 1), ('lineno', 1)])
+        self.assertEqual('SOFT', curs[0]['state_type'])
+        self.assertEqual('HARD', curs[1]['state_type'])
+
 
 @mock_livestatus_handle_request
 class TestConfigBig(TestConfig):
+    # more options of the logstore module
+    module_options = {}
+
     def setUp(self):
         super(TestConfigBig, self).setUp()
         start_setUp = time.time()
@@ -245,11 +390,13 @@ class TestConfigBig(TestConfig):
         Comment.id = 1
         self.testid = str(os.getpid() + random.randint(1, 1000))
 
-        dbmodconf = Module({'module_name': 'LogStore',
+        options = {'module_name': 'LogStore',
             'module_type': 'logstore_mongodb',
             'mongodb_uri': self.mongo_db_uri,
             'database': 'testtest' + self.testid,
-        })
+        }
+        options.update(self.module_options)
+        dbmodconf = Module(options)
 
         self.init_livestatus(dbmodconf=dbmodconf)
         print("Cleaning old broks?")
@@ -550,6 +697,22 @@ OutputFormat: json"""
 
 
 
+@mock_livestatus_handle_request
+class TestConfigBigParallel(TestConfigBig):
+    # the long history is read in time slices, the result must be the same
+    module_options = {
+        'parallel_slices': '4',
+        'parallel_min_span': '3600',
+    }
+
+    def test_limit_not_split(self):
+        db = self.livestatus_broker.db
+        week = {'time': {'$gte': int(time.time()) - 7 * 86400}}
+        self.assertEqual(4, len(db.slice_filters(week)))
+        # the database stops at the limit, slices would be read in full
+        self.assertEqual(None, db.slice_filters(week, 10))
+
+
 if __name__ == '__main__':
     #import cProfile
     command = """unittest.main()"""
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the parser of the common log lines.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from log_parser import parse_line
+
+
+class TestLogParser(unittest.TestCase):
+
+    def test_service_alert(self):
+        doc = parse_line('[1400000000] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;SOFT;2;a;b;c\n')
+        self.assertEqual(1400000000, doc['time'])
+        self.assertEqual('SERVICE ALERT', doc['type'])
+        self.assertEqual((1, 2), (doc['logclass'], doc['logobject']))
+        self.assertEqual(('test_host_0', 'test_ok_0'), (doc['host_name'], doc['service_description']))
+        self.assertEqual((2, 'SOFT', 2), (doc['state'], doc['state_type'], doc['attempt']))
+        self.assertEqual('a;b;c', doc['plugin_output'])
+        self.assertEqual('[1400000000] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;SOFT;2;a;b;c', doc['message'])
+        self.assertEqual('', doc['contact_name'])
+
+    def test_host_lines(self):
+        doc = parse_line('[1400000000] CURRENT HOST STATE: test_host_0;UP;HARD;1;OK')
+        self.assertEqual((6, 1, 0), (doc['logclass'], doc['logobject'], doc['state']))
+        doc = parse_line('[1400000000] HOST DOWNTIME ALERT: test_host_0;STARTED;Host has entered a period of scheduled downtime')
+        self.assertEqual(('STARTED', 'Host has entered a period of scheduled downtime'), (doc['state_type'], doc['comment']))
+
+    def test_notifications(self):
+        doc = parse_line('[1400000000] SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;CRITICAL;notify-service;BAD')
+        self.assertEqual(('test_contact', 'notify-service', 2, ''), (doc['contact_name'], doc['command_name'], doc['state'], doc['state_type']))
+        # the special notifications are UNKNOWN, like in Logline
+        for line in ('[1400000000] HOST NOTIFICATION: test_contact;test_host_0;DOWNTIMESTART (UP);notify-host;OK',
+                     '[1400000000] HOST NOTIFICATION: test_contact;test_host_0;(UP);notify-host;OK',
+                     '[1400000000] SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;ACKNOWLEDGEMENT (CRITICAL);notify-service;BAD'):
+            doc = parse_line(line)
+            self.assertEqual((3, ''), (doc['state'], doc['state_type']))
+
+    def test_unknown_lines(self):
+        # These are left to Logline
+        self.assertEqual(None, parse_line('[1400000000] Warning: the sky is falling'))
+        self.assertEqual(None, parse_line('[1400000000] SERVICE ALERT: test_host_0;test_ok_0;PURPLE;SOFT;2;output'))
+        self.assertEqual(None, parse_line('[1400000000] HOST ALERT: test_host_0;DOWN;HARD'))
+        self.assertEqual(None, parse_line('[140000000] HOST ALERT: test_host_0;DOWN;HARD;1;output'))
+        self.assertEqual(None, parse_line('garbage'))
+        self.assertEqual(None, parse_line(''))
+
+
+if __name__ == '__main__':
+    unittest.main()
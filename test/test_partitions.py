@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the time-bucketed collections.
+#
+
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from filter_compiler import make_filter, and_filters, or_filters, time_bounds
+from partitions import bucket_name, bucket_range, buckets_in_range, buckets_before, split_by_bucket, time_slices
+
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        # wednesday, 2014-05-21 12:00 local time
+        self.noon = time.mktime((2014, 5, 21, 12, 0, 0, 0, 0, -1))
+        self.midnight = time.mktime((2014, 5, 21, 0, 0, 0, 0, 0, -1))
+
+    def test_names(self):
+        self.assertEqual('logs_20140521', bucket_name('logs', self.noon, 'day'))
+        self.assertEqual('logs_w20140519', bucket_name('logs', self.noon, 'week'))
+        self.assertEqual('logs_201405', bucket_name('logs', self.noon, 'month'))
+        self.assertEqual((self.midnight, self.midnight + 86400), bucket_range('logs', 'logs_20140521', 'day'))
+        self.assertEqual(None, bucket_range('logs', 'logs', 'day'))
+        self.assertEqual(None, bucket_range('logs', 'logs_201405', 'day'))
+
+    def test_ranges(self):
+        names = ['logs', 'logs_20140522', 'logs_20140520', 'logs_20140521', 'other_20140521']
+        self.assertEqual(['logs_20140520', 'logs_20140521', 'logs_20140522'],
+                         buckets_in_range(names, 'logs', 'day'))
+        self.assertEqual(['logs_20140521'],
+                         buckets_in_range(names, 'logs', 'day', self.noon - 3600, self.noon))
+        self.assertEqual(['logs_20140521', 'logs_20140522'],
+                         buckets_in_range(names, 'logs', 'day', self.noon, None))
+        self.assertEqual(['logs_20140520'], buckets_before(names, 'logs', 'day', self.noon))
+
+    def test_split(self):
+        lines = [{'time': self.noon}, {'time': self.noon + 86400}, {'time': self.noon + 1}]
+        self.assertEqual([('logs_20140521', [lines[0], lines[2]]), ('logs_20140522', [lines[1]])],
+                         split_by_bucket(lines, 'logs', 'day'))
+
+    def test_time_bounds(self):
+        mongo_filter = and_filters([
+            make_filter('>=', 'time', '100'),
+            make_filter('>=', 'time', '150'),
+            make_filter('<=', 'time', '200'),
+            or_filters([make_filter('<', 'time', '120'), make_filter('=', 'state', '1')]),
+        ])
+        self.assertEqual((150, 200), time_bounds(mongo_filter))
+        self.assertEqual((None, None), time_bounds(make_filter('=', 'host_name', 'test_host_0')))
+
+    def test_time_slices(self):
+        slices = time_slices(1000, 1400, 4)
+        self.assertEqual([{'time': {'$lt': 1100}},
+                          {'time': {'$gte': 1100, '$lt': 1200}},
+                          {'time': {'$gte': 1200, '$lt': 1300}},
+                          {'time': {'$gte': 1300}}], slices)
+        for timestamp in (0, 1099, 1100, 1250, 5000):
+            matching = [s for s in slices if s['time'].get('$gte', timestamp) <= timestamp < s['time'].get('$lt', timestamp + 1)]
+            self.assertEqual(1, len(matching))
+
+
+if __name__ == '__main__':
+    unittest.main()
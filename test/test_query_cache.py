@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# This file is used to test the cache of query results.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from filter_compiler import make_filter, and_filters
+from query_cache import QueryCache
+
+
+def line(time, lineno, host_name='test_host_0'):
+    return {'time': time, 'lineno': lineno, 'host_name': host_name, 'message': 'x' * 100}
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = QueryCache(1024 * 1024)
+        self.host = make_filter('=', 'host_name', 'test_host_0')
+        self.since = make_filter('>=', 'time', '100')
+
+    def test_normalized_key(self):
+        key1 = self.cache.key(and_filters([self.host, self.since]), None, None)
+        key2 = self.cache.key(and_filters([self.since, self.host]), None, None)
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, self.cache.key(and_filters([self.since, self.host]), None, 10))
+
+    def test_closed_range(self):
+        key = self.cache.key(self.host, None, None)
+        documents = [line(100, 1), line(101, 1)]
+        self.cache.put(key, documents, 100, 200, self.cache.generation)
+        # lines after the time range don't touch the result
+        self.cache.written([line(300, 1)])
+        entry = self.cache.get(key)
+        self.assertFalse(entry.stale)
+        self.assertEqual(documents, entry.documents)
+
+    def test_extend(self):
+        key = self.cache.key(self.since, None, None)
+        self.cache.put(key, [line(100, 1), line(101, 1)], 100, None, self.cache.generation)
+        self.cache.written([line(101, 2), line(102, 1)])
+        entry = self.cache.get(key)
+        self.assertTrue(entry.stale)
+        self.assertEqual((101, 1), entry.watermark)
+        generation = self.cache.generation
+        self.cache.extend(key, entry, [line(101, 2), line(102, 1)], generation)
+        entry = self.cache.get(key)
+        self.assertFalse(entry.stale)
+        self.assertEqual(4, len(entry.documents))
+        self.assertEqual((102, 1), entry.watermark)
+        # a line before the watermark makes the result useless
+        self.cache.written([line(100, 5)])
+        self.assertEqual(None, self.cache.get(key))
+
+    def test_written_during_query(self):
+        key = self.cache.key(self.since, None, None)
+        generation = self.cache.generation
+        self.cache.written([line(100, 1)])
+        self.cache.put(key, [line(100, 1)], 100, None, generation)
+        self.assertEqual(None, self.cache.get(key))
+
+    def test_memory_budget(self):
+        cache = QueryCache(20000)
+        for num in range(10):
+            cache.put(num, [line(100, 1)] * 5, None, None, cache.generation)
+            cache.get(0)
+        self.assertTrue(cache.size <= 20000)
+        self.assertNotEqual(None, cache.get(0))
+        self.assertEqual(None, cache.get(1))
+
+    def test_trim(self):
+        key = self.cache.tail_key(self.host, None)
+        self.cache.put(key, [line(100, 1), line(101, 1), line(102, 1)], 100, None, self.cache.generation)
+        entry = self.cache.get(key)
+        size = self.cache.size
+        self.cache.trim(key, entry, 102)
+        self.assertEqual([line(102, 1)], entry.documents)
+        self.assertEqual(102, entry.low)
+        self.assertTrue(self.cache.size < size)
+        # older lines are not fetched again
+        self.cache.trim(key, entry, 100)
+        self.assertEqual(102, entry.low)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the routing of queries to the members of a
+# replica set.
+#
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from pymongo import ReadPreference
+from routing import NodeLatency, read_preference, cursor_address
+
+
+class Cursor(object):
+    address = ('db2', 27017)
+
+
+class TestRouting(unittest.TestCase):
+
+    def test_read_preference(self):
+        self.assertEqual(ReadPreference.SECONDARY_PREFERRED, read_preference('secondary_preferred'))
+        self.assertEqual(ReadPreference.NEAREST, read_preference('nearest'))
+        self.assertEqual(None, read_preference('tertiary'))
+
+    def test_node_latency(self):
+        latency = NodeLatency()
+        latency.record(cursor_address(Cursor()), 0.5)
+        latency.record(('db2', 27017), 1.5)
+        latency.record(('db1', 27017), 0.1)
+        report = latency.report(reset=True)
+        self.assertEqual(['db1:27017', 'db2:27017'], [entry['node'] for entry in report])
+        self.assertEqual((2, 1.0, 1.5), (report[1]['count'], report[1]['avg'], report[1]['max']))
+        self.assertEqual([], latency.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
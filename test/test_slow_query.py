@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the slow query log.
+#
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from slow_query import SlowQueryLog, explain_summary, format_slow_query
+
+
+# explain() of MongoDB 3.x for a query on host_name and a time range
+EXPLAIN_3 = {
+    'queryPlanner': {
+        'winningPlan': {
+            'stage': 'FETCH',
+            'inputStage': {
+                'stage': 'IXSCAN',
+                'keyPattern': {'host_name': 1, 'time': 1, 'lineno': 1},
+                'indexName': 'logs_idx',
+            },
+        },
+    },
+    'executionStats': {'nReturned': 40, 'totalKeysExamined': 41, 'totalDocsExamined': 40},
+}
+
+# explain() of MongoDB 3.x for an $or of two indexed conditions
+EXPLAIN_3_OR = {
+    'queryPlanner': {
+        'winningPlan': {
+            'stage': 'SORT',
+            'inputStage': {
+                'stage': 'OR',
+                'inputStages': [
+                    {'stage': 'IXSCAN', 'indexName': 'host_name_1'},
+                    {'stage': 'IXSCAN', 'indexName': 'service_description_1'},
+                ],
+            },
+        },
+    },
+    'executionStats': {'nReturned': 3, 'totalKeysExamined': 10, 'totalDocsExamined': 10},
+}
+
+# explain() of MongoDB 2.x without an index
+EXPLAIN_2 = {'cursor': 'BasicCursor', 'n': 5, 'nscanned': 100000, 'nscannedObjects': 100000}
+
+
+class TestExplainSummary(unittest.TestCase):
+
+    def test_index_scan(self):
+        self.assertEqual({'plan': 'IXSCAN', 'index': 'logs_idx', 'keys_examined': 41,
+                          'docs_examined': 40, 'returned': 40}, explain_summary(EXPLAIN_3))
+
+    def test_or(self):
+        summary = explain_summary(EXPLAIN_3_OR)
+        self.assertEqual('IXSCAN', summary['plan'])
+        self.assertEqual(['host_name_1', 'service_description_1'], sorted(summary['index'].split(',')))
+
+    def test_collection_scan(self):
+        summary = explain_summary({'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}})
+        self.assertEqual('COLLSCAN', summary['plan'])
+        self.assertEqual(None, summary['index'])
+        self.assertEqual(None, summary['returned'])
+
+    def test_old_server(self):
+        self.assertEqual({'plan': 'COLLSCAN', 'index': None, 'keys_examined': 100000,
+                          'docs_examined': 100000, 'returned': 5}, explain_summary(EXPLAIN_2))
+        summary = explain_summary({'cursor': 'BtreeCursor time_1_lineno_1 reverse', 'n': 1})
+        self.assertEqual(('IXSCAN', 'time_1_lineno_1'), (summary['plan'], summary['index']))
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def test_format(self):
+        text = format_slow_query({'total': 2.5, 'compile': 0.001, 'database': 2.0, 'rows': 0.5}, 40,
+                                 ['Filter: host_name = test_host_0', 'Filter: time >= 100', 'And: 2'],
+                                 {'$and': [{'host_name': 'test_host_0'}, {'time': {'$gte': 100}}]},
+                                 [('logs', explain_summary(EXPLAIN_3))])
+        lines = text.split('\n')
+        self.assertEqual('slow query 2.500s (compile 0.001s, database 2.000s, rows 0.500s), 40 rows', lines[0])
+        self.assertEqual('  livestatus: Filter: host_name = test_host_0 | Filter: time >= 100 | And: 2', lines[1])
+        self.assertEqual('  plan of logs: IXSCAN on logs_idx, 41 keys and 40 documents examined, 40 returned', lines[3])
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'slow.log')
+            slow_queries = SlowQueryLog(path, 1.0)
+            self.assertFalse(slow_queries.is_slow(0.5))
+            self.assertTrue(slow_queries.is_slow(1.0))
+            slow_queries.write({'total': 1.5}, 0, [], {}, 'not explained')
+            slow_queries.close()
+            text = open(path).read()
+            self.assertTrue('slow query 1.500s, 0 rows' in text)
+            self.assertTrue('  plan: not explained' in text)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_explain_interval(self):
+        directory = tempfile.mkdtemp()
+        try:
+            slow_queries = SlowQueryLog(os.path.join(directory, 'slow.log'), 1.0, explain_interval=600)
+            # one explain per shape in the interval
+            self.assertTrue(slow_queries.should_explain((('host_name', 'eq'),), now=1000))
+            self.assertFalse(slow_queries.should_explain((('host_name', 'eq'),), now=1599))
+            self.assertTrue(slow_queries.should_explain((('time', 'range'),), now=1599))
+            self.assertTrue(slow_queries.should_explain((('host_name', 'eq'),), now=1600))
+            slow_queries.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2010:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+#
+# This file is used to test the counters and histograms of the module.
+#
+
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module'))
+
+from stats import Histogram, Stats, StatsdSender, write_stats_file, COUNT_BOUNDS
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram(COUNT_BOUNDS)
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(50.5, histogram.summary()['avg'])
+        self.assertEqual(100, histogram.percentile(0.5))
+        self.assertEqual(10, histogram.percentile(0.05))
+        self.assertEqual(1, histogram.percentile(0.01))
+
+    def test_above_last_bound(self):
+        histogram = Histogram((1, 10))
+        histogram.add(500)
+        self.assertEqual(500, histogram.percentile(0.99))
+        self.assertEqual([(1, 0), (10, 0), ('inf', 1)], histogram.summary()['buckets'])
+
+    def test_empty(self):
+        self.assertEqual(None, Histogram(COUNT_BOUNDS).summary()['p95'])
+
+
+class TestStats(unittest.TestCase):
+
+    def test_snapshot(self):
+        stats = Stats()
+        stats.incr('ingest.lines', 10)
+        stats.gauge('backlog', lambda: 3)
+        stats.gauge('broken', lambda: 1 / 0)
+        stats.timing('query.total_time', 0.02)
+        snapshot = stats.snapshot(mark=True)
+        self.assertEqual(10, snapshot['counters']['ingest.lines'])
+        self.assertEqual(3, snapshot['gauges']['backlog'])
+        self.assertEqual(None, snapshot['gauges']['broken'])
+        self.assertEqual('s', snapshot['histograms']['query.total_time']['unit'])
+        # a percentile is never above the largest value
+        self.assertEqual(0.02, snapshot['histograms']['query.total_time']['p50'])
+        # rates are counted since the last mark
+        stats.incr('ingest.lines', 5)
+        stats.marked -= 5
+        self.assertAlmostEqual(1.0, stats.snapshot()['rates']['ingest.lines'], 2)
+        # and so are the histograms
+        stats.timing('query.total_time', 0.5)
+        histogram = stats.snapshot()['histograms']['query.total_time']
+        self.assertEqual((1, 0.5), (histogram['count'], histogram['max']))
+        stats.snapshot(mark=True)
+        histogram = stats.snapshot()['histograms']['query.total_time']
+        self.assertEqual((0, None, 's'), (histogram['count'], histogram['max'], histogram['unit']))
+
+    def test_write_stats_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'stats.json')
+            stats = Stats()
+            stats.incr('reconnects')
+            write_stats_file(path, stats.snapshot())
+            self.assertEqual(1, json.load(open(path))['counters']['reconnects'])
+            self.assertEqual(['stats.json'], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestStatsdSender(unittest.TestCase):
+
+    def test_lines(self):
+        sender = StatsdSender('localhost', prefix='test')
+        stats = Stats()
+        stats.incr('ingest.lines', 10)
+        stats.gauge('backlog', 3)
+        stats.timing('query.total_time', 0.5)
+        stats.observe('query.documents', 42)
+        lines = sender.lines(stats.snapshot())
+        self.assertTrue('test.ingest.lines:10|c' in lines)
+        self.assertTrue('test.backlog:3|g' in lines)
+        self.assertTrue('test.query.total_time.max:500.000000|g' in lines)
+        self.assertTrue('test.query.documents.avg:42.0|g' in lines)
+        # counters are sent as their increase
+        stats.incr('ingest.lines', 2)
+        self.assertTrue('test.ingest.lines:2|c' in sender.lines(stats.snapshot(mark=True)))
+        # histograms with the values of the last interval, none here
+        stats.timing('query.total_time', 0.1)
+        stats.snapshot(mark=True)
+        self.assertFalse([line for line in sender.lines(stats.snapshot()) if 'total_time' in line])
+
+
+if __name__ == '__main__':
+    unittest.main()